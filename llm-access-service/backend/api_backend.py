@@ -1,95 +1,616 @@
 # llm-access-service/backend/api_backend.py
 import os
-import requests
-from fastapi import FastAPI, HTTPException, Request, Header
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from dotenv import load_dotenv
+import json
+import time
+import asyncio
+import logging
+import math
+import uuid
+import httpx
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
+from datetime import date
+from fastapi import FastAPI, HTTPException, Request, Header, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 import firebase_admin
-from firebase_admin import credentials, auth, firestore
-from datetime import date, datetime
-# from fastapi.responses import StreamingResponse # Uncomment for streaming
+from firebase_admin import credentials, firestore
+from upstream_client import create_litellm_client
+from streaming import StreamUsage, proxy_sse_stream, run_detached
+from profile_cache import UserProfileCache
+from quota import FirestoreQuotaEngine, InsufficientBalanceError, QuotaExceededError, UserNotFoundError
+from usage_counter_cache import LocalCounterStore, RedisCounterStore, WriteBehindQuotaEngine
+from usage_rollups import query_rollups
+from response_cache import RESPONSE_CACHE_HEADER, ResponseCache, is_cacheable_request, response_cache_key
+from single_flight import SingleFlight
+from batch_dispatch import ConcurrencyLimits, result_line, run_in_completion_order
+from model_scheduler import (
+    DEFAULT_COMPLETION_TOKENS,
+    PRIORITY_FREE,
+    PRIORITY_PAID,
+    ModelBudget,
+    ModelBusyError,
+    ModelScheduler,
+    ReleasingStream,
+    estimate_request_tokens,
+)
+from upstream_resilience import Deadline, DeadlineExceededError, UpstreamResilience
+from app_logging import configure_logging
+from app_warmup import WarmUp
+from model_registry import ModelRegistryError, ModelRegistryLoader
+from billing_checkpoint import BILLING_REQUEST_ID_KEY
+from token_counter import count_prompt_tokens, load_encodings, text_cache_stats
+from settings import get_settings
+from metrics import REGISTRY
+from api_metrics import (
+    QUOTA_DECISIONS,
+    RESPONSE_CACHE_LOOKUPS,
+    STAGE_SECONDS,
+    UPSTREAM_ERRORS,
+    UPSTREAM_SECONDS,
+    MetricsMiddleware,
+    upstream_error_status,
+)
+from token_verifier import (
+    CachedTokenVerifier,
+    FirebaseAdminTokenVerifier,
+    GoogleCertKeyProvider,
+    TokenVerificationError,
+    TokenVerifierUnavailableError,
+)
 
 
-# Load environment variables from .env file in the backend directory
-load_dotenv()
+# Typed configuration, read once from the environment and the .env file (see settings.py).
+# Firebase, Firestore and the HTTP clients are created per worker when the app starts
+# (see lifespan), never at import: a pre-forking server (gunicorn --preload) imports this
+# module once and forks, and gRPC channels and connection pools must not cross a fork.
+settings = get_settings()
 
-# --- Firebase Admin SDK Initialization ---
-# Initialize Firebase Admin SDK once when the app starts
-FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH = os.environ.get('FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH')
-if not FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH:
-    print("FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH environment variable not set.")
-    # Exit or raise a critical error if the path is not set
-    exit(1) # Exit the application if essential config is missing
+# Structured logs, written by a background thread (see app_logging.py)
+configure_logging(settings.log_level, settings.log_format)
+logger = logging.getLogger("api_backend")
 
-try:
-    # Use a default app name if not already initialized to avoid errors
+# Clients can ask for a shorter time budget than settings.upstream_deadline_seconds (in seconds)
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'
+MIN_REQUEST_TIMEOUT_SECONDS = 1.0 # Lower requests are raised to this
+
+
+def create_firestore_client():
+    """Initializes the Firebase Admin SDK (once per process) and returns a Firestore client."""
     if not firebase_admin._apps:
-        cred = credentials.Certificate(FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH)
+        cred = credentials.Certificate(settings.firebase_service_account_key_path)
         firebase_admin.initialize_app(cred)
-        print("Firebase Admin SDK initialized successfully.")
-    else:
-         print("Firebase Admin SDK already initialized.")
+        logger.info("Firebase Admin SDK initialized successfully.")
+    return firestore.client()
+
+
+def create_quota_engine(db, profile_cache):
+    if settings.quota_backend == 'write-behind':
+        store = RedisCounterStore(settings.quota_redis_url) if settings.quota_redis_url else LocalCounterStore()
+        return WriteBehindQuotaEngine(
+            db,
+            settings.free_call_limit,
+            store=store,
+            flush_interval=settings.quota_flush_interval_seconds,
+            flush_threshold=settings.quota_flush_threshold,
+            max_staleness=settings.quota_max_staleness_seconds,
+        )
+    return FirestoreQuotaEngine(db, settings.free_call_limit, profile_cache=profile_cache)
+
+
+def create_model_scheduler():
+    budgets = {model: ModelBudget(**limits) for model, limits in settings.model_limits.items()}
+    return ModelScheduler(
+        budgets,
+        default_budget=ModelBudget(settings.model_default_max_concurrency, settings.model_default_tokens_per_minute),
+        max_queue=settings.model_queue_max_size,
+        max_wait=settings.model_queue_max_wait_seconds,
+    )
+
+
+def invalidate_user_profile(app, user_id):
+    """Drops every cached copy of the user's profile after it was changed."""
+    app.state.profile_cache.invalidate(user_id)
+    app.state.quota_engine.invalidate(user_id)
+
+
+# --- Firebase ID Token Verification ---
+def create_token_verifier():
+    if settings.firebase_token_verifier == 'firebase':
+        return FirebaseAdminTokenVerifier()
+    project_id = firebase_admin.get_app().project_id
+    return CachedTokenVerifier(project_id, GoogleCertKeyProvider(), cache_size=settings.firebase_token_cache_size)
+
 
-    db = firestore.client() # Get Firestore client
+async def verify_bearer_token(request: Request, authorization):
+    """Verifies the 'Bearer <Firebase ID token>' header value and returns the decoded token."""
+    id_token = authorization.split("Bearer ")[1] if authorization and "Bearer " in authorization else None
+    if not id_token:
+         raise HTTPException(status_code=401, detail="Bearer token missing")
+    try:
+        with STAGE_SECONDS.labels('token_verify').time():
+            return await request.app.state.token_verifier.verify(id_token)
+    except TokenVerificationError as e:
+        logger.info("Token verification failed: %s", e)
+        raise HTTPException(status_code=401, detail="Invalid or expired authentication token.")
+    except TokenVerifierUnavailableError as e:
+        logger.warning("Token verification unavailable: %s", e)
+        raise HTTPException(status_code=503, detail="Authentication is not ready yet. Please retry shortly.",
+                            headers={"Retry-After": "1"})
+
+
+def create_warmup(app):
+    """
+    The first network round trip of each client, run in the background after startup
+    (see app_warmup.py). GET /health/ready reports the worker ready once all are warm.
+    """
+    db = app.state.db
+    http_client = app.state.http_client
+    token_verifier = app.state.token_verifier
+    verifier_started = []
+
+    async def warm_firestore():
+        # Opens the gRPC channel; reading a document that does not exist is the cheapest round trip
+        await run_in_threadpool(db.collection('users').document('_warmup').get)
 
-except Exception as e:
-    print(f"Error initializing Firebase Admin SDK: {e}")
-    # Exit or raise a critical error if initialization fails
-    exit(1)
+    async def warm_litellm():
+        # Any answer leaves a keep-alive connection in the pool
+        await http_client.get(f"{settings.litellm_url}/health/liveliness")
+
+    async def warm_token_verifier():
+        # Loads the signing certificates and starts their background refresh. Requests that
+        # arrive earlier fetch them on demand, and get a 503 while none could be loaded.
+        if not verifier_started:
+            verifier_started.append(True)
+            await token_verifier.start()
+        if not token_verifier.ready:
+            raise RuntimeError("Signing certificates are not loaded yet.")
+
+    async def warm_tokenizers():
+        # Best effort: prompts of models whose encoding could not be loaded are estimated
+        await run_in_threadpool(load_encodings, app.state.model_registry.current.tokenizers)
+
+    return WarmUp(
+        {'firestore': warm_firestore, 'litellm': warm_litellm, 'token_verifier': warm_token_verifier,
+         'tokenizers': warm_tokenizers},
+        max_retry_seconds=settings.warmup_max_retry_seconds,
+    )
 
 
 # --- FastAPI App Setup ---
-app = FastAPI()
+async def shutdown_step(name, step):
+    """Runs one teardown step (a function or coroutine function). Returns False and logs if it fails."""
+    try:
+        result = step()
+        if asyncio.iscoroutine(result):
+            await result
+        return True
+    except Exception as e:
+        logger.exception("Error during shutdown of the %s: %s", name, e)
+        return False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Runs in every worker process. Clients are created here and warmed in the background,
+    # so the worker starts serving without waiting for any network round trip.
+    started = time.perf_counter()
+    # Starts this process's log writer thread if it was forked (see app_logging.py)
+    configure_logging(settings.log_level, settings.log_format)
+    settings.check_required()
+    try:
+        app.state.db = create_firestore_client()
+    except Exception as e:
+        logger.critical("Error initializing Firebase Admin SDK: %s", e)
+        raise
+    # Served models and their prices, re-read in the background when the files change
+    try:
+        app.state.model_registry = ModelRegistryLoader(settings.litellm_config_path, settings.model_pricing_path)
+    except ModelRegistryError as e:
+        logger.critical("Error loading the model registry: %s", e)
+        raise
+    app.state.model_registry.start(settings.model_registry_reload_seconds)
+    # Create one shared HTTP client (keep-alive connection pool) for all LiteLLM calls
+    # and close it when the app shuts down.
+    app.state.http_client = create_litellm_client(
+        max_connections=settings.litellm_http_max_connections,
+        max_keepalive_connections=settings.litellm_http_max_keepalive_connections,
+        keepalive_expiry=settings.litellm_http_keepalive_expiry,
+        connect_timeout=settings.litellm_http_connect_timeout,
+        read_timeout=settings.litellm_http_read_timeout,
+        write_timeout=settings.litellm_http_write_timeout,
+        pool_timeout=settings.litellm_http_pool_timeout,
+        http2=settings.litellm_http2,
+    )
+    app.state.litellm_headers = {
+        "Authorization": f"Bearer {settings.litellm_api_key}",
+        "Content-Type": "application/json"
+    } if settings.litellm_api_key else None
+    logger.info("LiteLLM HTTP client created.")
+    app.state.token_verifier = create_token_verifier()
+    # Cached user profiles, read by the quota engine
+    app.state.profile_cache = UserProfileCache(
+        app.state.db,
+        max_size=settings.profile_cache_size,
+        ttl=settings.profile_cache_ttl_seconds,
+        use_snapshot_listener=settings.profile_cache_snapshot_listener,
+    )
+    # Daily free-call reservations
+    app.state.quota_engine = create_quota_engine(app.state.db, app.state.profile_cache)
+    await app.state.quota_engine.start()
+    app.state.response_cache = ResponseCache(
+        max_bytes=settings.response_cache_max_bytes,
+        max_entry_bytes=settings.response_cache_max_entry_bytes,
+        ttl=settings.response_cache_ttl_seconds,
+        redis_url=settings.response_cache_redis_url,
+    ) if settings.response_cache_enabled else None
+    app.state.single_flight = SingleFlight() if settings.single_flight_enabled else None
+    app.state.batch_limits = ConcurrencyLimits(settings.batch_max_concurrency, settings.batch_per_user_concurrency)
+    # Per-model concurrency and token-rate budgets for LiteLLM calls
+    app.state.model_scheduler = create_model_scheduler()
+    # Retries, hedging and circuit breakers for LiteLLM calls
+    app.state.upstream_resilience = UpstreamResilience(
+        max_attempts=settings.upstream_max_attempts,
+        backoff_base=settings.upstream_backoff_base_seconds,
+        backoff_max=settings.upstream_backoff_max_seconds,
+        failure_threshold=settings.upstream_breaker_failure_threshold,
+        reset_timeout=settings.upstream_breaker_reset_seconds,
+        hedging=settings.upstream_hedging_enabled,
+        hedge_min_samples=settings.upstream_hedge_min_samples,
+    )
+    app.state.warmup = create_warmup(app)
+    app.state.warmup.start()
+    logger.info("Worker started.", extra={'pid': os.getpid(), 'startup_seconds': round(time.perf_counter() - started, 3)})
+    try:
+        yield
+    finally:
+        # Each step runs even if an earlier one failed, so e.g. a failed final flush of the
+        # usage counters does not leave the HTTP client and the listeners open.
+        state = app.state
+        await shutdown_step('warm-up', state.warmup.stop)
+        await shutdown_step('model registry', state.model_registry.stop)
+        logger.info("Model scheduler stats", extra={'stats': state.model_scheduler.stats()})
+        logger.info("Upstream resilience stats", extra={'stats': state.upstream_resilience.stats()})
+        if state.single_flight is not None:
+            logger.info("Request coalescing stats", extra={'stats': state.single_flight.stats()})
+        if state.response_cache is not None:
+            logger.info("Response cache stats", extra={'stats': state.response_cache.stats()})
+            await shutdown_step('response cache', state.response_cache.close)
+        await shutdown_step('quota engine', state.quota_engine.stop) # Flushes pending usage counters
+        await shutdown_step('user profile cache', state.profile_cache.close)
+        logger.info("User profile cache stats", extra={'stats': state.profile_cache.stats()})
+        logger.info("Token count cache stats", extra={'stats': text_cache_stats()})
+        await shutdown_step('token verifier', state.token_verifier.stop)
+        if await shutdown_step('LiteLLM HTTP client', state.http_client.aclose):
+            logger.info("LiteLLM HTTP client closed.")
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+
+BREAKER_STATES = {'closed': 0, 'half-open': 1, 'open': 2}
+
+
+def collect_app_state_metrics():
+    """Metrics read from the app's components at scrape time."""
+    state = app.state
+    scheduler = getattr(state, 'model_scheduler', None)
+    if scheduler is not None:
+        stats = scheduler.stats()
+        for key, name, metric_type, help_text in (
+            ('in_flight', 'llm_backend_scheduler_in_flight', 'gauge', 'LiteLLM calls in flight per model.'),
+            ('queue_depth', 'llm_backend_scheduler_queue_depth', 'gauge', 'Calls waiting for a model budget.'),
+            ('queued', 'llm_backend_scheduler_queued_total', 'counter', 'Calls that had to wait for a model budget.'),
+            ('wait_seconds_total', 'llm_backend_scheduler_wait_seconds_total', 'counter', 'Total time calls waited for a model budget.'),
+            ('rejected', 'llm_backend_scheduler_rejected_total', 'counter', 'Calls rejected because the model queue was full.'),
+            ('timeouts', 'llm_backend_scheduler_timeouts_total', 'counter', 'Calls that gave up waiting for a model budget.'),
+        ):
+            yield name, metric_type, help_text, [({'model': model}, model_stats[key]) for model, model_stats in stats.items()]
+
+    resilience = getattr(state, 'upstream_resilience', None)
+    if resilience is not None:
+        stats = resilience.stats()
+        for key in ('retries', 'hedges', 'hedge_wins', 'deadlines_exceeded'):
+            yield f'llm_backend_upstream_{key}_total', 'counter', f'LiteLLM {key.replace("_", " ")}.', [({}, stats[key])]
+        yield 'llm_backend_circuit_breaker_state', 'gauge', 'Circuit breaker state per model (0 closed, 1 half-open, 2 open).', [
+            ({'model': model}, BREAKER_STATES[breaker['state']]) for model, breaker in stats['breakers'].items()]
+
+    response_cache = getattr(state, 'response_cache', None)
+    if response_cache is not None:
+        stats = response_cache.stats()
+        yield 'llm_backend_response_cache_bytes', 'gauge', 'Size of the in-memory response cache.', [({}, stats['bytes'])]
+        yield 'llm_backend_response_cache_entries', 'gauge', 'Entries in the in-memory response cache.', [({}, stats['entries'])]
+
+    single_flight = getattr(state, 'single_flight', None)
+    if single_flight is not None:
+        stats = single_flight.stats()
+        yield 'llm_backend_coalesced_requests_total', 'counter', 'Requests served by another request\'s upstream call.', [
+            ({}, stats['followers'])]
+
+    profile_cache = getattr(state, 'profile_cache', None)
+    if profile_cache is not None:
+        stats = profile_cache.stats()
+        yield 'llm_backend_profile_cache_size', 'gauge', 'Cached user profiles.', [({}, stats['size'])]
+        yield 'llm_backend_profile_cache_lookups_total', 'counter', 'User profile cache lookups by result.', [
+            ({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]
+
+
+REGISTRY.add_collector(collect_app_state_metrics)
 
 # Define request body model for /chat/completion
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: list
+    stream: bool = False # If true, LiteLLM's SSE chunks are proxied to the client as they arrive
+    # Optional sampling parameters, forwarded to LiteLLM when set
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = Field(None, ge=1) # Sizes the balance hold, so it must be positive
+    seed: Optional[int] = None
+    stop: Optional[Union[str, list]] = None
+
+
+# Request body model for /chat/completions/batch
+class BatchChatCompletionRequest(BaseModel):
+    requests: List[ChatCompletionRequest]
+
+
+def build_litellm_payload(body, user_id):
+    """The LiteLLM /v1/chat/completions payload for a ChatCompletionRequest."""
+    # Prepare the payload for LiteLLM - ensure it matches LiteLLM's expected input
+    # LiteLLM's /v1/chat/completions endpoint expects OpenAI Chat Completions API format
+    litellm_payload = {
+        "model": body.model, # Use the model from the frontend request
+        "messages": body.messages, # Use the messages from the frontend request
+    }
+    for param in ("temperature", "top_p", "max_tokens", "seed", "stop"):
+        if getattr(body, param) is not None:
+            litellm_payload[param] = getattr(body, param)
+
+    # Add user identifier for LiteLLM logging (crucial for your billing script)
+    # This adds a 'user' field to the LiteLLM log which your billing script can read.
+    litellm_payload["user"] = user_id
+    return litellm_payload
+
+
+def upstream_payload(litellm_payload, request_id, **extra):
+    """
+    The body of one upstream attempt. All attempts of a call (retries and hedges) carry the
+    same request id, which LiteLLM logs with the usage: the billing job bills it once.
+    """
+    return dict(litellm_payload, metadata={BILLING_REQUEST_ID_KEY: request_id}, **extra)
+
+
+def allows_coalescing(cache_header):
+    return (cache_header or '').strip().lower() != 'bypass'
+
+
+def coalescing_key(kind, litellm_payload, priority):
+    # The shared call waits for the model budget with the leader's priority, so free-tier
+    # and paid callers don't share calls
+    return f"{kind}:{priority}:{response_cache_key(litellm_payload)}"
+
+
+def coalescing_deadline_exceeded(model):
+    return DeadlineExceededError(f"No answer from model {model} before the request deadline.")
+
+
+def call_priority(reservation):
+    # Users with a paid balance are admitted before free-tier users when a model is busy
+    return PRIORITY_PAID if reservation.balance > 0 else PRIORITY_FREE
+
+
+def unknown_model_message(registry, model):
+    return f"Unknown model: {model}. Available models: {', '.join(registry.served_models)}."
+
+
+# --- Pre-flight Cost Estimate and Settlement ---
+def max_completion_tokens(model_info, litellm_payload):
+    """The most output tokens a call can produce: max_tokens, capped at the model's limit."""
+    limit = model_info.max_output_tokens or DEFAULT_COMPLETION_TOKENS
+    requested = litellm_payload.get('max_tokens')
+    return min(requested, limit) if requested else limit
+
+
+def preflight_estimate(model_info, litellm_payload):
+    """
+    Counts the prompt's tokens locally (see token_counter.py) and returns (prompt tokens,
+    maximum cost of the call), the cost if it produces max_completion_tokens() of output.
+    """
+    with STAGE_SECONDS.labels('token_count').time():
+        prompt_tokens = count_prompt_tokens(litellm_payload['messages'], model_info.tokenizer)
+    return prompt_tokens, model_info.estimate_cost(prompt_tokens, max_completion_tokens(model_info, litellm_payload))
+
+
+def response_cost(model_info, content, prompt_tokens):
+    """The actual cost of a call from the usage block of its LiteLLM response, or None if it has none."""
+    try:
+        usage = json.loads(content).get('usage') or {}
+    except (ValueError, AttributeError):
+        return None
+    if usage.get('completion_tokens') is None:
+        return None
+    return model_info.estimate_cost(usage.get('prompt_tokens') or prompt_tokens, usage['completion_tokens'])
+
+
+def billable_cost(own_call, cost):
+    """
+    What a delivered call is charged. Response cache hits and coalesced followers get a body
+    without a LiteLLM call of their own, so the billing job writes no record for them: they
+    are settled at 0, and the balance only moves by what the billing history shows.
+    """
+    return cost if own_call else 0.0
+
+
+async def settle_calls(quota_engine, settlements):
+    """
+    Charges completed paid calls, given as [(reservation, actual cost or None)], and releases
+    their holds. A call without a known cost is charged its held maximum cost. Runs after the
+    response was sent, so a failure is only logged (the holds lapse, see quota.py).
+    """
+    paid = [(reservation, cost) for reservation, cost in settlements if not reservation.is_free_call]
+    if not paid:
+        return
+    unknown = sum(cost is None for _, cost in paid)
+    if unknown:
+        logger.warning("No usage in %d LiteLLM responses, charging the held maximum cost.", unknown,
+                       extra={'user_id': paid[0][0].user_id})
+    try:
+        await quota_engine.settle_many([(reservation, reservation.held if cost is None else cost) for reservation, cost in paid])
+    except Exception as e:
+        logger.error("Error settling %d paid calls: %s", len(paid), e, extra={'user_id': paid[0][0].user_id})
+
+
+def request_timeout_seconds(request):
+    """The request's time budget: settings.upstream_deadline_seconds, or less if the client asked for it."""
+    try:
+        requested = float(request.headers.get(REQUEST_TIMEOUT_HEADER, settings.upstream_deadline_seconds))
+    except ValueError:
+        requested = settings.upstream_deadline_seconds
+    if math.isnan(requested):
+        requested = settings.upstream_deadline_seconds
+    return max(MIN_REQUEST_TIMEOUT_SECONDS, min(requested, settings.upstream_deadline_seconds))
+
+
+def deadline_exceeded_exception(e):
+    return HTTPException(status_code=504, detail=str(e))
+
+
+def model_busy_exception(e):
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+def upstream_rate_limited_exception(e):
+    # LiteLLM (or the provider behind it) is rate limiting: tell the client when to retry
+    retry_after = e.response.headers.get("Retry-After", "1")
+    return HTTPException(status_code=503, detail="The language model is busy. Please retry later.",
+                         headers={"Retry-After": retry_after})
+
+
+async def fetch_completion(app, litellm_url, litellm_headers, litellm_payload, prompt_tokens, cache_header=None,
+                           priority=PRIORITY_FREE, deadline=None):
+    """
+    Non-streaming LiteLLM call, through the response cache and request coalescing when enabled.
+    Returns (response body as JSON bytes, response cache status or None, whether this caller's
+    own LiteLLM call produced the body). Raises httpx.HTTPError, ModelBusyError if the model is
+    busy or unhealthy, or DeadlineExceededError.
+    The caller must have reserved the call: a cache hit counts like any other call. Only an own
+    call is logged by LiteLLM (and billed), so only an own call is charged (see billable_cost).
+    """
+    deadline = deadline or Deadline(settings.upstream_deadline_seconds)
+    response_cache = app.state.response_cache
+    cache_key = None
+    cache_status = None
+    if response_cache is not None:
+        if is_cacheable_request(litellm_payload, False, cache_header):
+            cache_key = response_cache_key(litellm_payload)
+            cached_body = await response_cache.get(cache_key)
+            if cached_body is not None:
+                RESPONSE_CACHE_LOOKUPS.labels('hit').inc()
+                return cached_body, "HIT", False
+            cache_status = "MISS"
+        else:
+            cache_status = "BYPASS"
+        RESPONSE_CACHE_LOOKUPS.labels(cache_status.lower()).inc()
+
+    scheduler = app.state.model_scheduler
+    model = litellm_payload["model"]
+    request_tokens = estimate_request_tokens(prompt_tokens, litellm_payload.get("max_tokens"))
+
+    async def attempt(call_deadline, request_id):
+        # Wait for the model's budget, then call LiteLLM's chat completions endpoint
+        ticket = await scheduler.acquire(model, request_tokens, priority)
+        actual_tokens = None
+        try:
+            http_client = app.state.http_client
+            upstream_request = http_client.build_request(
+                "POST",
+                f"{litellm_url}/v1/chat/completions",
+                headers=litellm_headers,
+                # LiteLLM gives up when we do
+                json=upstream_payload(litellm_payload, request_id, timeout=round(call_deadline.remaining(), 3)),
+            )
+            started = time.perf_counter()
+            upstream_response = await http_client.send(upstream_request, stream=True)
+            UPSTREAM_SECONDS.labels(model, 'ttfb').observe(time.perf_counter() - started)
+            try:
+                await upstream_response.aread()
+            finally:
+                await upstream_response.aclose()
+            UPSTREAM_SECONDS.labels(model, 'total').observe(time.perf_counter() - started)
+            upstream_response.raise_for_status() # Raise an exception for bad status codes
+            completion = upstream_response.json() # Only pass on (and cache) valid JSON
+            if isinstance(completion, dict):
+                actual_tokens = (completion.get("usage") or {}).get("total_tokens")
+        except httpx.HTTPError as e:
+            UPSTREAM_ERRORS.labels(model, upstream_error_status(e)).inc()
+            raise
+        finally:
+            scheduler.release(ticket, actual_tokens)
+        return upstream_response.content
+
+    async def call_litellm(call_deadline):
+        request_id = uuid.uuid4().hex
+        content = await app.state.upstream_resilience.call(
+            model, call_deadline, lambda: attempt(call_deadline, request_id), hedge=True)
+        if cache_key is not None:
+            await response_cache.set(cache_key, content)
+        return content
+
+    # Concurrent identical requests wait for one upstream call. Each caller reserved
+    # its own call and is refunded on its own if the shared call fails.
+    single_flight = app.state.single_flight
+    if single_flight is not None and allows_coalescing(cache_header):
+        # The shared call gets the longest budget any caller can have; each caller (the
+        # leader too) only waits for it until its own deadline
+        try:
+            content, leader = await single_flight.do(
+                coalescing_key("json", litellm_payload, priority),
+                lambda: call_litellm(Deadline(settings.upstream_deadline_seconds)),
+                timeout=deadline.remaining(),
+            )
+        except asyncio.TimeoutError:
+            raise coalescing_deadline_exceeded(model) from None
+        return content, cache_status, leader
+    return await call_litellm(deadline), cache_status, True
 
 
 # --- Endpoint to Generate API Key ---
 @app.post("/generate-api-key")
-async def generate_api_key(authorization: str = Header(...)):
+async def generate_api_key(request: Request, authorization: str = Header(...)):
     """
     Generates a LiteLLM API key for the authenticated user and stores it in Firestore.
     Requires Firebase Auth ID token in Authorization header.
     """
     try:
         # 1. Verify Firebase Authentication token
-        id_token = authorization.split("Bearer ")[1] if "Bearer " in authorization else None
-        if not id_token:
-             raise HTTPException(status_code=401, detail="Bearer token missing")
-
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = await verify_bearer_token(request, authorization)
         user_id = decoded_token['uid']
-        print(f"Authenticated user ID for key generation: {user_id}")
-
-        # 2. Get LiteLLM configuration from environment variables
-        litellm_url = os.environ.get('LITELLM_INTERNAL_API_URL', 'http://litellm:4000') # Default to internal Docker URL
-        litellm_internal_key = os.environ.get('LITELLM_INTERNAL_API_KEY')
+        logger.debug("Authenticated user for key generation", extra={'user_id': user_id})
 
-        if not litellm_internal_key:
-            print("LITELLM_INTERNAL_API_KEY environment variable not set for key generation.")
+        # 2. Get LiteLLM configuration (see settings.py)
+        litellm_headers = request.app.state.litellm_headers
+        if litellm_headers is None:
+            logger.error("LITELLM_INTERNAL_API_KEY environment variable not set for key generation.")
             raise HTTPException(status_code=500, detail="Backend configuration error: LiteLLM key not set.")
 
         # 3. Call LiteLLM /key/generate API
-        generate_key_url = f"{litellm_url}/key/generate"
+        generate_key_url = f"{settings.litellm_url}/key/generate"
         try:
-            # Define models the key can access (based on your LiteLLM config)
-            allowed_models = ["gpt-4o", "deepseek-r1"]
+            # Define models the key can access: the served models of the model registry (see model_registry.py)
+            allowed_models = list(request.app.state.model_registry.current.served_models)
             # Define the initial budget. In a real app, this would be based on user's plan/balance.
             # For the free tier scenario, the first key might have a small budget or infinite (if limit is daily calls)
             # If using daily call limit implemented in backend, max_budget could be high or infinite here.
             # Let's set a nominal initial budget for demonstration, but daily call limit is enforced in /chat/completion
             initial_max_budget = 1000000 # Set a high budget if enforcing daily calls in backend
 
-            litellm_response = requests.post(
+            litellm_response = await request.app.state.http_client.post(
                 generate_key_url,
-                headers={
-                    "Authorization": f"Bearer {litellm_internal_key}",
-                    "Content-Type": "application/json"
-                },
+                headers=litellm_headers,
                 json={
                     "model": allowed_models, # Specify models the key can access
                     "duration": "inf", # Key duration (e.g., "1h", "2d", "inf") - 'inf' means no expiry
@@ -102,28 +623,29 @@ async def generate_api_key(authorization: str = Header(...)):
             generated_key = litellm_data.get("key")
 
             if not generated_key:
-                 print(f"LiteLLM did not return an API key. Response: {litellm_data}")
+                 logger.error("LiteLLM did not return an API key. Response fields: %s", sorted(litellm_data))
                  raise HTTPException(status_code=500, detail="Failed to generate API key from LiteLLM.")
 
-            print(f"Generated LiteLLM key for user {user_id}: {generated_key}")
+            logger.info("Generated LiteLLM key", extra={'user_id': user_id}) # Never log the key itself
 
-        except requests.exceptions.RequestException as e:
-            print(f"Error calling LiteLLM API for key generation: {e}")
+        except httpx.HTTPError as e:
+            logger.error("Error calling LiteLLM API for key generation: %s", e)
             raise HTTPException(status_code=500, detail=f"Error communicating with LiteLLM: {e}")
         except Exception as e:
-             print(f"An unexpected error occurred during LiteLLM key generation call: {e}")
+             logger.exception("An unexpected error occurred during LiteLLM key generation call: %s", e)
              raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
 
 
         # 4. Update Firestore with the New Key
         try:
-            user_ref = db.collection('users').document(user_id)
+            user_ref = request.app.state.db.collection('users').document(user_id)
             # Use set(merge=True) to update or create the document if it doesn't exist
             user_ref.set({'apiKey': generated_key}, merge=True)
-            print(f"Updated Firestore with API key for user {user_id}")
+            invalidate_user_profile(request.app, user_id)
+            logger.info("Updated Firestore with API key", extra={'user_id': user_id})
 
         except Exception as e:
-            print(f"Error updating Firestore with new API key: {e}")
+            logger.error("Error updating Firestore with new API key: %s", e, extra={'user_id': user_id})
             # Consider what to do if Firestore update fails after generating key in LiteLLM
             # You might want to log this as a critical error
             raise HTTPException(status_code=500, detail="Error saving API key to database.")
@@ -135,7 +657,7 @@ async def generate_api_key(authorization: str = Header(...)):
     except HTTPException as e:
         raise e # Re-raise FastAPI HTTPExceptions
     except Exception as e:
-        print(f"An unexpected error occurred in /generate-api-key: {e}")
+        logger.exception("An unexpected error occurred in /generate-api-key: %s", e)
         # Catch authentication errors from verify_id_token
         if "Firebase ID token has expired" in str(e) or "Firebase ID token is invalid" in str(e):
              raise HTTPException(status_code=401, detail="Invalid or expired authentication token.")
@@ -152,152 +674,203 @@ async def chat_completion(request: Request, body: ChatCompletionRequest):
     Requires Firebase Auth ID token in Authorization header.
     """
     user_id = None
+    deadline = Deadline(request_timeout_seconds(request)) # Covers everything below, including retries
     try:
         # 1. Verify Firebase Authentication token
         auth_header = request.headers.get('Authorization')
         if not auth_header:
             raise HTTPException(status_code=401, detail="Authorization header missing")
 
-        id_token = auth_header.split("Bearer ")[1] if "Bearer " in auth_header else None
-        if not id_token:
-             raise HTTPException(status_code=401, detail="Bearer token missing")
-
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = await verify_bearer_token(request, auth_header)
         user_id = decoded_token['uid']
-        print(f"Authenticated user ID for chat completion: {user_id}")
-
-        # 2. Retrieve User Data and Check Usage Limits
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-
-        FREE_CALL_LIMIT = 5 # Define your daily free call limit
-        request_allowed = False # Flag to indicate if the request is allowed
-
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            freeCallsToday = user_data.get('freeCallsToday', 0)
-            lastFreeCallDate_ts = user_data.get('lastFreeCallDate') # This will be a Firestore Timestamp
-
-            today = date.today()
-            # Convert Firestore Timestamp to date object
-            lastFreeCallDate = lastFreeCallDate_ts.toDate().date() if lastFreeCallDate_ts else None
-
-            # Check if it's a new day and reset free calls
-            if lastFreeCallDate is None or lastFreeCallDate < today:
-                print(f"User {user_id} - New day, resetting free calls.")
-                freeCallsToday = 0
-                # Store the current date as a Firestore Timestamp (datetime object)
-                user_ref.update({
-                    'freeCallsToday': freeCallsToday,
-                    'lastFreeCallDate': datetime.combine(today, datetime.min.time())
-                })
-                # Re-fetch user data after update
-                user_doc = user_ref.get()
-                user_data = user_doc.to_dict() # Get updated data
-
-            # Check if user has remaining free calls
-            if user_data.get('freeCallsToday', 0) < FREE_CALL_LIMIT:
-                # User has remaining free calls, allow the request
-                request_allowed = True
-                print(f"User {user_id} - Using free call. Remaining: {FREE_CALL_LIMIT - user_data.get('freeCallsToday', 0) -1}") # -1 for the current call
-
-            else:
-                # Free limit reached, check paid balance
-                print(f"User {user_id} - Free limit reached. Checking paid balance.")
-                user_balance = user_data.get('balance', 0) # Assuming 'balance' field in user doc
-
-                if user_balance > 0:
-                    # User has a positive balance, allow the request for paid usage
-                    request_allowed = True
-                    print(f"User {user_id} - Has balance {user_balance}. Allowing paid call.")
-                    # Note: Actual cost deduction happens later when processing LiteLLM logs
-
-                else:
-                    # User has no free calls left and insufficient balance
-                    print(f"User {user_id} - Has insufficient balance.")
-                    request_allowed = False
-                    raise HTTPException(
-                        status_code=403, # Forbidden
-                        detail="You have run out of tokens. Please top up your account to continue."
-                    )
+        logger.debug("Authenticated user for chat completion", extra={'user_id': user_id})
 
-        else:
+        # 2. Look up the model in the model registry (see model_registry.py)
+        model_registry = request.app.state.model_registry.current
+        model_info = model_registry.served(body.model)
+        if model_info is None:
+            logger.info("Unknown model requested.", extra={'user_id': user_id, 'model': body.model})
+            raise HTTPException(status_code=400, detail=unknown_model_message(model_registry, body.model))
+
+        # 3. Count the prompt's tokens and estimate the call's maximum cost
+        litellm_payload = build_litellm_payload(body, user_id)
+        prompt_tokens, max_cost = preflight_estimate(model_info, litellm_payload)
+
+        # 4. Check Usage Limits and Reserve the Call
+        # The daily reset, the free-call check and the reservation happen in one atomic operation.
+        # A paid call holds its maximum cost of the balance until it is settled to the actual cost.
+        # A reserved call is refunded below if the LiteLLM call fails.
+        quota_engine = request.app.state.quota_engine
+        try:
+            with STAGE_SECONDS.labels('quota_reserve').time():
+                reservation = await quota_engine.reserve(user_id, cost=max_cost)
+        except InsufficientBalanceError as e:
+            QUOTA_DECISIONS.labels('insufficient_balance').inc()
+            logger.info("Balance does not cover the maximum cost.",
+                        extra={'user_id': user_id, 'available': e.available, 'max_cost': max_cost})
+            raise HTTPException(status_code=403, detail=str(e))
+        except QuotaExceededError as e:
+            QUOTA_DECISIONS.labels('exhausted').inc()
+            logger.info("User has insufficient balance.", extra={'user_id': user_id})
+            raise HTTPException(status_code=403, detail=str(e)) # Forbidden
+        except UserNotFoundError:
             # User document doesn't exist (shouldn't happen if user is authenticated via Firebase)
-             print(f"User document not found for authenticated user: {user_id}")
-             raise HTTPException(status_code=500, detail="User data not found.")
+            QUOTA_DECISIONS.labels('user_not_found').inc()
+            logger.error("User document not found for authenticated user.", extra={'user_id': user_id})
+            raise HTTPException(status_code=500, detail="User data not found.")
 
-        # 3. If request is allowed, Call LiteLLM and return response
-        if request_allowed:
-            print(f"User {user_id} request allowed. Calling LiteLLM.")
+        QUOTA_DECISIONS.labels('free' if reservation.is_free_call else 'paid').inc()
+        if reservation.is_free_call:
+            logger.debug("Using free call.", extra={'user_id': user_id, 'free_calls_remaining': settings.free_call_limit - reservation.free_calls_used})
+        else:
+            logger.debug("Free limit reached. Allowing paid call.", extra={'user_id': user_id, 'balance': reservation.balance, 'held': reservation.held})
+        request_allowed = True
 
-            litellm_url = os.environ.get('LITELLM_INTERNAL_API_URL', 'http://litellm:4000') # Default to internal Docker URL
-            litellm_internal_key = os.environ.get('LITELLM_INTERNAL_API_KEY')
+        # 5. If request is allowed, Call LiteLLM and return response
+        if request_allowed:
 
-            if not litellm_internal_key:
-                print("LITELLM_INTERNAL_API_KEY environment variable not set for chat completion.")
+            litellm_url = settings.litellm_url
+            litellm_headers = request.app.state.litellm_headers
+            if litellm_headers is None:
+                logger.error("LITELLM_INTERNAL_API_KEY environment variable not set for chat completion.")
+                await quota_engine.refund(reservation)
                 raise HTTPException(status_code=500, detail="Backend configuration error: LiteLLM key not set for chat.")
 
-            # Prepare the payload for LiteLLM - ensure it matches LiteLLM's expected input
-            # LiteLLM's /v1/chat/completions endpoint expects OpenAI Chat Completions API format
-            litellm_payload = {
-                "model": body.model, # Use the model from the frontend request
-                "messages": body.messages, # Use the messages from the frontend request
-                # "stream": True # Uncomment for streaming
-                # Add other LiteLLM parameters if needed (e.g., temperature, max_tokens)
-            }
-
-            # Add user identifier for LiteLLM logging (crucial for your billing script)
-            # This adds a 'user' field to the LiteLLM log which your billing script can read.
-            litellm_payload["user"] = user_id
+            http_client = request.app.state.http_client
+            cache_header = request.headers.get(RESPONSE_CACHE_HEADER)
 
             try:
-                # Call LiteLLM's chat completions endpoint
-                litellm_response = requests.post(
-                    f"{litellm_url}/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {litellm_internal_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json=litellm_payload,
-                    # stream=True # Uncomment for streaming
-                )
-                litellm_response.raise_for_status() # Raise an exception for bad status codes
-
-                # Update free calls count in Firestore AFTER successful LiteLLM call if it was a free call
-                if user_data.get('freeCallsToday', 0) < FREE_CALL_LIMIT:
-                     current_free_calls = user_data.get('freeCallsToday', 0)
-                     user_ref.update({
-                         'freeCallsToday': current_free_calls + 1,
-                         'lastFreeCallDate': datetime.combine(today, datetime.min.time()) # Update timestamp on each free call
-                     })
-                     print(f"User {user_id} - Incremented free call count after successful LiteLLM call.")
+                if body.stream:
+                    # Ask LiteLLM for SSE chunks, plus a final usage chunk if the provider supports it
+                    litellm_payload["stream"] = True
+                    litellm_payload["stream_options"] = {"include_usage": True}
 
+                    async def open_litellm_stream_attempt(request_id):
+                        # The scheduler ticket is held until the upstream stream is closed
+                        scheduler = request.app.state.model_scheduler
+                        ticket = await scheduler.acquire(
+                            body.model, estimate_request_tokens(prompt_tokens, body.max_tokens), call_priority(reservation))
+                        try:
+                            upstream_request = http_client.build_request(
+                                "POST",
+                                f"{litellm_url}/v1/chat/completions",
+                                headers=litellm_headers,
+                                json=upstream_payload(litellm_payload, request_id),
+                            )
+                            started = time.perf_counter()
+                            upstream_response = await http_client.send(upstream_request, stream=True)
+                            UPSTREAM_SECONDS.labels(body.model, 'ttfb').observe(time.perf_counter() - started)
+                            if upstream_response.is_error:
+                                # Read the (small) error body before raising so the message is useful
+                                await upstream_response.aread()
+                                await upstream_response.aclose()
+                            upstream_response.raise_for_status() # Raise an exception for bad status codes
+                        except BaseException as e:
+                            if isinstance(e, httpx.HTTPError):
+                                UPSTREAM_ERRORS.labels(body.model, upstream_error_status(e)).inc()
+                            scheduler.release(ticket)
+                            raise
+                        return ReleasingStream(upstream_response, scheduler, ticket)
 
-                # For non-streaming: Return the JSON response from LiteLLM directly
-                return JSONResponse(content=litellm_response.json())
+                    async def open_litellm_stream(stream_deadline=deadline):
+                        # Retried until the stream starts; once chunks flow, errors end the stream
+                        request_id = uuid.uuid4().hex
+                        return await request.app.state.upstream_resilience.call(
+                            body.model, stream_deadline, lambda: open_litellm_stream_attempt(request_id))
+
+                    # Concurrent identical streams share one upstream stream. As in fetch_completion,
+                    # it gets the longest budget and each caller waits for it until its own deadline.
+                    stream_started = time.perf_counter()
+                    single_flight = request.app.state.single_flight
+                    if single_flight is not None and allows_coalescing(cache_header):
+                        try:
+                            litellm_response = await single_flight.stream(
+                                coalescing_key("stream", litellm_payload, call_priority(reservation)),
+                                lambda: open_litellm_stream(Deadline(settings.upstream_deadline_seconds)),
+                                timeout=deadline.remaining(),
+                            )
+                        except asyncio.TimeoutError:
+                            raise coalescing_deadline_exceeded(body.model) from None
+                    else:
+                        litellm_response = await open_litellm_stream()
+                    # Followers of a shared stream have no LiteLLM log row of their own
+                    own_call = getattr(litellm_response, 'leader', True)
 
-                # For streaming:
-                # from fastapi.responses import StreamingResponse
-                # return StreamingResponse(litellm_response.iter_lines(), media_type="text/event-stream")
+                    def streamed_cost(usage):
+                        return billable_cost(own_call, model_info.estimate_cost(usage.prompt_tokens or prompt_tokens, usage.output_tokens))
 
+                    async def on_stream_complete(usage):
+                        UPSTREAM_SECONDS.labels(body.model, 'total').observe(time.perf_counter() - stream_started)
+                        logger.debug("Stream completed.", extra={'user_id': user_id, 'output_tokens': usage.output_tokens})
+                        await settle_calls(quota_engine, [(reservation, streamed_cost(usage))])
 
-            except requests.exceptions.RequestException as e:
-                print(f"Error calling LiteLLM /v1/chat/completions: {e}")
+                    async def on_stream_incomplete(usage):
+                        if not reservation.is_free_call and usage.output_tokens:
+                            # A paid call is charged for the part that was streamed
+                            await settle_calls(quota_engine, [(reservation, streamed_cost(usage))])
+                            logger.info("Stream did not complete. Charged the streamed part.", extra={'user_id': user_id})
+                            return
+                        # The free call only counts once the whole stream was delivered
+                        await quota_engine.refund(reservation)
+                        logger.info("Stream did not complete. Refunded reserved call.", extra={'user_id': user_id})
+
+                    return StreamingResponse(
+                        proxy_sse_stream(
+                            litellm_response,
+                            StreamUsage(),
+                            on_complete=on_stream_complete,
+                            on_incomplete=on_stream_incomplete,
+                        ),
+                        media_type="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, # Disable proxy buffering
+                    )
+
+                # For non-streaming: Return the JSON response from LiteLLM directly
+                content, cache_status, own_call = await fetch_completion(
+                    request.app, litellm_url, litellm_headers, litellm_payload, prompt_tokens, cache_header,
+                    call_priority(reservation), deadline)
+                with STAGE_SECONDS.labels('response_serialization').time():
+                    headers = {RESPONSE_CACHE_HEADER: cache_status} if cache_status else {}
+                    # A paid call is settled to the usage in the response once the response was sent
+                    settlement = None if reservation.is_free_call else BackgroundTask(
+                        settle_calls, quota_engine,
+                        [(reservation, billable_cost(own_call, response_cost(model_info, content, prompt_tokens)))])
+                    return Response(content=content, media_type="application/json", headers=headers, background=settlement)
+
+            except ModelBusyError as e:
+                logger.warning("Model is busy: %s", e, extra={'user_id': user_id, 'model': body.model})
+                await quota_engine.refund(reservation)
+                raise model_busy_exception(e)
+            except DeadlineExceededError as e:
+                UPSTREAM_ERRORS.labels(body.model, 'deadline_exceeded').inc()
+                logger.warning("%s", e, extra={'user_id': user_id, 'model': body.model})
+                await quota_engine.refund(reservation)
+                raise deadline_exceeded_exception(e)
+            except httpx.HTTPStatusError as e:
+                logger.error("Error calling LiteLLM /v1/chat/completions: %s", e, extra={'user_id': user_id, 'model': body.model})
+                await quota_engine.refund(reservation)
+                if e.response.status_code == 429:
+                    raise upstream_rate_limited_exception(e)
+                raise HTTPException(status_code=500, detail=f"Error communicating with the language model: {e}")
+            except httpx.HTTPError as e:
+                logger.error("Error calling LiteLLM /v1/chat/completions: %s", e, extra={'user_id': user_id, 'model': body.model})
+                await quota_engine.refund(reservation)
                 raise HTTPException(status_code=500, detail=f"Error communicating with the language model: {e}")
             except Exception as e:
-                print(f"An unexpected error occurred during LiteLLM call processing: {e}")
+                logger.exception("An unexpected error occurred during LiteLLM call processing: %s", e)
+                await quota_engine.refund(reservation)
                 raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
         # If request_allowed was False, an HTTPException should have been raised already.
         # This part should ideally not be reached if the logic is correct.
-        print(f"User {user_id} - Request was not allowed, but no HTTPException was raised.")
+        logger.error("Request was not allowed, but no HTTPException was raised.", extra={'user_id': user_id})
         raise HTTPException(status_code=500, detail="Internal logic error.")
 
 
     except HTTPException as e:
         raise e # Re-raise FastAPI HTTPExceptions
     except Exception as e:
-        print(f"An unexpected error occurred in /chat/completion (outside LiteLLM call): {e}")
+        logger.exception("An unexpected error occurred in /chat/completion (outside LiteLLM call): %s", e)
         # Catch authentication errors from verify_id_token
         if "Firebase ID token has expired" in str(e) or "Firebase ID token is invalid" in str(e):
              raise HTTPException(status_code=401, detail="Invalid or expired authentication token.")
@@ -305,8 +878,220 @@ async def chat_completion(request: Request, body: ChatCompletionRequest):
              raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
 
+# --- Endpoints for Batch Chat Completions ---
+async def dispatch_batch(request: Request, body: BatchChatCompletionRequest):
+    """
+    Verifies the token once, reserves quota for all items in one operation and starts the items.
+    Returns an async generator of JSON result lines (bytes) in completion order.
+    """
+    decoded_token = await verify_bearer_token(request, request.headers.get('Authorization'))
+    user_id = decoded_token['uid']
+
+    if len(body.requests) > settings.batch_max_items:
+        raise HTTPException(status_code=413, detail=f"A batch can have at most {settings.batch_max_items} requests.")
+
+    litellm_url = settings.litellm_url
+    litellm_headers = request.app.state.litellm_headers
+    if litellm_headers is None:
+        logger.error("LITELLM_INTERNAL_API_KEY environment variable not set for batch chat completion.")
+        raise HTTPException(status_code=500, detail="Backend configuration error: LiteLLM key not set for chat.")
+    cache_header = request.headers.get(RESPONSE_CACHE_HEADER)
+
+    model_registry = request.app.state.model_registry.current
+    rejected = []
+    items = [] # (index, item, model_info, LiteLLM payload, prompt tokens, maximum cost)
+    for i, item in enumerate(body.requests):
+        model_info = model_registry.served(item.model)
+        if item.stream:
+            rejected.append(result_line(i, 400, error="Streaming is not supported in batch requests."))
+        elif model_info is None:
+            rejected.append(result_line(i, 400, error=unknown_model_message(model_registry, item.model)))
+        else:
+            litellm_payload = build_litellm_payload(item, user_id)
+            items.append((i, item, model_info, litellm_payload) + preflight_estimate(model_info, litellm_payload))
+
+    # One quota operation for the whole batch; paid items hold their maximum cost of the balance.
+    # Items beyond the user's quota get a 403 result.
+    quota_engine = request.app.state.quota_engine
+    reservations = []
+    if items:
+        try:
+            with STAGE_SECONDS.labels('quota_reserve').time():
+                reservations = await quota_engine.reserve_many(user_id, len(items), costs=[item[5] for item in items])
+        except QuotaExceededError as e:
+            QUOTA_DECISIONS.labels('exhausted').inc(len(items))
+            logger.info("User has insufficient balance for a batch.", extra={'user_id': user_id, 'items': len(items)})
+            raise HTTPException(status_code=403, detail=str(e))
+        except UserNotFoundError:
+            QUOTA_DECISIONS.labels('user_not_found').inc()
+            logger.error("User document not found for authenticated user.", extra={'user_id': user_id})
+            raise HTTPException(status_code=500, detail="User data not found.")
+    free_calls = sum(reservation.is_free_call for reservation in reservations)
+    QUOTA_DECISIONS.labels('free').inc(free_calls)
+    QUOTA_DECISIONS.labels('paid').inc(len(reservations) - free_calls)
+    QUOTA_DECISIONS.labels('exhausted').inc(len(items) - len(reservations))
+    rejected += [result_line(item[0], 403, error="Your balance does not cover this request. Please top up your account to continue.")
+                 for item in items[len(reservations):]]
+    logger.info("Batch received.", extra={'user_id': user_id, 'items': len(body.requests), 'reserved': len(reservations)})
+
+    limits = request.app.state.batch_limits
+    timeout_seconds = request_timeout_seconds(request)
+    delivered = set() # Indexes of items whose successful result reached the client
+    costs = {} # Index -> actual cost of a successful item (None if the response has no usage)
+
+    async def run_item(index, item, model_info, litellm_payload, prompt_tokens, reservation):
+        try:
+            async with limits.slot(user_id):
+                # Each item's deadline starts when it gets its slot, not when the batch arrived
+                content, _, own_call = await fetch_completion(
+                    request.app, litellm_url, litellm_headers, litellm_payload, prompt_tokens, cache_header,
+                    call_priority(reservation), Deadline(timeout_seconds))
+            if not reservation.is_free_call:
+                costs[index] = billable_cost(own_call, response_cost(model_info, content, prompt_tokens))
+            return index, True, result_line(index, 200, response=content)
+        except ModelBusyError as e:
+            return index, False, result_line(index, 503, error=str(e))
+        except DeadlineExceededError as e:
+            UPSTREAM_ERRORS.labels(item.model, 'deadline_exceeded').inc()
+            return index, False, result_line(index, 504, error=str(e))
+        except httpx.HTTPStatusError as e:
+            return index, False, result_line(index, e.response.status_code, error=f"Error from the language model: {e}")
+        except httpx.HTTPError as e:
+            return index, False, result_line(index, 502, error=f"Error communicating with the language model: {e}")
+        except Exception as e:
+            logger.exception("An unexpected error occurred in batch item %d: %s", index, e)
+            return index, False, result_line(index, 500, error="An internal server error occurred.")
+
+    async def results():
+        try:
+            for line in rejected:
+                yield line
+            async for index, succeeded, line in run_in_completion_order(
+                    run_item(i, item, model_info, litellm_payload, prompt_tokens, reservation)
+                    for (i, item, model_info, litellm_payload, prompt_tokens, _), reservation in zip(items, reservations)):
+                yield line
+                if succeeded:
+                    delivered.add(index)
+        finally:
+            # Settle the delivered paid items and refund every reserved item that failed or was
+            # not delivered (e.g. the client disconnected), as separate tasks so they also run
+            # when this one is cancelled
+            reserved = [(item[0], reservation) for item, reservation in zip(items, reservations)]
+            settlements = [(reservation, costs.get(index)) for index, reservation in reserved if index in delivered]
+            refunds = [reservation for index, reservation in reserved if index not in delivered]
+            if settlements:
+                run_detached(settle_calls(quota_engine, settlements))
+            if refunds:
+                run_detached(quota_engine.refund_many(refunds))
+
+    return results()
+
+
+@app.post("/chat/completions/batch")
+async def chat_completions_batch(request: Request, body: BatchChatCompletionRequest):
+    """
+    Runs many non-streaming chat completions in one request.
+    Returns {"results": [...]} in completion order; each result has the item's index and
+    either status 200 and the LiteLLM response, or an error status and message.
+    Requires Firebase Auth ID token in Authorization header.
+    """
+    results = await dispatch_batch(request, body)
+    try:
+        lines = [line async for line in results]
+    finally:
+        await results.aclose() # Cancels the remaining items if this request is cancelled
+    with STAGE_SECONDS.labels('response_serialization').time():
+        return Response(content=b'{"results":[' + b','.join(lines) + b']}', media_type="application/json")
+
+
+@app.post("/chat/completions/batch/stream")
+async def chat_completions_batch_stream(request: Request, body: BatchChatCompletionRequest):
+    """
+    Same as /chat/completions/batch, but streams one JSON result per line (JSONL)
+    as soon as each item finishes.
+    """
+    results = await dispatch_batch(request, body)
+
+    async def jsonl():
+        async for line in results:
+            yield line + b"\n"
+
+    return StreamingResponse(jsonl(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+
+# --- Endpoint to Serve Daily Usage Rollups for the Usage Dashboard ---
+@app.get("/usage/rollups")
+async def get_usage_rollups(
+    request: Request,
+    authorization: str = Header(...),
+    start: Optional[str] = Query(None, description="First day (YYYY-MM-DD), inclusive"),
+    end: Optional[str] = Query(None, description="Last day (YYYY-MM-DD), inclusive"),
+    page_size: int = Query(100, ge=1),
+    page_token: Optional[str] = Query(None),
+):
+    """
+    Returns the authenticated user's usage per day and model, newest day first.
+    Pass the returned next_page_token to get the next page (null on the last page).
+    Requires Firebase Auth ID token in Authorization header.
+    """
+    decoded_token = await verify_bearer_token(request, authorization)
+    user_id = decoded_token['uid']
+
+    for day in (start, end):
+        if day is not None:
+            try:
+                date.fromisoformat(day)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid date '{day}', expected YYYY-MM-DD.")
+
+    try:
+        rollups, next_page_token = await run_in_threadpool(
+            query_rollups, request.app.state.db, user_id, start, end, min(page_size, settings.usage_rollups_max_page_size), page_token,
+        )
+    except Exception as e:
+        logger.error("Error reading usage rollups: %s", e, extra={'user_id': user_id})
+        raise HTTPException(status_code=500, detail="Error reading usage data.")
+
+    return {"rollups": rollups, "next_page_token": next_page_token}
+
+
+# --- Endpoint for Prometheus Metrics ---
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of this worker, in the text exposition format."""
+    if not settings.metrics_enabled:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# --- Health Probes ---
+@app.get("/health/live")
+async def liveness():
+    """Liveness probe: the worker's event loop answers."""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness(request: Request):
+    """
+    Readiness probe: 200 once this worker's clients are warm, 503 while they warm up.
+    The body shows which clients are warm and how long each took.
+    """
+    warmup = request.app.state.warmup
+    clients = dict(warmup.warm)
+    clients['token_verifier'] = clients['token_verifier'] and getattr(request.app.state.token_verifier, 'ready', True)
+    ready = all(clients.values())
+    return JSONResponse(
+        {"status": "ready" if ready else "warming_up", "clients": clients, "warm_seconds": warmup.warm_seconds, "pid": os.getpid()},
+        status_code=200 if ready else 503,
+    )
+
+
 # --- Basic Run Configuration (for development) ---
 # To run this file directly: uvicorn api_backend:app --reload --host 0.0.0.0 --port 8000
+# Several workers: uvicorn api_backend:app --workers 4 (or WEB_CONCURRENCY=4), or
+# gunicorn -k uvicorn.workers.UvicornWorker --preload -w 4 api_backend:app. Every worker creates
+# its own clients on startup, so importing once in a pre-forking master is safe.
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,79 @@
+# llm-access-service/backend/api_metrics.py
+# Metrics of the API backend, served by GET /metrics (see metrics.py).
+#
+# Request stages: llm_backend_stage_seconds{stage=...}
+#   token_verify            Firebase ID token verification
+#   profile_read            Reading the user profile (cache or Firestore) for the quota decision
+#   quota_reserve           The whole quota reservation, profile read included
+#   response_serialization  Building the response body
+# Upstream calls: llm_backend_upstream_seconds{model, phase=ttfb|total}, one sample per attempt
+# (ttfb: until LiteLLM's response headers; total: until the body was read or the stream ended).
+import time
+
+import httpx
+
+from metrics import Counter, Histogram
+
+
+STAGE_SECONDS = Histogram(
+    'llm_backend_stage_seconds', 'Time spent in each stage of a request.', ['stage'])
+UPSTREAM_SECONDS = Histogram(
+    'llm_backend_upstream_seconds', 'LiteLLM call time per attempt, to the first byte and in total.', ['model', 'phase'])
+HTTP_REQUEST_SECONDS = Histogram(
+    'llm_backend_http_request_seconds', 'Time from request to the end of the response body.', ['method', 'route', 'status'])
+
+QUOTA_DECISIONS = Counter(
+    'llm_backend_quota_decisions_total', 'Quota decisions: free, paid, exhausted, insufficient_balance or user_not_found.', ['decision'])
+RESPONSE_CACHE_LOOKUPS = Counter(
+    'llm_backend_response_cache_lookups_total', 'Response cache lookups by result (hit, miss, bypass).', ['result'])
+UPSTREAM_ERRORS = Counter(
+    'llm_backend_upstream_errors_total',
+    'Failed LiteLLM attempts by model and HTTP status (or connect_error, timeout, deadline_exceeded).', ['model', 'status'])
+
+
+def upstream_error_status(error):
+    """The `status` label of a failed upstream attempt."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    if isinstance(error, httpx.TimeoutException):
+        return 'timeout'
+    if isinstance(error, httpx.ConnectError):
+        return 'connect_error'
+    return type(error).__name__
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request, labelled by route template rather than raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = [500]
+        recorded = []
+
+        def observe():
+            if recorded:
+                return
+            recorded.append(True)
+            route = scope.get('route')
+            endpoint = scope.get('endpoint')
+            route_name = getattr(route, 'path', None) or getattr(endpoint, '__name__', None) or 'unmatched'
+            HTTP_REQUEST_SECONDS.labels(scope['method'], route_name, status[0]).observe(time.perf_counter() - start)
+
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            observe() # Also count requests that failed or were cancelled before the body ended
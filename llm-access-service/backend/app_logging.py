@@ -0,0 +1,82 @@
+# llm-access-service/backend/app_logging.py
+# Structured logging that does not block the caller.
+#
+# Log calls only put the record on an in-memory queue. A background thread formats the
+# records (one JSON object per line by default) and writes them to stdout, so a slow
+# stdout (e.g. a container log pipe under load) never stalls the event loop.
+# Extra fields go in `extra`, e.g. logger.info("Call reserved", extra={"user_id": uid}).
+#
+# The writer thread does not survive a fork. A forked worker (e.g. gunicorn --preload) calls
+# configure_logging() again, which starts its own thread; api_backend does so on startup.
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='INFO', log_format='json'):
+    """
+    Routes all logging through a queue to a stdout writer thread. Safe to call more than once.
+    `log_format` is 'json' or 'text'; both values come from LOG_LEVEL and LOG_FORMAT (see settings.py).
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+    # httpx logs every request at INFO; the metrics already count them
+    logging.getLogger('httpx').setLevel(max(logging.WARNING, root.level))
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Writes out the queued records and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _forget_listener_after_fork():
+    global _listener
+    _listener = None # Its thread only runs in the parent
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_listener_after_fork)
@@ -0,0 +1,55 @@
+# llm-access-service/backend/app_warmup.py
+# Background warm-up of a worker's clients, and the state reported by the readiness probe.
+#
+# The app starts serving as soon as its clients are created; the first network round trips
+# (opening the Firestore channel, a keep-alive connection to LiteLLM) happen here, in the
+# background, instead of delaying startup. Requests that arrive earlier open their own
+# Firestore and LiteLLM connections, and the token verifier fetches the signing certificates
+# on demand (answering 503 while none could be loaded, see token_verifier.py).
+# A failed warm-up is retried with exponential backoff until it succeeds.
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUp:
+    """Runs named warm-up checks (no-argument coroutine functions) until each one succeeds once."""
+
+    def __init__(self, checks, retry_seconds=1.0, max_retry_seconds=30.0):
+        self.checks = checks
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.warm = {name: False for name in checks}
+        self.warm_seconds = {} # Time from start() until each check first succeeded
+        self._tasks = []
+
+    def start(self):
+        started = time.perf_counter()
+        self._tasks = [asyncio.create_task(self._warm(name, check, started)) for name, check in self.checks.items()]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _warm(self, name, check, started):
+        delay = self.retry_seconds
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                await check()
+            except Exception as e:
+                # Log the first failure; later ones only at debug level, the readiness probe shows the state
+                log = logger.warning if attempts == 1 else logger.debug
+                log("Warm-up of %s failed (attempt %d), retrying in %.0fs: %s", name, attempts, delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_seconds)
+                continue
+            self.warm[name] = True
+            self.warm_seconds[name] = round(time.perf_counter() - started, 3)
+            logger.info("%s is warm.", name, extra={'warm_seconds': self.warm_seconds[name], 'attempts': attempts})
+            return
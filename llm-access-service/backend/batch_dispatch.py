@@ -0,0 +1,63 @@
+# llm-access-service/backend/batch_dispatch.py
+# Concurrent dispatch of the items of a batch chat completion request.
+#
+# Items run as separate tasks, each holding a slot of its user's semaphore and of the
+# global semaphore while it calls LiteLLM, so one large batch can neither flood the
+# upstream nor starve other users' batches. Results are yielded in completion order.
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+
+class ConcurrencyLimits:
+    """A global semaphore shared by all batches, plus one semaphore per user."""
+
+    def __init__(self, global_limit=64, per_user_limit=8):
+        self.global_limit = global_limit
+        self.per_user_limit = per_user_limit
+        self._global = asyncio.Semaphore(global_limit)
+        self._users = {} # user_id -> [semaphore, number of tasks using it]
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        entry = self._users.get(user_id)
+        if entry is None:
+            entry = self._users[user_id] = [asyncio.Semaphore(self.per_user_limit), 0]
+        entry[1] += 1
+        try:
+            # Per-user first, so a user's queued items don't hold global slots while waiting
+            async with entry[0]:
+                async with self._global:
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self._users.get(user_id) is entry:
+                del self._users[user_id] # Don't keep a semaphore per user forever
+
+
+def result_line(index, status, response=None, error=None):
+    """One JSON result (bytes, no newline). A successful `response` is already-encoded JSON and is embedded as is."""
+    if response is not None:
+        return b'{"index":%d,"status":%d,"response":' % (index, status) + response + b'}'
+    return json.dumps({"index": index, "status": status, "error": error}).encode()
+
+
+async def run_in_completion_order(jobs):
+    """
+    Starts every job (a coroutine that handles its own errors) as a task and yields
+    the results as they finish. Closing the generator (e.g. the client disconnected)
+    cancels the jobs that are still running.
+    """
+    results = asyncio.Queue()
+    tasks = []
+    for job in jobs:
+        task = asyncio.ensure_future(job)
+        task.add_done_callback(results.put_nowait)
+        tasks.append(task)
+    try:
+        for _ in range(len(tasks)):
+            task = await results.get()
+            yield task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,90 @@
+# llm-access-service/backend/benchmarks/bench_batch.py
+# Compares N sequential /chat/completion calls with one /chat/completions/batch request
+# (and its JSONL streaming variant) of N items, against the stub LiteLLM server.
+# Token verification and quota use the in-memory stand-ins from fake_services.py.
+#
+# Run from the backend directory:
+#   python -m benchmarks.bench_batch --items 200 --delay 0.2
+# The stub listens on --port and the backend on --port + 1.
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from benchmarks.fake_services import install_api_stand_ins, use_offline_firebase
+from benchmarks.stub_litellm import run_app_server, run_stub_server
+
+
+def prompts(count):
+    return [{"model": "gpt-4o", "messages": [{"role": "user", "content": f"prompt {i}"}]} for i in range(count)]
+
+
+async def run_sequential(client, items):
+    for item in items:
+        response = await client.post("/chat/completion", json=item, headers={"Authorization": "Bearer bench-user"})
+        response.raise_for_status()
+    return len(items), None
+
+
+async def run_batch(client, items):
+    response = await client.post("/chat/completions/batch", json={"requests": items}, headers={"Authorization": "Bearer bench-user"})
+    response.raise_for_status()
+    results = response.json()["results"]
+    return sum(result["status"] == 200 for result in results), None
+
+
+async def run_batch_stream(client, items):
+    start = time.perf_counter()
+    first_result = None
+    succeeded = 0
+    async with client.stream("POST", "/chat/completions/batch/stream", json={"requests": items},
+                             headers={"Authorization": "Bearer bench-user"}) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            first_result = first_result or time.perf_counter() - start
+            succeeded += json.loads(line)["status"] == 200
+    return succeeded, first_result
+
+
+async def run_all(args, backend_url):
+    async with httpx.AsyncClient(base_url=backend_url, timeout=None) as client:
+        items = prompts(args.items)
+        for name, runner in (("sequential /chat/completion", run_sequential),
+                             ("/chat/completions/batch", run_batch),
+                             ("/chat/completions/batch/stream", run_batch_stream)):
+            start = time.perf_counter()
+            succeeded, first_result = await runner(client, items)
+            elapsed = time.perf_counter() - start
+            first = f", first result after {first_result:.2f}s" if first_result is not None else ""
+            print(f"{name:<32} {succeeded}/{args.items} ok in {elapsed:.2f}s -> {args.items / elapsed:.1f} completions/s{first}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch endpoint vs sequential calls benchmark.")
+    parser.add_argument("--items", type=int, default=200, help="Completions per run.")
+    parser.add_argument("--delay", type=float, default=0.2, help="Fixed stub response delay in seconds.")
+    parser.add_argument("--port", type=int, default=4100, help="Port for the stub LiteLLM server.")
+    args = parser.parse_args()
+
+    key_path = use_offline_firebase()
+    try:
+        with run_stub_server(port=args.port, delay_seconds=args.delay) as litellm_url:
+            os.environ["LITELLM_INTERNAL_API_URL"] = litellm_url
+            os.environ.setdefault("LITELLM_INTERNAL_API_KEY", "bench-key")
+            import api_backend
+
+            # The backend runs in its own server (and event loop), like in production
+            with run_app_server(api_backend.app, args.port + 1) as backend_url:
+                install_api_stand_ins(api_backend.app, users={"bench-user": {"balance": 1_000_000}})
+                asyncio.run(run_all(args, backend_url))
+    finally:
+        os.unlink(key_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# llm-access-service/backend/benchmarks/bench_billing_workers.py
+# Runs the partitioned billing workers of process_usage_data.py against a throwaway local
+# Postgres, for 1, 2, 4, ... worker processes, and checks that every usage row is billed
+# exactly once. Firestore is replaced by a stand-in for add_billing_records_to_firestore
+# that records the billed IDs and waits a fixed commit latency per batch.
+#
+# Needs a local Postgres you can throw away. The script creates (and drops) its own schema:
+#   docker run --rm -d -p 5432:5432 -e POSTGRES_PASSWORD=postgres postgres:16
+#   POSTGRES_HOST=localhost POSTGRES_PASSWORD=postgres POSTGRES_DB=postgres \
+#     python -m benchmarks.bench_billing_workers --rows 200000 --workers 1 2 4 8
+# tests/test_billing_workers.py runs the same exactly-once check on a small table.
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from benchmarks.fake_services import use_offline_firebase
+
+BENCH_SCHEMA = "bench_billing"
+FIRESTORE_COMMIT_SECONDS = 0.02 # Simulated latency of one Firestore transaction
+
+
+# --- Worker Process Side ---
+billed_ids = []
+
+
+def fake_add_billing_records_to_firestore(billing_records):
+    time.sleep(FIRESTORE_COMMIT_SECONDS)
+    billed_ids.extend(record['id'] for record in billing_records)
+    return len(billing_records)
+
+
+def init_worker(commit_seconds):
+    global FIRESTORE_COMMIT_SECONDS
+    FIRESTORE_COMMIT_SECONDS = commit_seconds
+    import process_usage_data
+    process_usage_data.add_billing_records_to_firestore = fake_add_billing_records_to_firestore
+
+
+def bench_worker(worker_index, partition_count, chunk_size):
+    import process_usage_data
+    billed_ids.clear()
+    process_usage_data.run_billing_worker(worker_index, partition_count, "flag", chunk_size)
+    return list(billed_ids)
+
+
+# --- Benchmark Driver ---
+def setup_schema(conn, rows, users):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE; CREATE SCHEMA {BENCH_SCHEMA};")
+        cur.execute(f"""
+            CREATE TABLE {BENCH_SCHEMA}.litellm_logs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                model TEXT,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                timestamp TIMESTAMPTZ NOT NULL,
+                metadata JSONB,
+                processed BOOLEAN NOT NULL DEFAULT false
+            );
+            INSERT INTO {BENCH_SCHEMA}.litellm_logs (id, user_id, model, prompt_tokens, completion_tokens, timestamp)
+            SELECT 'row-' || i, 'user-' || (i %% %s), (ARRAY['gpt-4o', 'deepseek-r1'])[1 + i %% 2],
+                   10 + i %% 4000, 1 + i %% 2000, now() - make_interval(secs => %s - i)
+            FROM generate_series(1, %s) AS i;
+        """, (users, rows, rows))
+    conn.commit()
+
+
+def reset_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"UPDATE {BENCH_SCHEMA}.litellm_logs SET processed = false;")
+    conn.commit()
+
+
+def count_unprocessed(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {BENCH_SCHEMA}.litellm_logs WHERE processed = false;")
+        count = cur.fetchone()[0]
+    conn.commit()
+    return count
+
+
+def run(workers, partition_count, chunk_size, commit_seconds):
+    """Bills all unprocessed rows with `workers` processes. Returns (elapsed seconds, billed IDs)."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(commit_seconds,)) as pool:
+        list(pool.map(time.sleep, [0.5] * workers)) # Start and initialize the processes before timing
+        start = time.perf_counter()
+        futures = [pool.submit(bench_worker, i, partition_count, chunk_size) for i in range(workers)]
+        ids = [record_id for future in futures for record_id in future.result()]
+        return time.perf_counter() - start, ids
+
+
+def run_billing_passes(conn, rows, worker_counts, partitions=0, chunk_size=5000, commit_seconds=FIRESTORE_COMMIT_SECONDS):
+    """
+    Bills the benchmark table once per entry of worker_counts, from all rows unprocessed each time.
+    Yields (workers, elapsed seconds, billed IDs, rows left unprocessed, exactly once) per pass.
+    """
+    for workers in worker_counts:
+        reset_rows(conn)
+        elapsed, ids = run(workers, partitions or workers, chunk_size, commit_seconds)
+        unprocessed = count_unprocessed(conn)
+        exactly_once = len(ids) == len(set(ids)) == rows and unprocessed == 0
+        yield workers, elapsed, ids, unprocessed, exactly_once
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partitioned billing worker benchmark (needs a throwaway Postgres).")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--partitions", type=int, default=0, help="0 = one partition per worker.")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--commit-latency", type=float, default=FIRESTORE_COMMIT_SECONDS,
+                        help="Simulated seconds per Firestore transaction.")
+    args = parser.parse_args()
+
+    # Workers inherit these: their connections use the benchmark schema, and Firebase initializes offline
+    os.environ["PGOPTIONS"] = f"-c search_path={BENCH_SCHEMA}"
+    key_path = use_offline_firebase()
+
+    from process_usage_data import connect_to_postgres
+    conn = connect_to_postgres()
+    try:
+        setup_schema(conn, args.rows, args.users)
+        baseline = None
+        passes = run_billing_passes(conn, args.rows, args.workers, args.partitions, args.chunk_size, args.commit_latency)
+        for workers, elapsed, ids, unprocessed, exactly_once in passes:
+            baseline = baseline or elapsed
+            print(f"{workers} workers: {args.rows} rows in {elapsed:.2f}s -> {args.rows / elapsed:,.0f} rows/s, "
+                  f"speedup {baseline / elapsed:.2f}x, billed {len(ids)} ({len(set(ids))} distinct), "
+                  f"unprocessed {unprocessed}, exactly once: {'yes' if exactly_once else 'NO'}")
+    finally:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+        conn.commit()
+        conn.close()
+        os.unlink(key_path)
+
+
+if __name__ == "__main__":
+    main()
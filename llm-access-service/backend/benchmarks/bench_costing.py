@@ -0,0 +1,106 @@
+# llm-access-service/backend/benchmarks/bench_costing.py
+# Compares the old per-record costing loop of process_litellm_logs with the vectorized
+# price_chunk() on a synthetic usage dataset (1M rows by default).
+# The old loop is timed both without and with its per-record print (sent to /dev/null).
+#
+# Run from the backend directory:
+#   python -m benchmarks.bench_costing --rows 1000000 --chunk-size 5000
+import argparse
+import contextlib
+import gc
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from model_registry import load_pricing
+from usage_costing import PriceTable, price_chunk
+
+
+# The old loop read these from module constants, now they come from model_pricing.yaml
+pricing_per_million, PROFIT_MARGIN = load_pricing()
+
+
+def make_rows(count, users=10_000, seed=42):
+    rng = random.Random(seed)
+    models = list(pricing_per_million) + ["unknown-model"]
+    start = datetime(2025, 1, 1)
+    return [
+        (
+            i,
+            f"user-{rng.randrange(users)}",
+            rng.choice(models),
+            rng.randrange(10, 4000),
+            rng.randrange(1, 2000) if i % 100 else None, # Some NULL token counts
+            start + timedelta(seconds=i),
+        )
+        for i in range(count)
+    ]
+
+
+def legacy_loop(rows, with_print=False):
+    """The per-record costing loop from process_litellm_logs before vectorization."""
+    totals = {}
+    costs = []
+    for record in rows:
+        record_id, user_id, model = record[0], record[1], record[2]
+        input_tokens = record[3] if record[3] is not None else 0
+        output_tokens = record[4] if record[4] is not None else 0
+        if not user_id:
+            continue
+        input_cost = (input_tokens / 1_000_000) * pricing_per_million.get(model, {}).get("input", 0)
+        output_cost = (output_tokens / 1_000_000) * pricing_per_million.get(model, {}).get("output", 0)
+        raw_cost = input_cost + output_cost
+        total_cost_with_margin = raw_cost * (1 + PROFIT_MARGIN)
+        if with_print:
+            print(f"Record {record_id} for user {user_id} ({model}): Input: {input_tokens}, Output: {output_tokens}, Raw Cost: ${raw_cost:.6f}, Total Cost (with margin): ${total_cost_with_margin:.6f}")
+        costs.append(total_cost_with_margin)
+        totals[(user_id, model)] = totals.get((user_id, model), 0) + total_cost_with_margin
+    return costs, totals
+
+
+def vectorized(rows, chunk_size, price_table):
+    costs = []
+    aggregate_count = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk, _ = price_chunk(rows[start:start + chunk_size], price_table)
+        costs.extend(chunk.costs.tolist())
+        aggregate_count += len(chunk.aggregates()['user_id'])
+    return costs, aggregate_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Billing cost computation benchmark.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    price_table = PriceTable(pricing_per_million, PROFIT_MARGIN)
+
+    gc.collect()
+    start = time.process_time()
+    legacy_costs, _ = legacy_loop(rows)
+    legacy_seconds = time.process_time() - start
+
+    gc.collect()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.process_time()
+        legacy_loop(rows, with_print=True)
+        legacy_print_seconds = time.process_time() - start
+
+    gc.collect()
+    start = time.process_time()
+    vector_costs, aggregate_count = vectorized(rows, args.chunk_size, price_table)
+    vector_seconds = time.process_time() - start
+
+    max_diff = max(abs(a - b) for a, b in zip(legacy_costs, vector_costs))
+    print(f"rows: {args.rows}, chunk size: {args.chunk_size}, max cost difference: {max_diff:.3e}")
+    print(f"per-record loop:   {legacy_seconds:.2f}s CPU ({args.rows / legacy_seconds:,.0f} rows/s)")
+    print(f"  with its print:  {legacy_print_seconds:.2f}s CPU ({args.rows / legacy_print_seconds:,.0f} rows/s)")
+    print(f"vectorized chunks: {vector_seconds:.2f}s CPU ({args.rows / vector_seconds:,.0f} rows/s, "
+          f"incl. {aggregate_count} per-chunk user/model aggregates)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# llm-access-service/backend/benchmarks/bench_resilience.py
+# Sends /chat/completion calls through the backend to a fault-injecting stub LiteLLM
+# (a share of errors and of slow responses) and compares success rate and tail latency
+# without the resilience layer, with retries, and with retries plus hedging. A last run
+# has the stub fail every call, to show the circuit breaker failing fast.
+#
+# Run from the backend directory:
+#   python -m benchmarks.bench_resilience --requests 300 --error-rate 0.1 --slow-rate 0.02
+# The stub listens on --port and the backend on --port + 1.
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+from benchmarks.fake_services import install_api_stand_ins, use_offline_firebase
+from benchmarks.stub_litellm import run_app_server, run_stub_server
+
+
+PAYLOAD = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hello"}]}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_requests(backend_url, total_requests, concurrency):
+    """Returns (latencies of all requests, status code counts)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, statuses = [], {}
+
+    async with httpx.AsyncClient(base_url=backend_url, timeout=None) as client:
+        async def one_call():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/chat/completion", json=PAYLOAD, headers={"Authorization": "Bearer bench-user"})
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        await asyncio.gather(*(one_call() for _ in range(total_requests)))
+    return latencies, statuses
+
+
+def report(name, latencies, statuses, total_requests):
+    ok = statuses.get(200, 0)
+    print(f"{name:<28} ok {ok / total_requests:6.1%}  p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.1f} ms  statuses {dict(sorted(statuses.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upstream resilience layer benchmark.")
+    parser.add_argument("--requests", type=int, default=300, help="Calls per run.")
+    parser.add_argument("--concurrency", type=int, default=20, help="Calls in flight.")
+    parser.add_argument("--delay", type=float, default=0.05, help="Normal stub response delay in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.1, help="Share of stub calls answered with a 503.")
+    parser.add_argument("--slow-rate", type=float, default=0.02, help="Share of stub calls that are slow.")
+    parser.add_argument("--slow-delay", type=float, default=2.0, help="Delay of slow stub calls in seconds.")
+    parser.add_argument("--port", type=int, default=4300, help="Port for the stub LiteLLM server.")
+    args = parser.parse_args()
+
+    key_path = use_offline_firebase()
+    faults = {"error_rate": args.error_rate, "slow_rate": args.slow_rate, "slow_delay_seconds": args.slow_delay, "seed": 1}
+    try:
+        with run_stub_server(port=args.port, delay_seconds=args.delay, **faults) as litellm_url:
+            os.environ["LITELLM_INTERNAL_API_URL"] = litellm_url
+            os.environ.setdefault("LITELLM_INTERNAL_API_KEY", "bench-key")
+            import api_backend
+            from upstream_resilience import UpstreamResilience
+
+            with run_app_server(api_backend.app, args.port + 1) as backend_url:
+                install_api_stand_ins(api_backend.app, users={"bench-user": {"balance": 1_000_000}})
+                runs = (
+                    ("no retries", UpstreamResilience(max_attempts=1, failure_threshold=10 ** 9)),
+                    ("retries", UpstreamResilience(max_attempts=3, failure_threshold=10 ** 9)),
+                    ("retries + hedging", UpstreamResilience(max_attempts=3, failure_threshold=10 ** 9, hedging=True)),
+                )
+                for name, resilience in runs:
+                    api_backend.app.state.upstream_resilience = resilience
+                    latencies, statuses = asyncio.run(run_requests(backend_url, args.requests, args.concurrency))
+                    report(name, latencies, statuses, args.requests)
+                    print(f"{'':<28} {resilience.stats()}")
+
+        # Provider outage: every call fails. The breaker opens and the rest fail fast with 503s.
+        with run_stub_server(port=args.port, delay_seconds=args.delay, error_rate=1.0) as litellm_url:
+            with run_app_server(api_backend.app, args.port + 1) as backend_url:
+                install_api_stand_ins(api_backend.app, users={"bench-user": {"balance": 1_000_000}})
+                api_backend.app.state.upstream_resilience = UpstreamResilience(max_attempts=3)
+                latencies, statuses = asyncio.run(run_requests(backend_url, args.requests, args.concurrency))
+                report("outage, circuit breaker", latencies, statuses, args.requests)
+                print(f"{'':<28} {api_backend.app.state.upstream_resilience.stats()}")
+    finally:
+        os.unlink(key_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# llm-access-service/backend/benchmarks/bench_token_count.py
+# Measures the per-request cost of the pre-flight token count in chat_completion
+# (count_prompt_tokens plus the maximum-cost estimate), compared with the old
+# ~4-characters-per-token estimate of model_scheduler.py.
+#
+# Two workloads:
+#   unique:       every request has texts never seen before (no memoization hits)
+#   conversation: a fixed system prompt and a growing history are resent with one new
+#                 user message per request, like a chat client does (mostly hits)
+# The tiktoken encodings from model_pricing.yaml are used if tiktoken is installed and the
+# encodings can be loaded; otherwise the length estimate is measured (see the first line).
+#
+# Run from the backend directory:
+#   python -m benchmarks.bench_token_count --requests 20000 --model gpt-4o
+import argparse
+import gc
+import random
+import string
+import time
+
+import token_counter
+from model_registry import load_model_registry
+
+
+SYSTEM_PROMPT = "You are a helpful assistant. Answer concisely and cite sources when you can. " * 8
+
+
+def random_text(rng, words):
+    return " ".join("".join(rng.choices(string.ascii_lowercase, k=rng.randrange(2, 10))) for _ in range(words))
+
+
+def unique_requests(count, words, seed=1):
+    rng = random.Random(seed)
+    return [
+        [{"role": "system", "content": f"{SYSTEM_PROMPT} Session {i}."}, {"role": "user", "content": random_text(rng, words)}]
+        for i in range(count)
+    ]
+
+
+def conversation_requests(count, words, turns, seed=2):
+    """Conversations of up to `turns` exchanges; each request resends the history plus a new message."""
+    rng = random.Random(seed)
+    requests = []
+    history = []
+    for _ in range(count):
+        if len(history) >= 2 * turns:
+            history = []
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history + [{"role": "user", "content": random_text(rng, words)}]
+        requests.append(messages)
+        history = messages[1:] + [{"role": "assistant", "content": random_text(rng, words * 2)}]
+    return requests
+
+
+def legacy_prompt_estimate(messages):
+    """The ~4-characters-per-token estimate model_scheduler.py used before prompts were counted."""
+    prompt_chars = 0
+    for message in messages:
+        content = message.get('content') if isinstance(message, dict) else None
+        if isinstance(content, str):
+            prompt_chars += len(content)
+        elif isinstance(content, list):
+            prompt_chars += sum(len(part.get('text') or '') for part in content if isinstance(part, dict))
+    return prompt_chars // 4
+
+
+def time_per_request(requests, count_tokens):
+    gc.collect()
+    start = time.perf_counter()
+    for messages in requests:
+        count_tokens(messages)
+    return (time.perf_counter() - start) / len(requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-flight token counting overhead benchmark.")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--words", type=int, default=60, help="Words per user message.")
+    parser.add_argument("--turns", type=int, default=8, help="Exchanges per conversation.")
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    model_info = load_model_registry().get(args.model)
+    token_counter.load_encodings([model_info.tokenizer] if model_info.tokenizer else [])
+    loaded = model_info.tokenizer in token_counter.text_cache_stats()['encodings']
+    print(f"model: {args.model}, tokenizer: {model_info.tokenizer if loaded else 'length estimate (encoding not loaded)'}")
+
+    def preflight(messages):
+        prompt_tokens = token_counter.count_prompt_tokens(messages, model_info.tokenizer)
+        return model_info.estimate_cost(prompt_tokens, model_info.max_output_tokens)
+
+    for name, requests in (
+        ("unique", unique_requests(args.requests, args.words)),
+        ("conversation", conversation_requests(args.requests, args.words, args.turns)),
+    ):
+        old_seconds = time_per_request(requests, legacy_prompt_estimate)
+        token_counter._count_memoized.cache_clear()
+        new_seconds = time_per_request(requests, preflight)
+        stats = token_counter.text_cache_stats()
+        avg_tokens = sum(token_counter.count_prompt_tokens(m, model_info.tokenizer) for m in requests[:1000]) / min(len(requests), 1000)
+        print(f"{name:<13} ~{avg_tokens:,.0f} prompt tokens/request: "
+              f"pre-flight {new_seconds * 1e6:7.1f} us/request (memo hit ratio {stats['hit_ratio']:.2f}), "
+              f"old chars/4 estimate {old_seconds * 1e6:5.1f} us/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# llm-access-service/backend/benchmarks/bench_upstream_concurrency.py
+# Measures how many concurrent LiteLLM calls one backend worker (one event loop) can handle.
+# Compares the old pattern (blocking `requests.post` inside an async handler) with the
+# shared async client from upstream_client.py, against a local stub LiteLLM server.
+#
+# Run from the backend directory:
+#   python -m benchmarks.bench_upstream_concurrency --requests 50 --concurrency 50 --delay 0.5
+import argparse
+import asyncio
+import time
+
+import requests
+
+from benchmarks.stub_litellm import run_stub_server
+from upstream_client import create_litellm_client
+
+
+PAYLOAD = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hello"}], "user": "bench-user"}
+
+
+async def run_blocking(base_url, total_requests, concurrency):
+    """Old behaviour: each handler calls requests.post, which blocks the event loop."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_call():
+        async with semaphore:
+            response = requests.post(f"{base_url}/v1/chat/completions", json=PAYLOAD)
+            response.raise_for_status()
+
+    await asyncio.gather(*(one_call() for _ in range(total_requests)))
+
+
+async def run_async_client(base_url, total_requests, concurrency):
+    """New behaviour: all handlers share one pooled async client."""
+    semaphore = asyncio.Semaphore(concurrency)
+    client = create_litellm_client()
+
+    async def one_call():
+        async with semaphore:
+            response = await client.post(f"{base_url}/v1/chat/completions", json=PAYLOAD)
+            response.raise_for_status()
+
+    try:
+        await asyncio.gather(*(one_call() for _ in range(total_requests)))
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-worker upstream concurrency benchmark.")
+    parser.add_argument("--requests", type=int, default=50, help="Total number of upstream calls.")
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent in-flight handler calls.")
+    parser.add_argument("--delay", type=float, default=0.5, help="Fixed stub response delay in seconds.")
+    parser.add_argument("--port", type=int, default=4100, help="Port for the stub LiteLLM server.")
+    args = parser.parse_args()
+
+    with run_stub_server(port=args.port, delay_seconds=args.delay) as base_url:
+        for name, runner in (("blocking requests.post", run_blocking), ("shared async client", run_async_client)):
+            start = time.perf_counter()
+            asyncio.run(runner(base_url, args.requests, args.concurrency))
+            elapsed = time.perf_counter() - start
+            print(f"{name:<24} {args.requests} calls in {elapsed:.2f}s -> {args.requests / elapsed:.1f} req/s per worker")
+
+
+if __name__ == "__main__":
+    main()
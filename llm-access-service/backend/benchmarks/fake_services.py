@@ -0,0 +1,144 @@
+# llm-access-service/backend/benchmarks/fake_services.py
+# Offline stand-ins for Firebase, used by the benchmarks.
+#
+# api_backend.py initializes Firebase when the app starts, process_usage_data.py when it is
+# imported. use_offline_firebase() points them at a generated (syntactically valid) service
+# account, which is enough to create the clients without network access. install_api_stand_ins()
+# then swaps the token verifier and quota engine of a started app for in-memory versions.
+# InMemoryBillingStore stands in for the Firestore writes of the billing job.
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+
+from quota import InMemoryQuotaEngine
+
+
+def write_fake_service_account(path):
+    """A syntactically valid service account key, so Firebase can initialize offline."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    with open(path, "w") as f:
+        json.dump({
+            "type": "service_account",
+            "project_id": "bench-project",
+            "private_key_id": "bench",
+            "private_key": pem.decode(),
+            "client_email": "bench@bench-project.iam.gserviceaccount.com",
+            "client_id": "0",
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }, f)
+
+
+def use_offline_firebase():
+    """Writes a fake service account and points FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH at it. Returns the path."""
+    key_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    key_file.close()
+    write_fake_service_account(key_file.name)
+    os.environ["FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH"] = key_file.name
+    return key_file.name
+
+
+class FakeTokenVerifier:
+    """Accepts any bearer token and uses it as the user ID."""
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def verify(self, id_token):
+        return {'uid': id_token}
+
+
+class ContendedQuotaEngine:
+    """
+    Wraps a quota engine with Firestore-like latency: every reservation takes `write_seconds`,
+    and reservations of the same user run one at a time, like transactions on one document.
+    Makes hot-user skew visible in the benchmarks.
+    """
+
+    def __init__(self, engine, write_seconds=0.02):
+        self.engine = engine
+        self.write_seconds = write_seconds
+        self._user_locks = {}
+
+    def _user_lock(self, user_id):
+        return self._user_locks.setdefault(user_id, asyncio.Lock())
+
+    async def start(self):
+        await self.engine.start()
+
+    async def stop(self):
+        await self.engine.stop()
+
+    async def reserve(self, user_id, today=None, cost=0.0):
+        async with self._user_lock(user_id):
+            await asyncio.sleep(self.write_seconds)
+            return await self.engine.reserve(user_id, today, cost)
+
+    async def reserve_many(self, user_id, count, today=None, costs=None):
+        async with self._user_lock(user_id):
+            await asyncio.sleep(self.write_seconds)
+            return await self.engine.reserve_many(user_id, count, today, costs)
+
+    async def refund(self, reservation):
+        await self.engine.refund(reservation)
+
+    async def refund_many(self, reservations):
+        await self.engine.refund_many(reservations)
+
+    async def settle(self, reservation, cost):
+        await self.engine.settle(reservation, cost)
+
+    async def settle_many(self, settlements):
+        await self.engine.settle_many(settlements)
+
+    def invalidate(self, user_id):
+        self.engine.invalidate(user_id)
+
+
+def install_api_stand_ins(app, users, free_call_limit=5, quota_write_seconds=0.0):
+    """
+    Replaces the token verifier and quota engine of a started api_backend app.
+    With quota_write_seconds, reservations are slowed down and serialized per user (ContendedQuotaEngine).
+    """
+    app.state.token_verifier = FakeTokenVerifier()
+    engine = InMemoryQuotaEngine(free_call_limit, users=users)
+    app.state.quota_engine = ContendedQuotaEngine(engine, quota_write_seconds) if quota_write_seconds else engine
+
+
+class InMemoryBillingStore:
+    """
+    Stand-in for process_usage_data.add_billing_records_to_firestore: keeps the billed IDs and
+    per-user cost totals in memory and waits `commit_seconds` per batch, like one Firestore transaction.
+    Skips IDs it has already billed, like the real function.
+    """
+
+    def __init__(self, commit_seconds=0.02):
+        self.commit_seconds = commit_seconds
+        self.billed_ids = set()
+        self.cost_by_user = {}
+        self._lock = threading.Lock()
+
+    def add_billing_records(self, billing_records):
+        time.sleep(self.commit_seconds)
+        written = 0
+        with self._lock:
+            for record in billing_records:
+                if record['id'] in self.billed_ids:
+                    continue
+                self.billed_ids.add(record['id'])
+                self.cost_by_user[record['user_id']] = self.cost_by_user.get(record['user_id'], 0.0) + record['cost']
+                written += 1
+        return written
+
+    def install(self, process_usage_data_module):
+        """Routes the billing job's Firestore writes to this store."""
+        process_usage_data_module.add_billing_records_to_firestore = self.add_billing_records
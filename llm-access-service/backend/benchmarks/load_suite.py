@@ -0,0 +1,356 @@
+# llm-access-service/backend/benchmarks/load_suite.py
+# Reproducible load scenarios for the API backend and the billing job, run entirely against
+# local stand-ins: the stub LiteLLM (latency, streaming and error rates are configurable),
+# in-memory token verification and quota (Firestore-like per-user latency) and, for the
+# billing job, a throwaway Postgres and an in-memory Firestore billing store.
+#
+# Scenarios:
+#   api-sweep     /chat/completion at increasing concurrency, requests spread over many users
+#   api-hot-user  fixed concurrency, a growing share of the requests from one user
+#   api-stream    streaming /chat/completion at increasing concurrency (also time to first chunk)
+#   billing       process_usage_data's flag-mode pass over backlogs of increasing size,
+#                 each in a fresh process; checks that every row is billed exactly once
+# Every result has throughput, p50/p99 latency (per request, or per Firestore write for billing)
+# and memory: the backend's RSS after the run and its peak so far, or the peak RSS of the
+# billing pass. The stub, the backend and the billing pass each get their own process, so
+# the load generator does not compete with them for the GIL.
+#
+# Run from the backend directory:
+#   python -m benchmarks.load_suite --scenarios api-sweep api-hot-user api-stream \
+#     --output benchmarks/results/api.json --baseline benchmarks/results/api.json
+#   python -m benchmarks.load_suite --scenarios billing --postgres docker --backlog 100000 1000000 10000000
+# The results are saved as JSON. With --baseline, results that are slower than the baseline by
+# more than --tolerance are listed and the exit status is 1, so regressions show up in review.
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from benchmarks.fake_services import InMemoryBillingStore, install_api_stand_ins, use_offline_firebase
+from benchmarks.stub_litellm import run_app_server, run_stub_server
+
+
+API_SCENARIOS = ("api-sweep", "api-hot-user", "api-stream")
+PROMPT = [{"role": "user", "content": "hello"}]
+HOT_USER = "user-hot"
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def process_memory_mb(pid):
+    """(Current, peak) resident memory of a process in MB, from /proc (Linux only; (None, None) elsewhere)."""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    name, kib, _ = line.split()
+                    memory[name] = round(int(kib) / 1024, 1)
+    except OSError:
+        pass
+    return memory.get("VmRSS:"), memory.get("VmHWM:")
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10 # Bytes on macOS, KiB on Linux
+
+
+def latency_result(latencies, statuses, elapsed, backend_pid, **extra):
+    ok = statuses.get(200, 0)
+    result = {
+        "requests": len(latencies),
+        "ok_share": round(ok / len(latencies), 4),
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=lambda item: str(item[0]))},
+        "throughput_per_second": round(ok / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+    result["rss_mb"], result["peak_rss_mb"] = process_memory_mb(backend_pid)
+    result.update(extra)
+    return result
+
+
+# --- API Scenarios ---
+async def run_api_load(backend_url, total_requests, concurrency, pick_user, stream=False):
+    """Returns (latencies, status counts, times to first chunk, elapsed seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_chunks, statuses = [], [], {}
+    payload = {"model": "gpt-4o", "messages": PROMPT, "stream": stream}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=backend_url, timeout=None, limits=limits) as client:
+        async def one_call():
+            async with semaphore:
+                headers = {"Authorization": f"Bearer {pick_user()}"}
+                start = time.perf_counter()
+                try:
+                    if stream:
+                        async with client.stream("POST", "/chat/completion", json=payload, headers=headers) as response:
+                            first_chunk = None
+                            async for _ in response.aiter_lines(): # Read to the end, for the total time
+                                if first_chunk is None:
+                                    first_chunk = time.perf_counter() - start
+                            if first_chunk is not None:
+                                first_chunks.append(first_chunk)
+                    else:
+                        response = await client.post("/chat/completion", json=payload, headers=headers)
+                    status = response.status_code
+                except httpx.TransportError as e: # Dropped connections count as failed calls
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_call() for _ in range(total_requests)))
+        return latencies, statuses, first_chunks, time.perf_counter() - start
+
+
+def serve_stub(port, stub_options, ready, stop):
+    """Stub LiteLLM process."""
+    with run_stub_server(port=port, **stub_options):
+        ready.set()
+        stop.wait()
+
+
+def serve_backend(port, users, quota_write_seconds, ready, stop):
+    """Backend process: api_backend with in-memory token verification and quota."""
+    import api_backend
+
+    with run_app_server(api_backend.app, port):
+        accounts = {user: {"balance": 10 ** 9} for user in users}
+        install_api_stand_ins(api_backend.app, users=accounts, quota_write_seconds=quota_write_seconds)
+        ready.set()
+        stop.wait()
+
+
+def start_process(context, target, *args):
+    ready, stop = context.Event(), context.Event()
+    process = context.Process(target=target, args=(*args, ready, stop), daemon=True)
+    process.start()
+    if not ready.wait(timeout=60):
+        process.terminate()
+        raise RuntimeError(f"{target.__name__} did not start")
+    return process, stop
+
+
+def run_api_scenarios(args, scenarios):
+    results = {}
+    users = [f"user-{i}" for i in range(args.users)]
+    rng = random.Random(args.seed)
+    stub_options = {
+        "delay_seconds": args.delay, "token_interval_seconds": args.token_interval, "stream_tokens": args.stream_tokens,
+        "error_rate": args.error_rate, "slow_rate": args.slow_rate, "slow_delay_seconds": args.slow_delay, "seed": args.seed,
+    }
+
+    # Spawned processes inherit the environment: the backend calls the stub and initializes Firebase offline
+    os.environ["LITELLM_INTERNAL_API_URL"] = f"http://127.0.0.1:{args.port}"
+    os.environ.setdefault("LITELLM_INTERNAL_API_KEY", "bench-key")
+    context = multiprocessing.get_context("spawn")
+    stub, stop_stub = start_process(context, serve_stub, args.port, stub_options)
+    backend, stop_backend = start_process(context, serve_backend, args.port + 1, users + [HOT_USER], args.quota_latency)
+    backend_url = f"http://127.0.0.1:{args.port + 1}"
+
+    def run(name, concurrency, hot_share=0.0, stream=False):
+        def pick_user():
+            return HOT_USER if rng.random() < hot_share else rng.choice(users)
+
+        latencies, statuses, first_chunks, elapsed = asyncio.run(
+            run_api_load(backend_url, args.requests, concurrency, pick_user, stream))
+        extra = {"concurrency": concurrency, "hot_user_share": hot_share}
+        if stream and first_chunks:
+            extra["first_chunk_p50_ms"] = round(statistics.median(first_chunks) * 1000, 1)
+            extra["first_chunk_p99_ms"] = round(percentile(first_chunks, 0.99) * 1000, 1)
+        results[name] = latency_result(latencies, statuses, elapsed, backend.pid, **extra)
+        print_result(name, results[name])
+
+    try:
+        asyncio.run(run_api_load(backend_url, 50, 10, lambda: rng.choice(users))) # Warm up connections and caches
+        if "api-sweep" in scenarios:
+            for concurrency in args.concurrency:
+                run(f"api-sweep/c{concurrency}", concurrency)
+        if "api-hot-user" in scenarios:
+            for hot_share in args.hot_user_share:
+                run(f"api-hot-user/hot{hot_share:g}", args.hot_user_concurrency, hot_share=hot_share)
+        if "api-stream" in scenarios:
+            for concurrency in args.concurrency:
+                run(f"api-stream/c{concurrency}", concurrency, stream=True)
+    finally:
+        for process, stop in ((backend, stop_backend), (stub, stop_stub)):
+            stop.set()
+            process.join(timeout=10)
+    return results
+
+
+# --- Billing Scenario (worker process side) ---
+def bill_backlog(chunk_size, commit_seconds):
+    """Runs one flag-mode pass in this (fresh) process. Returns (pass summary, billed IDs count, peak RSS)."""
+    import process_usage_data
+    from billing_run_stats import BillingRunStats
+
+    store = InMemoryBillingStore(commit_seconds)
+    store.install(process_usage_data)
+    read_conn = process_usage_data.connect_to_postgres()
+    write_conn = process_usage_data.connect_to_postgres()
+    try:
+        stats = BillingRunStats("flag")
+        process_usage_data.bill_unprocessed_records(read_conn, write_conn, chunk_size=chunk_size, stats=stats)
+    finally:
+        read_conn.close()
+        write_conn.close()
+    return stats.summary(), len(store.billed_ids), peak_rss_mb()
+
+
+def run_billing_scenario(args):
+    from benchmarks.throwaway_postgres import fill_usage_table, throwaway_postgres
+
+    results = {}
+    context = multiprocessing.get_context("spawn") # A fresh process per backlog, so its peak RSS is its own
+    with throwaway_postgres(args.postgres) as conn:
+        for rows in args.backlog:
+            fill_usage_table(conn, rows, args.users, args.billing_hot_user_share)
+            with context.Pool(1) as pool:
+                summary, billed, peak = pool.apply(bill_backlog, (args.chunk_size, args.commit_latency))
+            with conn.cursor() as cur:
+                cur.execute("SELECT count(*) FROM litellm_logs WHERE processed = false;")
+                unprocessed = cur.fetchone()[0]
+            conn.commit()
+
+            name = f"billing/{rows}"
+            results[name] = {
+                "rows": rows,
+                "throughput_per_second": summary["rows_per_second"],
+                "elapsed_seconds": summary["elapsed_seconds"],
+                "p50_ms": round(summary["firestore_write_p50_seconds"] * 1000, 1),
+                "p99_ms": round(summary["firestore_write_p99_seconds"] * 1000, 1),
+                "peak_rss_mb": round(peak, 1),
+                "exactly_once": billed == rows and unprocessed == 0,
+            }
+            print_result(name, results[name])
+    return results
+
+
+# --- Reporting ---
+def print_result(name, result):
+    memory = result.get("rss_mb") or result.get("peak_rss_mb") or 0.0
+    line = (f"{name:<26} {result['throughput_per_second']:>10,.1f}/s  p50 {result['p50_ms']:8.1f} ms  "
+            f"p99 {result['p99_ms']:8.1f} ms  mem {memory:7.1f} MB")
+    if "ok_share" in result:
+        line += f"  ok {result['ok_share']:.1%}"
+    if "first_chunk_p99_ms" in result:
+        line += f"  first chunk p99 {result['first_chunk_p99_ms']:.1f} ms"
+    if "exactly_once" in result:
+        line += f"  exactly once: {'yes' if result['exactly_once'] else 'NO'}"
+    print(line)
+
+
+def find_regressions(results, baseline, tolerance):
+    """Results more than `tolerance` (a fraction) worse than the baseline in throughput or p99 latency."""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["throughput_per_second"] < before["throughput_per_second"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput_per_second']} -> {result['throughput_per_second']}/s")
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {before['p99_ms']} -> {result['p99_ms']} ms")
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and benchmark suite for the API backend and billing job.")
+    parser.add_argument("--scenarios", nargs="+", default=list(API_SCENARIOS), choices=API_SCENARIOS + ("billing",))
+    parser.add_argument("--requests", type=int, default=1000, help="Calls per API run.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128], help="Sweep of calls in flight.")
+    parser.add_argument("--users", type=int, default=1000, help="Distinct users of the API scenarios and usage rows.")
+    parser.add_argument("--hot-user-share", type=float, nargs="+", default=[0.0, 0.5, 0.9],
+                        help="api-hot-user: share of calls from one user.")
+    parser.add_argument("--hot-user-concurrency", type=int, default=32)
+    parser.add_argument("--quota-latency", type=float, default=0.01,
+                        help="Seconds per quota reservation; one user's reservations are serialized, as in Firestore.")
+    parser.add_argument("--delay", type=float, default=0.05, help="Stub LiteLLM response delay in seconds.")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Stub seconds between streamed chunks.")
+    parser.add_argument("--stream-tokens", type=int, default=10, help="Stub chunks per streamed response.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of stub calls answered with a 503.")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Share of stub calls that are slow.")
+    parser.add_argument("--slow-delay", type=float, default=2.0, help="Delay of slow stub calls in seconds.")
+    parser.add_argument("--backlog", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="billing: usage rows per run (up to 10M).")
+    parser.add_argument("--billing-hot-user-share", type=float, default=0.0, help="billing: share of rows of one user.")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--commit-latency", type=float, default=0.005, help="billing: simulated seconds per Firestore transaction.")
+    parser.add_argument("--postgres", choices=("env", "docker"), default="env",
+                        help="billing: use the POSTGRES_* server, or start a throwaway container.")
+    parser.add_argument("--port", type=int, default=4400, help="Port for the stub LiteLLM server; the backend uses the next one.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare with the results in this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%).")
+    args = parser.parse_args()
+
+    key_path = use_offline_firebase()
+    results = {}
+    try:
+        api_scenarios = [scenario for scenario in args.scenarios if scenario in API_SCENARIOS]
+        if api_scenarios:
+            results.update(run_api_scenarios(args, api_scenarios))
+        if "billing" in args.scenarios:
+            results.update(run_billing_scenario(args))
+    finally:
+        os.unlink(key_path)
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({
+                "meta": {
+                    "revision": git_revision(),
+                    "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "arguments": vars(args),
+                },
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Results written to {args.output}")
+
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
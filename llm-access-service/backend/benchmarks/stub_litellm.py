@@ -0,0 +1,130 @@
+# llm-access-service/backend/benchmarks/stub_litellm.py
+# A minimal stand-in for the LiteLLM proxy, used by the benchmarks.
+# It answers /v1/chat/completions and /key/generate after a fixed delay,
+# so backend-side throughput can be measured without calling a real provider.
+# Requests with "stream": true get an SSE response: the first chunk after the delay,
+# then one chunk per token every `token_interval_seconds` (`stream_tokens` chunks in all).
+#
+# Faults can be injected to exercise the backend's resilience layer: a share of requests
+# (`error_rate`) fail with `error_status`, and a share (`slow_rate`) take `slow_delay_seconds`
+# instead of `delay_seconds`.
+import asyncio
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+STREAM_TOKENS = ["stub", " streamed", " response"]
+# The servers keep idle connections open longer than any client of the suite keeps them
+# (httpx: 5 s, the backend's LiteLLM pool: LITELLM_HTTP_KEEPALIVE_EXPIRY, 30 s). With uvicorn's
+# default of 5 s, a client could send a call on a connection the server was just closing,
+# and the call failed with a ReadError.
+SERVER_KEEP_ALIVE_SECONDS = 75
+
+
+def create_stub_app(delay_seconds=1.0, token_interval_seconds=0.05, error_rate=0.0, error_status=503,
+                    slow_rate=0.0, slow_delay_seconds=5.0, seed=None, stream_tokens=len(STREAM_TOKENS)):
+    """Creates the stub LiteLLM FastAPI app. Every response waits `delay_seconds` unless a fault is injected."""
+    app = FastAPI()
+    app.state.calls = 0
+    rng = random.Random(seed)
+
+    def response_delay():
+        return slow_delay_seconds if rng.random() < slow_rate else delay_seconds
+
+    def injected_error():
+        if rng.random() < error_rate:
+            return JSONResponse({"error": {"message": "Injected fault"}}, status_code=error_status)
+        return None
+
+    async def stream_chunks(model, delay):
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        await asyncio.sleep(delay)
+        for i in range(stream_tokens):
+            token = STREAM_TOKENS[i % len(STREAM_TOKENS)]
+            if i:
+                await asyncio.sleep(token_interval_seconds)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        usage_chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "model": model,
+            "choices": [],
+            "usage": {"prompt_tokens": 10, "completion_tokens": stream_tokens, "total_tokens": 10 + stream_tokens},
+        }
+        yield f"data: {json.dumps(usage_chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.calls += 1
+        body = await request.json()
+        error = injected_error()
+        if error is not None:
+            return error
+        if body.get("stream"):
+            return StreamingResponse(stream_chunks(body.get("model"), response_delay()), media_type="text/event-stream")
+        await asyncio.sleep(response_delay())
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "stub response"},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+        }
+
+    @app.post("/key/generate")
+    async def key_generate(request: Request):
+        await asyncio.sleep(delay_seconds)
+        return {"key": f"sk-stub-{uuid.uuid4().hex}"}
+
+    return app
+
+
+@contextmanager
+def run_app_server(app, port):
+    """
+    Runs an ASGI app with uvicorn in a background thread for the duration of the `with` block.
+    Yields the base URL of the server.
+    """
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                            timeout_keep_alive=SERVER_KEEP_ALIVE_SECONDS)
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    # Wait for the server to start accepting connections
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+
+
+@contextmanager
+def run_stub_server(port=4100, delay_seconds=1.0, token_interval_seconds=0.05, **faults):
+    """
+    Runs the stub LiteLLM server in a background thread for the duration of the `with` block.
+    Yields the base URL of the server. `faults` are passed to create_stub_app().
+    """
+    with run_app_server(create_stub_app(delay_seconds, token_interval_seconds, **faults), port) as base_url:
+        yield base_url
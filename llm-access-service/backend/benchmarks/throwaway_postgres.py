@@ -0,0 +1,119 @@
+# llm-access-service/backend/benchmarks/throwaway_postgres.py
+# A Postgres the billing benchmarks can fill and drop, and the usage table they bill from.
+#
+# throwaway_postgres("docker") starts a postgres:16 container on a free port and removes it
+# afterwards. throwaway_postgres("env") uses the server from the POSTGRES_* variables instead
+# and works in its own schema, which it drops afterwards. Either way, POSTGRES_* and PGOPTIONS
+# are set for the duration, so connect_to_postgres() (also in spawned processes) lands there.
+import os
+import socket
+import subprocess
+import time
+from contextlib import contextmanager
+
+import psycopg2
+
+
+BENCH_SCHEMA = "bench_load"
+POSTGRES_IMAGE = "postgres:16"
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _connect():
+    return psycopg2.connect(
+        database=os.environ["POSTGRES_DB"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+    )
+
+
+def _wait_until_ready(timeout_seconds=60):
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        try:
+            _connect().close()
+            return
+        except psycopg2.OperationalError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+@contextmanager
+def throwaway_postgres(source="env"):
+    """Yields an open connection to an empty benchmark schema (see the module comment for `source`)."""
+    container = None
+    if source == "docker":
+        port = _free_port()
+        container = subprocess.run(
+            ["docker", "run", "--rm", "-d", "-p", f"127.0.0.1:{port}:5432", "-e", "POSTGRES_PASSWORD=bench", POSTGRES_IMAGE],
+            check=True, capture_output=True, text=True,
+        ).stdout.strip()
+        os.environ.update(POSTGRES_HOST="127.0.0.1", POSTGRES_PORT=str(port), POSTGRES_USER="postgres",
+                          POSTGRES_PASSWORD="bench", POSTGRES_DB="postgres")
+    else:
+        for name, default in (("POSTGRES_HOST", "localhost"), ("POSTGRES_PORT", "5432"), ("POSTGRES_USER", "postgres"),
+                              ("POSTGRES_PASSWORD", "postgres"), ("POSTGRES_DB", "postgres")):
+            os.environ.setdefault(name, default)
+    os.environ["PGOPTIONS"] = f"-c search_path={BENCH_SCHEMA}"
+
+    conn = None
+    try:
+        _wait_until_ready()
+        conn = _connect()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE; CREATE SCHEMA {BENCH_SCHEMA};")
+        conn.commit()
+        yield conn
+    finally:
+        if conn is not None:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+            conn.commit()
+            conn.close()
+        if container:
+            subprocess.run(["docker", "rm", "-f", container], capture_output=True)
+
+
+def fill_usage_table(conn, rows, users, hot_user_share=0.0):
+    """
+    (Re)creates litellm_logs with `rows` unprocessed usage rows, as LiteLLM and the migrations
+    would leave it. A `hot_user_share` of the rows belongs to one user ('user-hot').
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            DROP TABLE IF EXISTS litellm_logs;
+            CREATE TABLE litellm_logs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                model TEXT,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                timestamp TIMESTAMPTZ NOT NULL,
+                metadata JSONB,
+                processed BOOLEAN NOT NULL DEFAULT false
+            );
+        """)
+        cur.execute("""
+            INSERT INTO litellm_logs (id, user_id, model, prompt_tokens, completion_tokens, timestamp)
+            SELECT 'row-' || i,
+                   CASE WHEN random() < %s THEN 'user-hot' ELSE 'user-' || (i %% %s) END,
+                   (ARRAY['gpt-4o', 'deepseek-r1'])[1 + i %% 2],
+                   10 + i %% 4000, 1 + i %% 2000, now() - make_interval(secs => %s - i)
+            FROM generate_series(1, %s) AS i;
+        """, (hot_user_share, users, rows, rows))
+        # Same indexes as migrations/001 and 002
+        cur.execute("""
+            CREATE INDEX litellm_logs_timestamp_id_idx ON litellm_logs (timestamp, id);
+            CREATE INDEX litellm_logs_unprocessed_idx ON litellm_logs (timestamp) WHERE processed = false;
+            ANALYZE litellm_logs;
+        """)
+    conn.commit()
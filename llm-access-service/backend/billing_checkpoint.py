@@ -0,0 +1,45 @@
+# llm-access-service/backend/billing_checkpoint.py
+# Durable high-watermark checkpoint for the incremental billing mode.
+# The checkpoint is the (timestamp, id) of the last billed usage row, stored in the
+# billing_checkpoints table (see migrations/001_billing_checkpoint.sql).
+
+
+def load_checkpoint(conn, name):
+    """Returns (last_timestamp, last_id) for the pipeline, or None if it has never run."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT last_timestamp, last_id FROM billing_checkpoints WHERE name = %s;", (name,))
+        row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def save_checkpoint(conn, name, last_timestamp, last_id):
+    """Moves the pipeline's checkpoint forward to (last_timestamp, last_id) and commits."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+                INSERT INTO billing_checkpoints (name, last_timestamp, last_id, updated_at)
+                VALUES (%s, %s, %s, now())
+                ON CONFLICT (name) DO UPDATE
+                SET last_timestamp = EXCLUDED.last_timestamp,
+                    last_id = EXCLUDED.last_id,
+                    updated_at = now();
+            """,
+            (name, last_timestamp, str(last_id))
+        )
+    conn.commit()
+
+
+# Key of the API's request id in the metadata of a LiteLLM call. Every attempt of one call
+# (retries and hedged copies) sends the same id, so their usage rows are billed once.
+BILLING_REQUEST_ID_KEY = "billing_request_id"
+
+
+def billing_document_id(record_id, request_id=None):
+    """
+    Deterministic Firestore document ID for a usage row, so re-billing a row overwrites instead of duplicating.
+    Rows with the API's request id share one document per request, so duplicate attempts are billed once.
+    """
+    if request_id:
+        return f"litellm-request-{request_id}"
+    return f"litellm-{record_id}"
@@ -0,0 +1,152 @@
+# llm-access-service/backend/billing_daemon.py
+# Long-running loop for the billing job (process_usage_data.py --daemon).
+#
+# The daemon keeps its Postgres connections and Firestore client open, claims one usage
+# partition by its advisory lock, and bills micro-batches whenever LiteLLM inserts usage rows.
+# New rows are announced with NOTIFY on the 'litellm_usage' channel by the trigger in
+# migrations/003_usage_notify.sql. If the trigger is missing or a notification is lost, the
+# daemon still polls every `poll_interval` seconds.
+#
+# Backpressure: a pass bills at most `batch_rows` rows. While the backlog is larger, passes
+# run back to back and notifications are coalesced instead of queued. Bursts of inserts are
+# debounced to one pass per `min_interval`, and failures back off exponentially.
+# SIGTERM/SIGINT finish the current pass, release the partition and close the connections.
+import logging
+import select
+import signal
+import time
+
+import psycopg2
+
+from billing_partitions import partition_order, try_lock_partition, unlock_partition
+
+
+logger = logging.getLogger(__name__)
+
+
+USAGE_NOTIFY_CHANNEL = 'litellm_usage'
+
+
+class BillingDaemon:
+    """
+    Runs `run_pass(read_conn, write_conn, partition, max_rows)` whenever new usage may be there.
+    run_pass returns (rows read, records that failed). `lock_name(partition)` names the partition's advisory lock.
+    """
+
+    def __init__(self, connect, run_pass, lock_name, worker_index=0, partition_count=1,
+                 batch_rows=5000, poll_interval=30.0, min_interval=1.0, max_backoff=60.0):
+        self.connect = connect
+        self.run_pass = run_pass
+        self.lock_name = lock_name
+        self.worker_index = worker_index
+        self.partition_count = partition_count
+        self.batch_rows = batch_rows
+        self.poll_interval = poll_interval
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.stopping = False
+        self.read_conn = None
+        self.write_conn = None
+        self.partition = None
+
+    def stop(self, *_):
+        if not self.stopping:
+            logger.info("Billing daemon stopping after the current pass...")
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        backoff = 0
+        while not self.stopping:
+            try:
+                self._open()
+                backoff = 0
+                if self.partition is None:
+                    # Every partition has a daemon: stand by and take over if one of them exits
+                    self._wait(self.poll_interval)
+                    continue
+                self._serve()
+            except psycopg2.Error as e:
+                backoff = min(max(backoff * 2, 1), self.max_backoff)
+                logger.error("Billing daemon database error: %s. Reconnecting in %.0fs.", e, backoff)
+                self._close()
+                self._sleep(backoff)
+        self._close()
+        logger.info("Billing daemon stopped.")
+
+    def _open(self):
+        if self.write_conn is None or self.write_conn.closed:
+            self._close()
+            self.read_conn = self.connect()
+            self.write_conn = self.connect()
+            # The write connection also receives the notifications: it commits after every
+            # statement, so it is never idle inside a transaction (which would hold them back)
+            with self.write_conn.cursor() as cur:
+                cur.execute(f"LISTEN {USAGE_NOTIFY_CHANNEL};")
+            self.write_conn.commit()
+            logger.info("Billing daemon connected to PostgreSQL database.")
+        if self.partition is None:
+            for partition in partition_order(self.worker_index, self.partition_count):
+                if try_lock_partition(self.write_conn, self.lock_name(partition), partition):
+                    self.partition = partition
+                    logger.info("Billing daemon claimed partition %d/%d.", partition, self.partition_count)
+                    break
+
+    def _close(self):
+        if self.write_conn is not None and not self.write_conn.closed and self.partition is not None:
+            try:
+                unlock_partition(self.write_conn, self.lock_name(self.partition), self.partition)
+            except psycopg2.Error:
+                pass # Closing the connection releases the lock as well
+        self.partition = None
+        for conn in (self.read_conn, self.write_conn):
+            if conn is not None and not conn.closed:
+                conn.close()
+        self.read_conn = self.write_conn = None
+
+    def _serve(self):
+        backoff = 0
+        while not self.stopping:
+            started = time.monotonic()
+            try:
+                rows_read, failed = self.run_pass(self.read_conn, self.write_conn, self.partition, self.batch_rows)
+            except psycopg2.Error:
+                raise
+            except Exception as e:
+                logger.exception("Billing daemon pass failed: %s", e)
+                self.read_conn.rollback()
+                self.write_conn.rollback()
+                rows_read, failed = 0, 1
+
+            if failed:
+                # Firestore is failing or throttling: retry later instead of hammering it
+                backoff = min(max(backoff * 2, 1), self.max_backoff)
+                self._sleep(backoff)
+                continue
+            backoff = 0
+            if rows_read >= self.batch_rows:
+                continue # Still behind: drain the backlog without waiting for notifications
+
+            self._wait(self.poll_interval)
+            # Debounce: rows inserted in quick succession are billed in one micro-batch
+            self._sleep(started + self.min_interval - time.monotonic())
+
+    def _wait(self, timeout):
+        """Waits until a notification arrives, `timeout` passes or the daemon is stopped."""
+        deadline = time.monotonic() + timeout
+        while not self.stopping:
+            self.write_conn.poll()
+            if self.write_conn.notifies:
+                self.write_conn.notifies.clear() # Any number of notifications means one pass
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            # Short slices, so a stop signal is noticed within a second
+            select.select([self.write_conn], [], [], min(remaining, 1.0))
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(deadline - time.monotonic(), 1.0))
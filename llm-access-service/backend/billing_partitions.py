@@ -0,0 +1,52 @@
+# llm-access-service/backend/billing_partitions.py
+# Hash partitioning of the usage backlog for parallel billing workers.
+#
+# Usage rows are split into `partition_count` partitions by a hash of user_id, so all rows
+# of one user land in the same partition. A worker bills a partition only while it holds
+# the partition's Postgres advisory lock. The lock lives in the database, so workers on
+# one host and on different hosts coordinate the same way: a partition that is locked by
+# another worker is skipped, and no two workers bill the same rows at the same time.
+#
+# All workers (on every host) must use the same partition count.
+
+
+def partition_filter(partition, partition_count):
+    """
+    Returns (SQL predicate, params) selecting the rows of one partition.
+    Rows without a user_id hash like an empty string, so exactly one partition owns them.
+    """
+    if partition_count <= 1:
+        return "true", ()
+    # hashtext() is Postgres' built-in string hash (int4); mask off the sign bit before the modulo
+    return "(hashtext(coalesce(user_id, '')) & 2147483647) %% %s = %s", (partition_count, partition)
+
+
+def try_lock_partition(conn, lock_name, partition):
+    """
+    Tries to take the session-level advisory lock of a partition without waiting.
+    Returns True if this connection now holds it. The lock survives commits and is
+    released by unlock_partition() or when the connection closes (e.g. the worker dies).
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s);", (lock_name, partition))
+        locked = cur.fetchone()[0]
+    conn.commit()
+    return locked
+
+
+def unlock_partition(conn, lock_name, partition):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s), %s);", (lock_name, partition))
+    conn.commit()
+
+
+def partition_order(worker_index, partition_count):
+    """Partitions in the order a worker tries them, starting at its own index so workers don't all contend for partition 0."""
+    return [(worker_index + offset) % partition_count for offset in range(partition_count)]
+
+
+def partition_checkpoint_name(checkpoint_name, partition, partition_count):
+    """Each partition keeps its own incremental checkpoint, since it moves through the backlog independently."""
+    if partition_count <= 1:
+        return checkpoint_name
+    return f"{checkpoint_name}:{partition}/{partition_count}"
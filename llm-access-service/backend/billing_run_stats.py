@@ -0,0 +1,91 @@
+# llm-access-service/backend/billing_run_stats.py
+# Instrumentation of a billing pass: rows read, chunk sizes, Firestore write latency and
+# throughput. The summary is logged at the end of every pass and can also be written as a
+# Prometheus textfile (for node_exporter's textfile collector), since the job is not a server.
+import os
+import time
+
+from metrics import Gauge, Histogram, Registry
+
+
+FIRESTORE_WRITE_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class BillingRunStats:
+    def __init__(self, mode, partition=0):
+        self.mode = mode
+        self.partition = partition
+        self.started = time.perf_counter()
+        self.rows_read = 0
+        self.billed = 0
+        self.failed = 0
+        self.chunk_sizes = []
+        self.write_seconds = [] # One sample per Firestore transaction
+
+    def record_chunk(self, rows):
+        self.rows_read += rows
+        self.chunk_sizes.append(rows)
+
+    def record_write(self, seconds, records, succeeded=True):
+        self.write_seconds.append(seconds)
+        if succeeded:
+            self.billed += records
+        else:
+            self.failed += records
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'mode': self.mode,
+            'partition': self.partition,
+            'elapsed_seconds': round(elapsed, 3),
+            'rows_read': self.rows_read,
+            'rows_per_second': round(self.rows_read / elapsed, 1) if elapsed > 0 else 0.0,
+            'billed': self.billed,
+            'failed': self.failed,
+            'chunks': len(self.chunk_sizes),
+            'chunk_rows_max': max(self.chunk_sizes, default=0),
+            'chunk_rows_avg': round(self.rows_read / len(self.chunk_sizes), 1) if self.chunk_sizes else 0.0,
+            'firestore_writes': len(self.write_seconds),
+            'firestore_write_p50_seconds': round(_percentile(self.write_seconds, 0.5), 4),
+            'firestore_write_p99_seconds': round(_percentile(self.write_seconds, 0.99), 4),
+            'firestore_write_max_seconds': round(max(self.write_seconds, default=0.0), 4),
+        }
+
+    def write_textfile(self, directory):
+        """Writes the pass's metrics to <directory>/billing_<mode>_<partition>.prom, atomically."""
+        registry = Registry()
+        labels = ('mode', 'partition')
+        values = (self.mode, self.partition)
+        summary = self.summary()
+
+        for name, help_text, value in (
+            ('billing_last_pass_rows_read', 'Usage rows read in the last pass.', self.rows_read),
+            ('billing_last_pass_records_billed', 'Records billed in the last pass.', self.billed),
+            ('billing_last_pass_records_failed', 'Records whose Firestore write failed in the last pass.', self.failed),
+            ('billing_last_pass_duration_seconds', 'Duration of the last pass.', summary['elapsed_seconds']),
+            ('billing_last_pass_rows_per_second', 'Rows read per second in the last pass.', summary['rows_per_second']),
+            ('billing_last_pass_timestamp_seconds', 'When the last pass ended.', time.time()),
+        ):
+            Gauge(name, help_text, labels, registry=registry).labels(*values).set(value)
+        chunk_rows = Histogram('billing_last_pass_chunk_rows', 'Rows per fetched chunk in the last pass.', labels,
+                               buckets=(100, 500, 1000, 2500, 5000, 10000, 25000), registry=registry)
+        for size in self.chunk_sizes:
+            chunk_rows.labels(*values).observe(size)
+        write_seconds = Histogram('billing_last_pass_firestore_write_seconds', 'Firestore transaction latency in the last pass.', labels,
+                                  buckets=FIRESTORE_WRITE_BUCKETS, registry=registry)
+        for seconds in self.write_seconds:
+            write_seconds.labels(*values).observe(seconds)
+
+        path = os.path.join(directory, f"billing_{self.mode}_{self.partition}.prom")
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(registry.render())
+        os.replace(temp_path, path) # The collector never sees a half-written file
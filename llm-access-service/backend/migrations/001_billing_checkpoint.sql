@@ -0,0 +1,19 @@
+-- llm-access-service/backend/migrations/001_billing_checkpoint.sql
+-- Supports the incremental (high-watermark) mode of process_usage_data.py.
+--
+-- Run once against the LiteLLM database, outside a transaction
+-- (CREATE INDEX CONCURRENTLY does not lock the table against LiteLLM's inserts):
+--   psql "$DATABASE_URL" -f migrations/001_billing_checkpoint.sql
+
+-- Keyset index for: WHERE (timestamp, id) > (checkpoint) ORDER BY timestamp, id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS litellm_logs_timestamp_id_idx
+    ON litellm_logs (timestamp, id);
+
+-- Durable checkpoint of the last billed usage row, one row per billing pipeline.
+-- Kept in its own table so the billing job never writes to LiteLLM's tables.
+CREATE TABLE IF NOT EXISTS billing_checkpoints (
+    name            TEXT PRIMARY KEY,
+    last_timestamp  TIMESTAMPTZ NOT NULL,
+    last_id         TEXT NOT NULL,
+    updated_at      TIMESTAMPTZ NOT NULL DEFAULT now()
+);
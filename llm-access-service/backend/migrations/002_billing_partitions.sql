@@ -0,0 +1,11 @@
+-- llm-access-service/backend/migrations/002_billing_partitions.sql
+-- Supports parallel billing workers in flag mode (process_usage_data.py --workers N).
+--
+-- Every worker scans the unprocessed rows and keeps those of its partitions, so the scan
+-- should only touch unprocessed rows, not the whole (ever growing) log table.
+-- Run once against the LiteLLM database, outside a transaction:
+--   psql "$DATABASE_URL" -f migrations/002_billing_partitions.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS litellm_logs_unprocessed_idx
+    ON litellm_logs (timestamp)
+    WHERE processed = false;
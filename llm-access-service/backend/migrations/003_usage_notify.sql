@@ -0,0 +1,19 @@
+-- llm-access-service/backend/migrations/003_usage_notify.sql
+-- Wakes the billing daemon (process_usage_data.py --daemon) when LiteLLM logs new usage.
+--
+-- One notification per INSERT statement, not per row, and Postgres folds identical
+-- notifications within a transaction, so bulk inserts don't flood the channel.
+--   psql "$DATABASE_URL" -f migrations/003_usage_notify.sql
+
+CREATE OR REPLACE FUNCTION notify_litellm_usage() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('litellm_usage', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS litellm_logs_notify_usage ON litellm_logs;
+CREATE TRIGGER litellm_logs_notify_usage
+    AFTER INSERT ON litellm_logs
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_litellm_usage();
@@ -0,0 +1,231 @@
+# llm-access-service/backend/model_registry.py
+# The catalog of models we serve and what they cost, shared by the API and the billing job.
+#
+# Built from two files: the LiteLLM config (which models are routed, model_list) and
+# model_pricing.yaml (what each model costs us, and our margin). Both are parsed and checked
+# once, into an immutable registry: a dict keyed by interned model names with plain-Python
+# per-token prices for the API, and the per-token price arrays of usage_costing.PriceTable
+# for the billing job. The arrays are built on first use, so the API never imports numpy.
+# A served model without a price is an error when the registry is built, not a model billed at 0.
+#
+# ModelRegistryLoader re-reads the files when they change. A new registry replaces the old
+# one in a single assignment, so requests in flight keep the registry they started with,
+# and a broken file is logged and leaves the previous registry in place.
+import asyncio
+import logging
+import os
+import sys
+from types import MappingProxyType
+
+import yaml
+
+
+logger = logging.getLogger(__name__)
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LITELLM_CONFIG_PATH = os.path.join(_BACKEND_DIR, "litellm", "config.yaml")
+DEFAULT_MODEL_PRICING_PATH = os.path.join(_BACKEND_DIR, "model_pricing.yaml")
+
+
+class ModelRegistryError(ValueError):
+    """The LiteLLM config or the pricing file is missing, malformed or inconsistent."""
+
+
+class ModelInfo:
+    """One model: where LiteLLM routes it and its per-token prices, profit margin included."""
+
+    __slots__ = ('name', 'index', 'upstream_model', 'served', 'input_price', 'output_price', 'max_output_tokens', 'tokenizer')
+
+    def __init__(self, name, index, upstream_model, served, input_price, output_price, max_output_tokens, tokenizer=None):
+        self.name = name
+        self.index = index # Position in the registry's PriceTable
+        self.upstream_model = upstream_model
+        self.served = served # Listed in the LiteLLM config (priced-only models can still be billed)
+        self.input_price = input_price
+        self.output_price = output_price
+        self.max_output_tokens = max_output_tokens
+        self.tokenizer = tokenizer # tiktoken encoding name, see token_counter.py
+
+    def estimate_cost(self, input_tokens, output_tokens):
+        """What a call with these token counts is billed, in dollars."""
+        return input_tokens * self.input_price + output_tokens * self.output_price
+
+    def __repr__(self):
+        return f"ModelInfo({self.name!r}, served={self.served})"
+
+
+class ModelRegistry:
+    """An immutable, compiled model catalog. Build it with load_model_registry()."""
+
+    def __init__(self, pricing, profit_margin, served_models, source_stamp=None):
+        """
+        pricing: {model: {"input": ..., "output": ..., "max_output_tokens": ..., "tokenizer": ...}}, prices per million tokens.
+        served_models: {model: upstream model} from the LiteLLM config. Every served model must be priced.
+        """
+        unpriced = [name for name in served_models if name not in pricing]
+        if unpriced:
+            raise ModelRegistryError(f"Models served by LiteLLM have no price: {', '.join(sorted(unpriced))}.")
+
+        names = [sys.intern(name) for name in pricing]
+        self.profit_margin = profit_margin
+        self._pricing = {name: pricing[name] for name in names}
+        self._price_table = None
+        multiplier = (1 + profit_margin) / 1_000_000 # Same arithmetic as PriceTable
+        self.models = tuple(
+            ModelInfo(
+                name=name,
+                index=index,
+                upstream_model=served_models.get(name),
+                served=name in served_models,
+                input_price=pricing[name].get("input", 0) * multiplier,
+                output_price=pricing[name].get("output", 0) * multiplier,
+                max_output_tokens=pricing[name].get("max_output_tokens"),
+                tokenizer=pricing[name].get("tokenizer"),
+            )
+            for index, name in enumerate(names)
+        )
+        self._by_name = MappingProxyType({info.name: info for info in self.models})
+        self.served_models = tuple(info.name for info in self.models if info.served)
+        self.tokenizers = frozenset(info.tokenizer for info in self.models if info.tokenizer)
+        self.source_stamp = source_stamp # The files' modification times this registry was built from
+
+    @property
+    def price_table(self):
+        """The prices as a usage_costing.PriceTable for the billing job, built on first use."""
+        if self._price_table is None:
+            from usage_costing import PriceTable # numpy, only the billing job prices columns
+            self._price_table = PriceTable(self._pricing, self.profit_margin)
+        return self._price_table
+
+    def get(self, name):
+        """The ModelInfo of a priced model, or None."""
+        return self._by_name.get(name)
+
+    def served(self, name):
+        """The ModelInfo of a model the API may route to LiteLLM, or None."""
+        info = self._by_name.get(name)
+        return info if info is not None and info.served else None
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def __len__(self):
+        return len(self.models)
+
+
+def _read_yaml(path):
+    try:
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    except OSError as e:
+        raise ModelRegistryError(f"Cannot read {path}: {e}")
+    except yaml.YAMLError as e:
+        raise ModelRegistryError(f"Invalid YAML in {path}: {e}")
+
+
+def _parse_litellm_models(config, path):
+    served_models = {}
+    for entry in config.get("model_list") or []:
+        name = entry.get("model_name") if isinstance(entry, dict) else None
+        if not name:
+            raise ModelRegistryError(f"{path}: every model_list entry needs a model_name.")
+        served_models[str(name)] = (entry.get("litellm_params") or {}).get("model", name)
+    return served_models
+
+
+def _parse_pricing(document, path):
+    models = document.get("models")
+    if not isinstance(models, dict):
+        raise ModelRegistryError(f"{path}: 'models' must map model names to prices.")
+    try:
+        profit_margin = float(document.get("profit_margin", 0.0))
+    except (TypeError, ValueError):
+        raise ModelRegistryError(f"{path}: profit_margin must be a number.")
+
+    pricing = {}
+    for name, prices in models.items():
+        if not isinstance(prices, dict):
+            raise ModelRegistryError(f"{path}: prices of {name} must be a mapping.")
+        try:
+            entry = {"input": float(prices["input"]), "output": float(prices["output"])}
+            if prices.get("max_output_tokens") is not None:
+                entry["max_output_tokens"] = int(prices["max_output_tokens"])
+            if prices.get("tokenizer"):
+                entry["tokenizer"] = sys.intern(str(prices["tokenizer"]))
+        except KeyError as e:
+            raise ModelRegistryError(f"{path}: {name} has no {e.args[0]} price.")
+        except (TypeError, ValueError):
+            raise ModelRegistryError(f"{path}: prices of {name} must be numbers.")
+        if entry["input"] < 0 or entry["output"] < 0:
+            raise ModelRegistryError(f"{path}: prices of {name} must not be negative.")
+        pricing[str(name)] = entry
+    return pricing, profit_margin
+
+
+def _source_stamp(paths):
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+
+def load_pricing(pricing_path=DEFAULT_MODEL_PRICING_PATH):
+    """Returns (prices per million tokens by model, profit margin) from the pricing file."""
+    return _parse_pricing(_read_yaml(pricing_path), pricing_path)
+
+
+def load_model_registry(litellm_config_path=DEFAULT_LITELLM_CONFIG_PATH, pricing_path=DEFAULT_MODEL_PRICING_PATH):
+    """Reads and compiles the registry. Raises ModelRegistryError if the files are inconsistent."""
+    stamp = _source_stamp((litellm_config_path, pricing_path))
+    served_models = _parse_litellm_models(_read_yaml(litellm_config_path), litellm_config_path)
+    pricing, profit_margin = load_pricing(pricing_path)
+    return ModelRegistry(pricing, profit_margin, served_models, source_stamp=stamp)
+
+
+class ModelRegistryLoader:
+    """Holds the current registry and swaps in a new one when the files change."""
+
+    def __init__(self, litellm_config_path=DEFAULT_LITELLM_CONFIG_PATH, pricing_path=DEFAULT_MODEL_PRICING_PATH):
+        self.litellm_config_path = litellm_config_path
+        self.pricing_path = pricing_path
+        self.current = load_model_registry(litellm_config_path, pricing_path) # Raises: no registry, no start
+        self._stamp = self.current.source_stamp
+        self._task = None
+
+    def reload_if_changed(self):
+        """Rebuilds the registry if either file changed. Returns True if a new registry was swapped in."""
+        stamp = _source_stamp((self.litellm_config_path, self.pricing_path))
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp # A broken file is reported once, not on every poll
+        try:
+            registry = load_model_registry(self.litellm_config_path, self.pricing_path)
+        except ModelRegistryError as e:
+            logger.error("Keeping the previous model registry: %s", e)
+            return False
+        self.current = registry
+        logger.info("Model registry reloaded.", extra={'models': len(registry), 'served_models': list(registry.served_models)})
+        return True
+
+    def start(self, interval_seconds):
+        """Polls the files every interval_seconds (0 = never) in a background task."""
+        if interval_seconds > 0:
+            self._task = asyncio.create_task(self._poll(interval_seconds))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _poll(self, interval_seconds):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                self.reload_if_changed()
+            except Exception:
+                logger.exception("Model registry reload failed.")
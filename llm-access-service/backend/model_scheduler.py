@@ -0,0 +1,222 @@
+# llm-access-service/backend/model_scheduler.py
+# Per-model admission control in front of LiteLLM.
+#
+# Every model has its own budget: a maximum number of upstream calls in flight and,
+# optionally, a token rate (tokens per minute, as a token bucket). A call that is over
+# budget waits in the model's bounded queue instead of being sent upstream (where the
+# provider would answer 429). Waiting calls are started in priority order (users with a
+# paid balance before free-tier users), then first come, first served.
+#
+# A full queue, or a call that waits longer than `max_wait`, raises ModelBusyError with a
+# Retry-After estimate, which the API turns into a 503.
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+DEFAULT_COMPLETION_TOKENS = 512 # Assumed completion size when the request sets no max_tokens
+
+
+class ModelBusyError(Exception):
+    """The model's budget is used up and its queue is full (or the wait timed out)."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelBudget:
+    def __init__(self, max_concurrency=100, tokens_per_minute=0):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute # 0 = no token rate limit
+
+
+def estimate_request_tokens(prompt_tokens, max_tokens=None):
+    """Rough upper estimate of the tokens a call uses: its prompt tokens (see token_counter.py) plus max_tokens."""
+    return prompt_tokens + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class Ticket:
+    """Admission to call a model. Must be passed to ModelScheduler.release() exactly once."""
+
+    def __init__(self, model, tokens):
+        self.model = model
+        self.tokens = tokens
+        self.started_at = time.monotonic()
+        self.released = False
+
+
+class _ModelQueue:
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_flight = 0
+        self.tokens = float(budget.tokens_per_minute)
+        self.refilled_at = time.monotonic()
+        self.waiters = [] # heap of [priority, sequence, tokens, future]
+        self.timer = None
+        self.avg_call_seconds = 1.0 # EWMA of upstream call durations, for Retry-After
+        # Metrics
+        self.started = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.max_queue_depth = 0
+
+    def refill(self):
+        rate = self.budget.tokens_per_minute
+        if rate:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.refilled_at) * rate / 60.0)
+            self.refilled_at = now
+
+
+class ModelScheduler:
+    """Per-model concurrency and token-rate budgets with a bounded priority queue."""
+
+    def __init__(self, budgets=None, default_budget=None, max_queue=200, max_wait=30.0):
+        self.budgets = budgets or {}
+        self.default_budget = default_budget or ModelBudget()
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._queues = {}
+        self._sequence = itertools.count()
+
+    async def acquire(self, model, tokens, priority=PRIORITY_FREE):
+        """Waits until the model has budget for a call of about `tokens` tokens. Returns a Ticket."""
+        queue = self._queue(model)
+        rate = queue.budget.tokens_per_minute
+        tokens = min(tokens, rate) if rate else 0 # A call bigger than the bucket only waits for a full bucket
+
+        queue.refill()
+        if not queue.waiters and self._has_budget(queue, tokens):
+            return self._start(queue, model, tokens)
+
+        if len(queue.waiters) >= self.max_queue:
+            queue.rejected += 1
+            raise ModelBusyError(f"Too many requests queued for model {model}.", self._retry_after(queue))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._sequence), tokens, future]
+        heapq.heappush(queue.waiters, entry)
+        queue.queued += 1
+        queue.max_queue_depth = max(queue.max_queue_depth, len(queue.waiters))
+        self._dispatch(model, queue)
+        waited_from = time.monotonic()
+        try:
+            ticket = await asyncio.wait_for(future, timeout=self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                self.release(future.result()) # Granted just as we gave up: hand the budget back
+            elif entry in queue.waiters:
+                queue.waiters.remove(entry)
+                heapq.heapify(queue.waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                queue.timeouts += 1
+                raise ModelBusyError(f"Timed out waiting for model {model}.", self._retry_after(queue)) from None
+            raise
+        waited = time.monotonic() - waited_from
+        queue.wait_seconds_total += waited
+        queue.wait_seconds_max = max(queue.wait_seconds_max, waited)
+        return ticket
+
+    def release(self, ticket, actual_tokens=None):
+        """Ends a call. With `actual_tokens`, the token bucket is corrected from the estimate to the real usage."""
+        if ticket.released:
+            return
+        ticket.released = True
+        queue = self._queue(ticket.model)
+        queue.in_flight -= 1
+        queue.avg_call_seconds = 0.9 * queue.avg_call_seconds + 0.1 * (time.monotonic() - ticket.started_at)
+        rate = queue.budget.tokens_per_minute
+        if rate and actual_tokens is not None:
+            queue.refill()
+            queue.tokens = max(queue.tokens - (min(actual_tokens, rate) - ticket.tokens), -rate)
+        self._dispatch(ticket.model, queue)
+
+    def stats(self):
+        return {
+            model: {
+                'in_flight': queue.in_flight,
+                'queue_depth': len(queue.waiters),
+                'max_queue_depth': queue.max_queue_depth,
+                'started': queue.started,
+                'queued': queue.queued,
+                'rejected': queue.rejected,
+                'timeouts': queue.timeouts,
+                'wait_seconds_total': queue.wait_seconds_total,
+                'avg_wait_seconds': queue.wait_seconds_total / queue.queued if queue.queued else 0.0,
+                'max_wait_seconds': queue.wait_seconds_max,
+            }
+            for model, queue in self._queues.items()
+        }
+
+    def _queue(self, model):
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = self._queues[model] = _ModelQueue(self.budgets.get(model, self.default_budget))
+        return queue
+
+    @staticmethod
+    def _has_budget(queue, tokens):
+        return queue.in_flight < queue.budget.max_concurrency and (not queue.budget.tokens_per_minute or queue.tokens >= tokens)
+
+    def _start(self, queue, model, tokens):
+        queue.in_flight += 1
+        queue.tokens -= tokens
+        queue.started += 1
+        return Ticket(model, tokens)
+
+    def _dispatch(self, model, queue):
+        """Starts waiting calls in priority order for as long as the model has budget."""
+        queue.refill()
+        while queue.waiters:
+            priority, _, tokens, future = queue.waiters[0]
+            if future.done(): # Cancelled waiter
+                heapq.heappop(queue.waiters)
+                continue
+            if not self._has_budget(queue, tokens):
+                if queue.in_flight < queue.budget.max_concurrency and queue.timer is None:
+                    # Only tokens are missing: look again once the bucket has refilled enough
+                    delay = (tokens - queue.tokens) * 60.0 / queue.budget.tokens_per_minute
+                    queue.timer = asyncio.get_running_loop().call_later(delay, self._on_timer, model, queue)
+                return
+            heapq.heappop(queue.waiters)
+            future.set_result(self._start(queue, model, tokens))
+
+    def _on_timer(self, model, queue):
+        queue.timer = None
+        self._dispatch(model, queue)
+
+    def _retry_after(self, queue):
+        """Seconds until a new call would likely be admitted, from the queue length and recent call durations."""
+        seconds = queue.avg_call_seconds * (len(queue.waiters) + 1) / max(queue.budget.max_concurrency, 1)
+        rate = queue.budget.tokens_per_minute
+        if rate:
+            queued_tokens = sum(entry[2] for entry in queue.waiters)
+            seconds = max(seconds, (queued_tokens - queue.tokens) * 60.0 / rate)
+        return max(1, math.ceil(seconds))
+
+
+class ReleasingStream:
+    """Wraps a streamed upstream response so that closing it also releases its scheduler ticket."""
+
+    def __init__(self, upstream_response, scheduler, ticket):
+        self.upstream_response = upstream_response
+        self.scheduler = scheduler
+        self.ticket = ticket
+
+    def aiter_lines(self):
+        return self.upstream_response.aiter_lines()
+
+    async def aclose(self):
+        try:
+            await self.upstream_response.aclose()
+        finally:
+            self.scheduler.release(self.ticket)
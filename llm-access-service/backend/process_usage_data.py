@@ -1,34 +1,59 @@
 # llm-access-service/backend/process_usage_data.py
 import os
+import time
+import argparse
+import logging
+import multiprocessing
+import signal
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import psycopg2
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime
-import pytz # Import pytz for timezone handling if needed
+from usage_costing import price_chunk
+from model_registry import DEFAULT_LITELLM_CONFIG_PATH, DEFAULT_MODEL_PRICING_PATH, ModelRegistryError, ModelRegistryLoader
+from app_logging import configure_logging
+from settings import get_settings
+from billing_run_stats import BillingRunStats
+from billing_daemon import BillingDaemon
+from billing_checkpoint import billing_document_id, load_checkpoint, save_checkpoint
+from billing_partitions import (
+    partition_checkpoint_name,
+    partition_filter,
+    partition_order,
+    try_lock_partition,
+    unlock_partition,
+)
+from usage_rollups import add_rollup_increments, build_rollups, plan_billing_batches
 
 # Load environment variables from .env file in the backend directory
 load_dotenv()
+# Structured logs, written by a background thread (see app_logging.py).
+# Only the logging values of the API's settings apply to the billing worker.
+log_settings = get_settings()
+configure_logging(log_settings.log_level, log_settings.log_format)
+logger = logging.getLogger("process_usage_data")
 
 # --- Firebase Admin SDK Initialization ---
 # Initialize Firebase Admin SDK once
 FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH = os.environ.get('FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH')
 if not FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH:
-    print("FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH environment variable not set.")
+    logger.critical("FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH environment variable not set.")
     exit(1) # Exit if essential config is missing
 
 try:
     if not firebase_admin._apps:
         cred = credentials.Certificate(FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH)
         firebase_admin.initialize_app(cred)
-        print("Firebase Admin SDK initialized successfully for billing script.")
+        logger.info("Firebase Admin SDK initialized successfully for billing script.")
     else:
-        print("Firebase Admin SDK already initialized for billing script.")
+        logger.info("Firebase Admin SDK already initialized for billing script.")
 
     db = firestore.client() # Get Firestore client
 
 except Exception as e:
-    print(f"Error initializing Firebase Admin SDK for billing script: {e}")
+    logger.critical("Error initializing Firebase Admin SDK for billing script: %s", e)
     exit(1)
 
 
@@ -40,167 +65,567 @@ DB_NAME = os.environ.get('POSTGRES_DB', 'litellm')
 DB_HOST = os.environ.get('POSTGRES_HOST', 'db') # 'db' if running in the same Docker network
 DB_PORT = os.environ.get('POSTGRES_PORT', '5432')
 
-# --- Model Pricing (per million tokens) ---
-# These prices should reflect the cost from the LLM provider
-# Adjust these based on the actual costs of GPT-4o and DeepSeek-R1
-pricing_per_million = {
-    "gpt-4o": {"input": 15.0, "output": 60.0},
-    "deepseek-r1": {"input": 0.55, "output": 1.10}
-}
-
-PROFIT_MARGIN = 0.30 # 30% profit margin
+# --- Model Pricing ---
+# Prices per million tokens and the profit margin are defined in model_pricing.yaml, the same
+# registry the API checks requests against (see model_registry.py). It is compiled once into
+# per-token arrays with the margin included, and the daemon re-reads it when the files change.
+try:
+    model_registry = ModelRegistryLoader(
+        os.environ.get('LITELLM_CONFIG_PATH', DEFAULT_LITELLM_CONFIG_PATH),
+        os.environ.get('MODEL_PRICING_PATH', DEFAULT_MODEL_PRICING_PATH),
+    )
+except ModelRegistryError as e:
+    logger.critical("Error loading the model registry: %s", e)
+    exit(1)
 
 
-# --- Function to Add Billing Record to Firestore ---
-def add_billing_record_to_firestore(user_id, model, input_tokens, output_tokens, cost, timestamp):
-    """Adds a billing record to the 'billing' collection in Firestore."""
-    try:
-        # Ensure timestamp is a Firestore Timestamp object or compatible
-        # If timestamp from DB is a Python datetime, it should be fine.
-        # If it's a string or other format, you might need to convert it.
-
-        doc_ref = db.collection('billing').add({
+# --- Batch Sizes ---
+# Rows fetched from the server-side cursor at a time (bounds memory use of the job)
+BILLING_CHUNK_SIZE = int(os.environ.get('BILLING_CHUNK_SIZE', '5000'))
+FIRESTORE_BATCH_LIMIT = 500 # Firestore allows at most 500 writes per batch
+
+# --- Incremental Mode ---
+# 'flag' finds new rows with `processed = false` and sets the flag on LiteLLM's table.
+# 'incremental' reads rows after a durable (timestamp, id) checkpoint and never writes to LiteLLM's table.
+# Incremental mode needs migrations/001_billing_checkpoint.sql.
+BILLING_MODE = os.environ.get('BILLING_MODE', 'flag')
+BILLING_CHECKPOINT_NAME = os.environ.get('BILLING_CHECKPOINT_NAME', 'litellm_logs')
+# Rows newer than this are left for the next run, so rows committed late by LiteLLM
+# (with a timestamp slightly older than already billed rows) are not skipped.
+BILLING_WATERMARK_LAG_SECONDS = int(os.environ.get('BILLING_WATERMARK_LAG_SECONDS', '60'))
+
+# --- Parallel Workers ---
+# The backlog is hash-partitioned by user_id (see billing_partitions.py). Each worker process
+# bills the partitions whose advisory lock it can take. Every host running workers against
+# the same database must use the same BILLING_PARTITIONS.
+BILLING_WORKERS = int(os.environ.get('BILLING_WORKERS', '1'))
+BILLING_PARTITIONS = int(os.environ.get('BILLING_PARTITIONS', '0')) # 0 = one partition per worker
+FLAG_MODE_LOCK_NAME = 'litellm_logs:processed' # Advisory lock namespace of the flag mode
+
+# --- Daemon Mode ---
+# Runs continuously and bills new usage within seconds (needs migrations/003_usage_notify.sql for
+# instant wake-ups; without it the daemon polls). In incremental mode, billing lag is still at
+# least BILLING_WATERMARK_LAG_SECONDS.
+BILLING_DAEMON_BATCH_ROWS = int(os.environ.get('BILLING_DAEMON_BATCH_ROWS', '5000')) # Max rows per micro-batch
+BILLING_DAEMON_POLL_SECONDS = float(os.environ.get('BILLING_DAEMON_POLL_SECONDS', '30')) # Fallback poll interval
+BILLING_DAEMON_MIN_INTERVAL_SECONDS = float(os.environ.get('BILLING_DAEMON_MIN_INTERVAL_SECONDS', '1')) # Debounce between passes
+
+# --- Run Metrics ---
+# Every pass logs a summary (rows/s, chunk sizes, Firestore write latency). If set, each pass
+# also writes it as a Prometheus textfile to this directory (see billing_run_stats.py).
+BILLING_METRICS_DIR = os.environ.get('BILLING_METRICS_DIR')
+
+USAGE_COLUMNS = """
+                id,             -- Add ID to uniquely identify the record
+                user_id,
+                model,
+                prompt_tokens,  -- Or input_tokens
+                completion_tokens, -- Or output_tokens
+                timestamp,      -- The timestamp of the completion
+                {request_id}
+"""
+# The API's request id (see BILLING_REQUEST_ID_KEY), NULL for other callers
+REQUEST_ID_COLUMN = "metadata->>'billing_request_id' AS request_id"
+_usage_columns = None
+
+
+def usage_columns(conn):
+    """
+    The columns the usage queries select. The request id comes from litellm_logs' JSON
+    `metadata` column; without one it is NULL, and every row is billed by its own id.
+    Checked once per process.
+    """
+    global _usage_columns
+    if _usage_columns is None:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+                WHERE attrelid = to_regclass('litellm_logs') AND attname = 'metadata' AND NOT attisdropped;
+            """)
+            row = cur.fetchone()
+        conn.commit()
+        if row is not None and row[0] in ('json', 'jsonb'):
+            request_id = REQUEST_ID_COLUMN
+        else:
+            logger.warning("litellm_logs has no JSON metadata column: hedged or retried API calls can't be "
+                           "matched by request id and may be billed more than once.")
+            request_id = "NULL AS request_id"
+        _usage_columns = USAGE_COLUMNS.format(request_id=request_id)
+    return _usage_columns
+
+
+# --- Function to Add Billing Records to Firestore ---
+def add_billing_records_to_firestore(billing_records):
+    """
+    Adds billing records to the 'billing' collection and increments the matching daily
+    rollups in 'usage_rollups', in one Firestore transaction.
+    Takes one batch from plan_billing_batches (at most 500 writes). Raises if the
+    transaction fails, so the caller does not mark the records as processed.
+
+    Document IDs are derived from the API's request ID, or the usage row ID for rows without one.
+    Records whose billing document already exists (e.g. a re-run after a crash, or a retried or
+    hedged attempt of a call that was billed) are skipped, so neither the billing record nor the
+    rollups are counted twice.
+    """
+    billing_refs = [db.collection('billing').document(billing_document_id(record['id'], record['request_id']))
+                    for record in billing_records]
+
+    @firestore.transactional
+    def write_in_transaction(transaction):
+        # One read round trip for the whole batch
+        existing_ids = {snapshot.id for snapshot in db.get_all(billing_refs, transaction=transaction) if snapshot.exists}
+        new_records = []
+        for record, billing_ref in zip(billing_records, billing_refs):
+            if billing_ref.id in existing_ids:
+                continue
+            existing_ids.add(billing_ref.id) # Attempts of one request in the same batch
+            new_records.append(record)
+            # Timestamps from psycopg2 are Python datetime objects, which Firestore accepts directly
+            transaction.set(billing_ref, {
+                'user_id': record['user_id'],
+                'model': record['model'],
+                'input_tokens': record['input_tokens'],
+                'output_tokens': record['output_tokens'],
+                'cost': record['cost'],
+                'timestamp': record['timestamp'], # Use the timestamp from the LiteLLM log
+                'processed_at': firestore.SERVER_TIMESTAMP # Add a timestamp for when processed by this script
+            })
+        add_rollup_increments(transaction, db, build_rollups(new_records))
+        return len(new_records)
+
+    written = write_in_transaction(db.transaction())
+    if written < len(billing_records):
+        logger.info("Skipped %d records that were already billed.", len(billing_records) - written)
+    return written
+
+
+# --- Function to Mark Records as Processed in PostgreSQL ---
+def mark_records_processed(conn, record_ids):
+    """Sets processed = true for the given LiteLLM log IDs and commits."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+                UPDATE litellm_logs
+                SET processed = true
+                WHERE id = ANY(%s);
+            """,
+            (list(record_ids),)
+        )
+    conn.commit()
+
+
+def stream_usage_records(conn, query, params=None, chunk_size=BILLING_CHUNK_SIZE):
+    """
+    Runs the usage query through a named cursor and yields the rows chunk_size at a time.
+    A named cursor is a server-side cursor: rows are fetched in chunks
+    instead of loading the whole backlog into memory.
+    """
+    with conn.cursor(name='litellm_usage_cursor') as cur:
+        cur.itersize = chunk_size
+        cur.execute(query, params)
+        while True:
+            usage_records = cur.fetchmany(chunk_size)
+            if not usage_records:
+                break
+            yield usage_records
+
+
+def connect_to_postgres():
+    return psycopg2.connect(
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT
+    )
+
+
+def build_billing_records(usage_records):
+    """
+    Prices a chunk of rows from the usage query in one vectorized pass.
+    Returns (billing records, per-user/per-model aggregates, IDs of rows to mark as processed without billing).
+    """
+    price_table = model_registry.current.price_table
+    chunk, skipped_record_ids = price_chunk(usage_records, price_table)
+    for record_id in skipped_record_ids:
+        logger.warning("Skipping record %s: Missing user_id.", record_id)
+
+    unpriced = chunk.model_ids == price_table.unknown_index
+    if unpriced.any():
+        # The API only routes priced models, so these came from elsewhere (e.g. a direct LiteLLM key)
+        logger.error("Billed %d records at 0: their models have no price in model_pricing.yaml.", int(unpriced.sum()),
+                     extra={'unpriced_models': dict(Counter(chunk.models[unpriced].tolist()))})
+
+    billing_records = [
+        {
+            'id': record_id,
             'user_id': user_id,
             'model': model,
             'input_tokens': input_tokens,
             'output_tokens': output_tokens,
             'cost': cost,
-            'timestamp': timestamp, # Use the timestamp from the LiteLLM log
-            'processed_at': firestore.SERVER_TIMESTAMP # Add a timestamp for when processed by this script
-        })
-        print(f"Added billing record for user {user_id} with ID: {doc_ref[1].id}")
-    except Exception as e:
-        print(f"Error adding billing record to Firestore for user {user_id}: {e}")
-        # Log this error, but maybe continue processing other records
-        # Depending on severity, you might want to stop or retry
+            'timestamp': timestamp, # This should be a Python datetime object from psycopg2
+            'request_id': request_id,
+        }
+        for record_id, user_id, model, input_tokens, output_tokens, cost, timestamp, request_id in zip(
+            chunk.record_ids,
+            chunk.user_ids.tolist(),
+            chunk.models.tolist(),
+            chunk.input_tokens.tolist(),
+            chunk.output_tokens.tolist(),
+            chunk.costs.tolist(),
+            chunk.timestamps,
+            chunk.request_ids,
+        )
+    ]
+    return billing_records, chunk.aggregates(), skipped_record_ids
 
 
 # --- Main Processing Logic ---
-def process_litellm_logs():
-    conn = None
-    cur = None
-    try:
-        # Connect to the PostgreSQL database
-        conn = psycopg2.connect(
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-        print("Connected to PostgreSQL database.")
-
-        # --- Query Usage Data from LiteLLM Logs ---
-        # **IMPORTANT:** The table name and column names below might vary
-        # based on your LiteLLM version and how its logging is configured.
-        # In LiteLLM v3+, the table might be `litellm_logs`.
-        # You need to verify the schema of your LiteLLM database.
-        # Ensure you select columns for user ID, model, input tokens, output tokens, and timestamp.
-        # Also, you need a mechanism to track which records have already been processed.
-        # The query below assumes a `processed` boolean column exists and is false for new records.
-        # You will need to add an UPDATE statement after processing to set `processed = true`.
-
-        # Example Query (adjust column names as needed)
-        query = """
-            SELECT
-                id,             -- Add ID to uniquely identify the record
-                user_id,
-                model,
-                prompt_tokens,  -- Or input_tokens
-                completion_tokens, -- Or output_tokens
-                timestamp       -- The timestamp of the completion
-            FROM litellm_logs
-            WHERE processed = false -- Assuming a 'processed' flag exists
-            ORDER BY timestamp;
-        """
-        cur.execute(query)
-        usage_records = cur.fetchall()
-        print(f"Found {len(usage_records)} unprocessed usage records.")
-
-        processed_record_ids = [] # To store IDs of successfully processed records
-
-        for record in usage_records:
-            # Unpack the record - adjust indices based on your query SELECT order
+def bill_unprocessed_records(read_conn, write_conn, partition=0, partition_count=1, chunk_size=BILLING_CHUNK_SIZE, max_rows=None,
+                             stats=None):
+    """
+    One flag-mode pass over open connections: bills the partition's unprocessed rows
+    (at most max_rows of them, oldest first) and marks them processed.
+    Returns (rows read, records billed, records that failed and stay unprocessed).
+    Chunk sizes and Firestore write times are recorded in `stats` (a BillingRunStats) if given.
+    """
+    stats = stats or BillingRunStats("flag", partition)
+    in_partition, partition_params = partition_filter(partition, partition_count)
+    limit = "LIMIT %s" if max_rows else ""
+
+    # --- Query Usage Data from LiteLLM Logs ---
+    # **IMPORTANT:** The table name and column names below might vary
+    # based on your LiteLLM version and how its logging is configured.
+    # In LiteLLM v3+, the table might be `litellm_logs`.
+    # You need to verify the schema of your LiteLLM database.
+    # Ensure you select columns for user ID, model, input tokens, output tokens, and timestamp.
+    # The query below assumes a `processed` boolean column exists and is false for new records.
+
+    # Example Query (adjust column names as needed)
+    query = f"""
+        SELECT {usage_columns(read_conn)}
+        FROM litellm_logs
+        WHERE processed = false -- Assuming a 'processed' flag exists
+          AND {in_partition}
+        ORDER BY timestamp
+        {limit};
+    """
+    params = (*partition_params, *((max_rows,) if max_rows else ()))
+
+    rows_read = 0
+    total_billed = 0
+    total_failed = 0
+    for usage_records in stream_usage_records(read_conn, query, params or None, chunk_size=chunk_size):
+        rows_read += len(usage_records)
+        stats.record_chunk(len(usage_records))
+        billing_records, aggregates, skipped_record_ids = build_billing_records(usage_records)
+        if skipped_record_ids:
+            mark_records_processed(write_conn, skipped_record_ids)
+
+        # Write to Firestore and mark processed one Firestore batch at a time
+        for batch_records in plan_billing_batches(billing_records, FIRESTORE_BATCH_LIMIT):
+            write_started = time.perf_counter()
             try:
-                record_id = record[0]
-                user_id = record[1]
-                model = record[2]
-                input_tokens = record[3] if record[3] is not None else 0
-                output_tokens = record[4] if record[4] is not None else 0
-                timestamp = record[5] # This should be a Python datetime object from psycopg2
-
-                # Ensure user_id is not None or empty
-                if not user_id:
-                    print(f"Skipping record {record_id}: Missing user_id.")
-                    continue # Skip to the next record
-
-                # 1. Calculate Cost
-                input_cost = (input_tokens / 1_000_000) * pricing_per_million.get(model, {}).get("input", 0)
-                output_cost = (output_tokens / 1_000_000) * pricing_per_million.get(model, {}).get("output", 0)
-                raw_cost = input_cost + output_cost
-
-                # Add profit margin
-                total_cost_with_margin = raw_cost * (1 + PROFIT_MARGIN)
-
-                print(f"Record {record_id} for user {user_id} ({model}): Input: {input_tokens}, Output: {output_tokens}, Raw Cost: ${raw_cost:.6f}, Total Cost (with margin): ${total_cost_with_margin:.6f}")
-
-
-                # 2. Add Billing Record to Firestore
-                # Pass the original timestamp from the log
-                add_billing_record_to_firestore(
-                    user_id,
-                    model,
-                    input_tokens,
-                    output_tokens,
-                    total_cost_with_margin,
-                    timestamp # Use the datetime object directly
-                )
-
-                # 3. Add record_id to the list for marking as processed
-                processed_record_ids.append(record_id)
-
+                add_billing_records_to_firestore(batch_records)
             except Exception as e:
-                print(f"Error processing record {record[0] if len(record) > 0 else 'N/A'}: {e}")
-                # Continue processing other records if one fails
+                # Leave these records unprocessed so the next run retries them
+                stats.record_write(time.perf_counter() - write_started, len(batch_records), succeeded=False)
+                logger.error("Error adding %d billing records to Firestore: %s", len(batch_records), e)
+                total_failed += len(batch_records)
+                continue
+            stats.record_write(time.perf_counter() - write_started, len(batch_records))
+            mark_records_processed(write_conn, [record['id'] for record in batch_records])
+            total_billed += len(batch_records)
+
+        logger.info("Processed chunk of usage records.", extra={
+            'rows': len(usage_records),
+            'user_model_pairs': len(aggregates['user_id']),
+            'cost': float(aggregates['cost'].sum()),
+            'billed_so_far': total_billed,
+        })
 
+    read_conn.commit() # End the cursor's read transaction
+    return rows_read, total_billed, total_failed
+
+
+def bill_records_after_checkpoint(read_conn, write_conn, checkpoint_name, partition=0, partition_count=1,
+                                  chunk_size=BILLING_CHUNK_SIZE, max_rows=None, lag_seconds=BILLING_WATERMARK_LAG_SECONDS,
+                                  stats=None):
+    """
+    One incremental-mode pass over open connections: bills up to max_rows rows after the
+    checkpoint and moves the checkpoint forward chunk by chunk.
+    Returns (rows read, records billed). Raises if a Firestore write fails.
+    Chunk sizes and Firestore write times are recorded in `stats` (a BillingRunStats) if given.
+    """
+    stats = stats or BillingRunStats("incremental", partition)
+    in_partition, partition_params = partition_filter(partition, partition_count)
+    checkpoint = load_checkpoint(write_conn, checkpoint_name)
+    logger.debug("Starting from checkpoint.", extra={'checkpoint': checkpoint_name, 'position': checkpoint})
+
+    # Keyset predicate: a row-value comparison the (timestamp, id) index can serve
+    after_checkpoint = "(timestamp, id) > (%s, %s)" if checkpoint else "true"
+    limit = "LIMIT %s" if max_rows else ""
+    query = f"""
+        SELECT {usage_columns(read_conn)}
+        FROM litellm_logs
+        WHERE {after_checkpoint}
+          AND timestamp < now() - make_interval(secs => %s)
+          AND {in_partition}
+        ORDER BY timestamp, id
+        {limit};
+    """
+    params = (*(checkpoint or ()), lag_seconds, *partition_params, *((max_rows,) if max_rows else ()))
+
+    rows_read = 0
+    total_billed = 0
+    for usage_records in stream_usage_records(read_conn, query, params, chunk_size=chunk_size):
+        rows_read += len(usage_records)
+        stats.record_chunk(len(usage_records))
+        billing_records, aggregates, _ = build_billing_records(usage_records)
+
+        for batch_records in plan_billing_batches(billing_records, FIRESTORE_BATCH_LIMIT):
+            # If a batch fails, stop here: the checkpoint must not move past unbilled rows
+            write_started = time.perf_counter()
+            try:
+                add_billing_records_to_firestore(batch_records)
+            except Exception:
+                stats.record_write(time.perf_counter() - write_started, len(batch_records), succeeded=False)
+                raise
+            stats.record_write(time.perf_counter() - write_started, len(batch_records))
+
+        last_record = usage_records[-1]
+        save_checkpoint(write_conn, checkpoint_name, last_record[5], last_record[0])
+        total_billed += len(billing_records)
+
+        logger.info("Processed chunk of usage records.", extra={
+            'rows': len(usage_records),
+            'user_model_pairs': len(aggregates['user_id']),
+            'cost': float(aggregates['cost'].sum()),
+            'billed_so_far': total_billed,
+            'checkpoint': (last_record[5], last_record[0]),
+        })
 
-        # --- Mark Records as Processed in PostgreSQL ---
-        if processed_record_ids:
-            # Create a tuple of IDs for the SQL IN clause
-            ids_tuple = tuple(processed_record_ids)
+    read_conn.commit() # End the cursor's read transaction
+    return rows_read, total_billed
 
-            # SQL UPDATE statement to mark processed records
-            update_query = """
-                UPDATE litellm_logs
-                SET processed = true
-                WHERE id IN %s;
-            """
-            cur.execute(update_query, (ids_tuple,))
-            conn.commit() # Commit the transaction
-            print(f"Marked {len(processed_record_ids)} records as processed in PostgreSQL.")
-        else:
-            print("No records were successfully processed to mark in PostgreSQL.")
 
+def report_billing_pass(stats):
+    """Logs the summary of a billing pass and writes its metrics textfile if BILLING_METRICS_DIR is set."""
+    logger.info("Billing pass finished.", extra={'summary': stats.summary()})
+    if BILLING_METRICS_DIR:
+        try:
+            stats.write_textfile(BILLING_METRICS_DIR)
+        except OSError as e:
+            logger.warning("Could not write billing metrics to %s: %s", BILLING_METRICS_DIR, e)
+
+
+def process_litellm_logs(chunk_size=BILLING_CHUNK_SIZE, partition=0, partition_count=1):
+    """
+    Streams unprocessed usage rows from PostgreSQL in chunks, writes each chunk to Firestore
+    in batched writes and marks it processed in the same loop, so memory use does not grow
+    with the backlog and a failure only leaves the current batch unprocessed.
+
+    Only bills the rows of one partition, and only while holding its advisory lock.
+    Returns the number of billed records (0 if another worker holds the partition).
+    """
+    read_conn = None
+    write_conn = None
+    total_billed = 0
+    try:
+        # Two connections: one holds the long-running read transaction of the server-side cursor,
+        # the other commits the processed flags chunk by chunk and holds the partition lock.
+        read_conn = connect_to_postgres()
+        write_conn = connect_to_postgres()
+        logger.debug("Connected to PostgreSQL database.")
+
+        if not try_lock_partition(write_conn, FLAG_MODE_LOCK_NAME, partition):
+            logger.info("Partition %d/%d is being billed by another worker, skipping.", partition, partition_count)
+            return 0
+
+        stats = BillingRunStats("flag", partition)
+        _, total_billed, total_failed = bill_unprocessed_records(
+            read_conn, write_conn, partition, partition_count, chunk_size, stats=stats)
+        report_billing_pass(stats)
+
+        if total_failed:
+            logger.warning("%d records failed and will be retried on the next run.", total_failed)
+        unlock_partition(write_conn, FLAG_MODE_LOCK_NAME, partition)
+
+    except psycopg2.Error as e:
+        logger.error("Database error: %s", e)
+        if write_conn:
+            write_conn.rollback() # Rollback in case of database error
+    except Exception as e:
+        logger.exception("An unexpected error occurred during log processing: %s", e)
+    finally:
+        # Close the database connections
+        if read_conn:
+            read_conn.close()
+        if write_conn:
+            write_conn.close()
+        logger.debug("Database connection closed.")
+    return total_billed
+
+
+def process_litellm_logs_incremental(chunk_size=BILLING_CHUNK_SIZE, checkpoint_name=BILLING_CHECKPOINT_NAME,
+                                     partition=0, partition_count=1):
+    """
+    Incremental mode: bills only rows after the durable (timestamp, id) checkpoint,
+    using a keyset predicate that the (timestamp, id) index can serve.
+    The checkpoint moves forward after each fully written chunk. If a run stops halfway,
+    the next run re-reads at most one chunk, and records that already have a billing
+    document are skipped rather than charged twice.
+
+    With several partitions, each one has its own checkpoint and advisory lock.
+    Returns the number of billed records (0 if another worker holds the partition).
+    """
+    read_conn = None
+    write_conn = None
+    total_billed = 0
+    checkpoint_name = partition_checkpoint_name(checkpoint_name, partition, partition_count)
+    try:
+        read_conn = connect_to_postgres()
+        write_conn = connect_to_postgres()
+        logger.debug("Connected to PostgreSQL database.")
+
+        if not try_lock_partition(write_conn, checkpoint_name, partition):
+            logger.info("Checkpoint %s is being billed by another worker, skipping.", checkpoint_name)
+            return 0
+
+        stats = BillingRunStats("incremental", partition)
+        try:
+            _, total_billed = bill_records_after_checkpoint(
+                read_conn, write_conn, checkpoint_name, partition, partition_count, chunk_size, stats=stats)
+        finally:
+            report_billing_pass(stats) # Also when a Firestore write stopped the pass
+        unlock_partition(write_conn, checkpoint_name, partition)
 
     except psycopg2.Error as e:
-        print(f"Database error: {e}")
-        if conn:
-            conn.rollback() # Rollback in case of database error
-        setError(f"Database connection or query error: {e}")
+        logger.error("Database error: %s", e)
+        if write_conn:
+            write_conn.rollback() # Rollback in case of database error
     except Exception as e:
-        print(f"An unexpected error occurred during log processing: {e}")
-        setError(f"An unexpected error occurred: {e}")
+        logger.exception("An unexpected error occurred during incremental log processing: %s", e)
     finally:
-        # Close the database connection
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-        print("Database connection closed.")
+        if read_conn:
+            read_conn.close()
+        if write_conn:
+            write_conn.close()
+        logger.debug("Database connection closed.")
+    return total_billed
+
+
+# --- Parallel Workers ---
+def run_billing_worker(worker_index, partition_count, mode=BILLING_MODE, chunk_size=BILLING_CHUNK_SIZE):
+    """Bills every partition this worker can lock, one after another. Returns the number of billed records."""
+    total_billed = 0
+    for partition in partition_order(worker_index, partition_count):
+        if mode == "incremental":
+            total_billed += process_litellm_logs_incremental(chunk_size=chunk_size, partition=partition, partition_count=partition_count)
+        else:
+            total_billed += process_litellm_logs(chunk_size=chunk_size, partition=partition, partition_count=partition_count)
+    return total_billed
+
+
+def run_billing_workers(workers=BILLING_WORKERS, partition_count=BILLING_PARTITIONS, mode=BILLING_MODE, chunk_size=BILLING_CHUNK_SIZE):
+    """
+    Runs `workers` billing processes over `partition_count` partitions (default: one per worker).
+    Each process has its own Postgres connections and Firestore client, and streams,
+    prices and writes its partitions independently. Returns the total number of billed records.
+    """
+    partition_count = partition_count or workers
+    if workers <= 1:
+        return run_billing_worker(0, partition_count, mode, chunk_size)
+
+    # 'spawn' instead of fork: gRPC (Firestore) clients must not be shared with forked children
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(run_billing_worker, i, partition_count, mode, chunk_size) for i in range(workers)]
+        return sum(future.result() for future in futures)
+
+
+# --- Daemon Mode ---
+def run_billing_daemon(worker_index=0, partition_count=1, mode=BILLING_MODE, chunk_size=BILLING_CHUNK_SIZE,
+                       checkpoint_name=BILLING_CHECKPOINT_NAME):
+    """Bills one partition continuously until SIGTERM/SIGINT, reusing the same connections and Firestore client."""
+    if mode == "incremental":
+        def lock_name(partition):
+            return partition_checkpoint_name(checkpoint_name, partition, partition_count)
+
+        def run_pass(read_conn, write_conn, partition, max_rows):
+            model_registry.reload_if_changed()
+            stats = BillingRunStats(mode, partition)
+            try:
+                rows_read, _ = bill_records_after_checkpoint(
+                    read_conn, write_conn, lock_name(partition), partition, partition_count, chunk_size, max_rows, stats=stats)
+            finally:
+                if stats.rows_read:
+                    report_billing_pass(stats)
+            return rows_read, 0 # A failed Firestore write raises and the daemon backs off
+    else:
+        def lock_name(partition):
+            return FLAG_MODE_LOCK_NAME
+
+        def run_pass(read_conn, write_conn, partition, max_rows):
+            model_registry.reload_if_changed()
+            stats = BillingRunStats(mode, partition)
+            rows_read, _, failed = bill_unprocessed_records(
+                read_conn, write_conn, partition, partition_count, chunk_size, max_rows, stats=stats)
+            if rows_read:
+                report_billing_pass(stats) # Idle polls are not reported
+            return rows_read, failed
+
+    BillingDaemon(
+        connect_to_postgres, run_pass, lock_name,
+        worker_index=worker_index,
+        partition_count=partition_count,
+        batch_rows=BILLING_DAEMON_BATCH_ROWS,
+        poll_interval=BILLING_DAEMON_POLL_SECONDS,
+        min_interval=BILLING_DAEMON_MIN_INTERVAL_SECONDS,
+    ).run()
+
+
+def run_billing_daemons(workers=BILLING_WORKERS, partition_count=BILLING_PARTITIONS, mode=BILLING_MODE, chunk_size=BILLING_CHUNK_SIZE):
+    """Runs one daemon per worker process and forwards SIGTERM/SIGINT to them for a graceful shutdown."""
+    partition_count = partition_count or workers
+    if workers <= 1:
+        run_billing_daemon(0, partition_count, mode, chunk_size)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_billing_daemon, args=(i, partition_count, mode, chunk_size), name=f"billing-daemon-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate() # SIGTERM: each daemon finishes its pass and exits
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
 
 # --- Execute the processing script ---
 if __name__ == "__main__":
-    print("Starting LiteLLM usage log processing script...")
-    process_litellm_logs()
-    print("Log processing script finished.")
+    parser = argparse.ArgumentParser(description="Bill LiteLLM usage logs into Firestore.")
+    parser.add_argument("--mode", choices=["flag", "incremental"], default=BILLING_MODE,
+                        help="'flag' uses the processed column, 'incremental' a (timestamp, id) checkpoint.")
+    parser.add_argument("--chunk-size", type=int, default=BILLING_CHUNK_SIZE, help="Rows fetched per chunk.")
+    parser.add_argument("--workers", type=int, default=BILLING_WORKERS, help="Billing worker processes on this host.")
+    parser.add_argument("--partitions", type=int, default=BILLING_PARTITIONS,
+                        help="Hash partitions of the backlog (same on every host; 0 = one per worker).")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and bill new usage as it arrives.")
+    args = parser.parse_args()
+
+    if args.daemon:
+        logger.info("Starting LiteLLM usage billing daemon...")
+        run_billing_daemons(args.workers, args.partitions, args.mode, args.chunk_size)
+    else:
+        logger.info("Starting LiteLLM usage log processing script...")
+        total_billed = run_billing_workers(args.workers, args.partitions, args.mode, args.chunk_size)
+        logger.info("Log processing script finished. Billed %d records.", total_billed)
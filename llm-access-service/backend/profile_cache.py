@@ -0,0 +1,167 @@
+# llm-access-service/backend/profile_cache.py
+# Per-process cache of user profile documents ('users' collection).
+#
+# Bounded in size (LRU eviction) and in age (TTL). Entries can be invalidated explicitly
+# after a write, or kept up to date by Firestore snapshot listeners instead of expiring.
+# Accessed from the event loop, from worker threads and from Firestore listener threads,
+# so all state is guarded by a lock.
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class _StartingWatch:
+    """Placeholder in _watches while a listener is being started (one per attempt)."""
+    __slots__ = ()
+
+
+class UserProfileCache:
+    """LRU + TTL cache of user documents, with hit/miss counters."""
+
+    def __init__(self, db, max_size=10000, ttl=30.0, use_snapshot_listener=False):
+        self.db = db
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_snapshot_listener = use_snapshot_listener
+        self._entries = OrderedDict() # user_id -> (user_data, expires_at)
+        self._watches = {} # user_id -> Firestore watch, or _StartingWatch while it starts (snapshot listener mode)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def peek(self, user_id):
+        """Returns a copy of the cached profile, or None on a miss. Never reads Firestore."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            user_data, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(user_data)
+
+    def get(self, user_id):
+        """Returns the profile from the cache, reading it from Firestore on a miss (None if it doesn't exist)."""
+        user_data = self.peek(user_id)
+        if user_data is not None:
+            return user_data
+
+        user_doc = self.db.collection('users').document(user_id).get()
+        if not user_doc.exists:
+            return None
+        user_data = user_doc.to_dict()
+        self.put(user_id, user_data)
+        return dict(user_data)
+
+    def put(self, user_id, user_data):
+        """Stores a profile we just read or wrote (write-through)."""
+        evicted = []
+        with self._lock:
+            # Listener-backed entries are kept current by Firestore, so they don't expire
+            watched = user_id in self._watches
+            expires_at = None if watched else time.monotonic() + self.ttl
+            self._entries[user_id] = (dict(user_data), expires_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                evicted_id, _ = self._entries.popitem(last=False)
+                evicted.append(evicted_id)
+                self.evictions += 1
+        for evicted_id in evicted:
+            self._unwatch(evicted_id)
+        if self.use_snapshot_listener and not watched:
+            self._watch(user_id)
+
+    def invalidate(self, user_id):
+        """Drops the cached profile, e.g. after generate_api_key or a billing write changed it."""
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+        self._unwatch(user_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'listeners': len(self._watches),
+            }
+
+    def close(self):
+        with self._lock:
+            user_ids = list(self._watches)
+        for user_id in user_ids:
+            self._unwatch(user_id)
+
+    # --- Snapshot Listener Mode ---
+    def _watch(self, user_id):
+        # Claim the user under the lock, so concurrent put() calls from several threads
+        # register one listener. The listener itself is started outside the lock, because
+        # its first snapshot may be delivered right away and takes the lock.
+        with self._lock:
+            if user_id in self._watches:
+                return
+            claim = self._watches[user_id] = _StartingWatch()
+
+        def on_snapshot(doc_snapshots, changes, read_time):
+            for doc in doc_snapshots:
+                if doc.exists:
+                    with self._lock:
+                        # Only refresh users that are still cached (not evicted or invalidated)
+                        if user_id in self._entries:
+                            self._entries[user_id] = (doc.to_dict(), None)
+                else:
+                    with self._lock:
+                        self._entries.pop(user_id, None)
+
+        user_ref = self.db.collection('users').document(user_id)
+        try:
+            watch = user_ref.on_snapshot(on_snapshot)
+        except Exception as e:
+            logger.warning("Error starting profile listener for user %s: %s", user_id, e)
+            with self._lock:
+                if self._watches.get(user_id) is claim:
+                    del self._watches[user_id]
+            return
+        with self._lock:
+            # The user may have been evicted or invalidated while the listener started
+            claimed = self._watches.get(user_id) is claim
+            if claimed:
+                self._watches[user_id] = watch
+                entry = self._entries.get(user_id)
+                if entry is not None:
+                    self._entries[user_id] = (entry[0], None)
+        if not claimed:
+            self._stop_watch(user_id, watch)
+
+    def _unwatch(self, user_id):
+        with self._lock:
+            watch = self._watches.pop(user_id, None)
+        # A listener that is still starting stops itself once it sees its claim is gone
+        if watch is not None and not isinstance(watch, _StartingWatch):
+            self._stop_watch(user_id, watch)
+
+    @staticmethod
+    def _stop_watch(user_id, watch):
+        try:
+            watch.unsubscribe()
+        except Exception as e:
+            logger.warning("Error stopping profile listener for user %s: %s", user_id, e)
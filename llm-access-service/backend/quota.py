@@ -0,0 +1,389 @@
+# llm-access-service/backend/quota.py
+# Free-tier quota engine for /chat/completion.
+#
+# reserve() does the daily reset, the limit check and the reservation of a free call
+# in one atomic operation, so concurrent requests cannot all read the same count and
+# overspend the daily limit. refund() gives a reserved free call back if the upstream call fails.
+#
+# A paid call holds its maximum cost (estimated before the call) against the balance in the
+# same operation, so concurrent calls cannot spend more than the balance. settle() charges the
+# actual cost once the call completed and releases the hold; refund() only releases it.
+# Each hold is stored on its own ('balanceHolds': {hold id: {'amount', 'expiresAt'}}) and lapses
+# BALANCE_HOLD_TTL_SECONDS after it was placed, so the hold of a call that was never settled
+# (e.g. the worker died) expires even while the user keeps placing new ones.
+import threading
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+from firebase_admin import firestore
+from starlette.concurrency import run_in_threadpool
+
+from api_metrics import STAGE_SECONDS
+
+
+# Longer than any call can run (see UPSTREAM_DEADLINE_SECONDS), so only holds of lost calls lapse
+BALANCE_HOLD_TTL_SECONDS = 900
+
+
+class QuotaExceededError(Exception):
+    """Raised when the user has no free calls left today and no paid balance."""
+
+
+class InsufficientBalanceError(QuotaExceededError):
+    """Raised when the balance not held by calls in flight does not cover a paid call's maximum cost."""
+
+    def __init__(self, available, cost):
+        super().__init__(
+            f"Your balance (${max(available, 0):.4f} available) does not cover the maximum cost of this request "
+            f"(${cost:.4f}). Please top up your account or lower max_tokens.")
+        self.available = available
+        self.cost = cost
+
+
+class UserNotFoundError(Exception):
+    """Raised when the user document does not exist."""
+
+
+class QuotaReservation:
+    """The outcome of a successful reserve() call."""
+
+    def __init__(self, user_id, day, is_free_call, free_calls_used, balance, held=0.0, hold_id=None):
+        self.user_id = user_id
+        self.day = day # The day the free call was counted against
+        self.is_free_call = is_free_call
+        self.free_calls_used = free_calls_used # Free calls used today, including this one
+        self.balance = balance # Balance not held by other calls in flight
+        self.held = held # Balance held for this (paid) call until it is settled or refunded
+        self.hold_id = hold_id # ... and the id of that hold
+
+
+def new_hold_id():
+    # Starts with a letter, so it can be used in a Firestore field path ('balanceHolds.<id>')
+    return f"h{uuid.uuid4().hex}"
+
+
+def active_holds(user_data, now):
+    """The user's holds ({hold id: {'amount', 'expiresAt'}}) that have not expired at `now`."""
+    holds = user_data.get('balanceHolds') or {}
+    return {hold_id: hold for hold_id, hold in holds.items() if hold['expiresAt'] > now}
+
+
+def held_balance(user_data, now):
+    """The balance held by calls in flight, without holds older than BALANCE_HOLD_TTL_SECONDS."""
+    return sum(hold['amount'] for hold in active_holds(user_data, now).values())
+
+
+def apply_quota(user_data, today, free_call_limit, cost=0.0, now=None):
+    """
+    Applies the quota policy to a user document. A paid call holds `cost` of the balance.
+    Returns (reservation fields, document updates) or raises QuotaExceededError.
+    Shared by all backends so they enforce exactly the same rules.
+    """
+    free_calls_today = user_data.get('freeCallsToday', 0) or 0
+    last_free_call_date = user_data.get('lastFreeCallDate')
+    if isinstance(last_free_call_date, datetime):
+        last_free_call_date = last_free_call_date.date()
+
+    # New day: the free calls start again from zero
+    if last_free_call_date is None or last_free_call_date < today:
+        free_calls_today = 0
+
+    balance = user_data.get('balance', 0) or 0
+
+    if free_calls_today < free_call_limit:
+        updates = {
+            'freeCallsToday': free_calls_today + 1,
+            'lastFreeCallDate': datetime.combine(today, datetime.min.time()),
+        }
+        return (True, free_calls_today + 1, balance, 0.0, None), updates
+
+    now = now or datetime.now(timezone.utc)
+    holds = active_holds(user_data, now)
+    available = balance - sum(hold['amount'] for hold in holds.values())
+    if available > 0:
+        if cost > available:
+            raise InsufficientBalanceError(available, cost)
+        if not cost:
+            return (False, free_calls_today, available, 0.0, None), {}
+        # Paid call: its maximum cost is held until settle() charges the actual cost.
+        # Writing the whole map also drops the holds that have expired.
+        hold_id = new_hold_id()
+        holds[hold_id] = {'amount': cost, 'expiresAt': now + timedelta(seconds=BALANCE_HOLD_TTL_SECONDS)}
+        return (False, free_calls_today, available, cost, hold_id), {'balanceHolds': holds}
+
+    raise QuotaExceededError("You have run out of tokens. Please top up your account to continue.")
+
+
+def apply_quota_batch(user_data, today, free_call_limit, count, costs=None):
+    """
+    Applies the quota policy to `count` calls at once, in order: free calls while any are
+    left today, then paid calls while the balance covers their `costs`. Calls beyond that
+    are not granted. Returns (list of reservation fields for the granted calls, document updates);
+    raises the first call's QuotaExceededError if not even that one is granted.
+    """
+    granted = []
+    updates = {}
+    user_data = dict(user_data)
+    now = datetime.now(timezone.utc)
+    for i in range(count):
+        try:
+            fields, call_updates = apply_quota(user_data, today, free_call_limit, costs[i] if costs else 0.0, now)
+        except QuotaExceededError:
+            if not granted:
+                raise
+            break
+        if not call_updates and not costs:
+            # Paid call: every remaining call is decided the same way
+            granted.extend([fields] * (count - len(granted)))
+            break
+        granted.append(fields)
+        user_data.update(call_updates)
+        updates.update(call_updates)
+    return granted, updates
+
+
+class QuotaEngine:
+    """Interface for quota backends."""
+
+    def __init__(self, free_call_limit):
+        self.free_call_limit = free_call_limit
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def reserve(self, user_id, today=None, cost=0.0):
+        """
+        Reserves one call for the user. If it is a paid call, `cost` (its maximum cost) is held
+        against the balance. Returns a QuotaReservation.
+        """
+        raise NotImplementedError
+
+    async def refund(self, reservation):
+        """Gives back a free call reserved by reserve(), or releases a paid call's hold without charging it."""
+        raise NotImplementedError
+
+    async def settle(self, reservation, cost):
+        """Charges a paid call's actual cost to the balance and releases its hold (no-op for free calls)."""
+        raise NotImplementedError
+
+    async def reserve_many(self, user_id, count, today=None, costs=None):
+        """
+        Reserves up to `count` calls for one user, e.g. for a batch request, holding costs[i]
+        for the i-th call if it is paid. Returns the granted QuotaReservations (fewer than
+        `count` once the quota or the balance runs out).
+        Raises QuotaExceededError if not even one call can be granted.
+        """
+        reservations = []
+        for i in range(count):
+            try:
+                reservations.append(await self.reserve(user_id, today, costs[i] if costs else 0.0))
+            except QuotaExceededError:
+                if not reservations:
+                    raise
+                break
+        return reservations
+
+    async def refund_many(self, reservations):
+        """Gives back several reservations of one user."""
+        for reservation in reservations:
+            await self.refund(reservation)
+
+    async def settle_many(self, settlements):
+        """Settles several (reservation, actual cost) pairs of one user."""
+        for reservation, cost in settlements:
+            await self.settle(reservation, cost)
+
+    def invalidate(self, user_id):
+        """Drops any cached state for the user (e.g. after their profile changed)."""
+        pass
+
+
+class FirestoreQuotaEngine(QuotaEngine):
+    """
+    Quota backend on the 'users' collection.
+    The read, reset, check and increment happen in one Firestore transaction
+    (one read plus one commit), which retries automatically on contention.
+    With a profile cache, calls that need no write (paid calls without a hold, or
+    rejections once today's free calls and the balance are used up) are decided from
+    the cached profile alone.
+    """
+
+    def __init__(self, db, free_call_limit, profile_cache=None):
+        super().__init__(free_call_limit)
+        self.db = db
+        self.profile_cache = profile_cache
+
+    async def reserve(self, user_id, today=None, cost=0.0):
+        today = today or date.today()
+        return await run_in_threadpool(self._reserve_sync, user_id, today, cost)
+
+    async def refund(self, reservation):
+        await self.refund_many([reservation])
+
+    async def settle(self, reservation, cost):
+        await self.settle_many([(reservation, cost)])
+
+    async def reserve_many(self, user_id, count, today=None, costs=None):
+        # One transaction for the whole batch instead of one per call
+        today = today or date.today()
+        return await run_in_threadpool(self._reserve_many_sync, user_id, count, today, costs)
+
+    async def refund_many(self, reservations):
+        free_calls = [reservation for reservation in reservations if reservation.is_free_call]
+        if free_calls:
+            await run_in_threadpool(self._refund_sync, free_calls[0], len(free_calls))
+        hold_ids = [reservation.hold_id for reservation in reservations if reservation.hold_id]
+        if hold_ids:
+            await run_in_threadpool(self._settle_sync, reservations[0].user_id, 0.0, hold_ids)
+        if free_calls or hold_ids:
+            self.invalidate(reservations[0].user_id)
+
+    async def settle_many(self, settlements):
+        paid = [(reservation, cost) for reservation, cost in settlements if not reservation.is_free_call]
+        if paid:
+            charged = sum(cost for _, cost in paid)
+            hold_ids = [reservation.hold_id for reservation, _ in paid if reservation.hold_id]
+            await run_in_threadpool(self._settle_sync, paid[0][0].user_id, charged, hold_ids)
+            self.invalidate(paid[0][0].user_id)
+
+    def invalidate(self, user_id):
+        if self.profile_cache is not None:
+            self.profile_cache.invalidate(user_id)
+
+    def _reserve_sync(self, user_id, today, cost):
+        if self.profile_cache is not None:
+            with STAGE_SECONDS.labels('profile_read').time():
+                cached = self.profile_cache.peek(user_id)
+            if cached is not None:
+                # Raises QuotaExceededError straight from the cache: today's free calls only
+                # go up, so a cached "used up with no balance" (or "balance minus holds below
+                # the cost") is still true, up to the cache TTL for top-ups and released holds.
+                # A hold that fits is placed by the transaction, against the current document.
+                fields, updates = apply_quota(cached, today, self.free_call_limit, cost)
+                if not updates:
+                    return QuotaReservation(user_id, today, *fields)
+
+        user_ref = self.db.collection('users').document(user_id)
+
+        @firestore.transactional
+        def reserve_in_transaction(transaction):
+            with STAGE_SECONDS.labels('profile_read').time():
+                user_doc = user_ref.get(transaction=transaction)
+            if not user_doc.exists:
+                raise UserNotFoundError(f"User data not found for {user_id}.")
+            user_data = user_doc.to_dict()
+            fields, updates = apply_quota(user_data, today, self.free_call_limit, cost)
+            if updates:
+                transaction.update(user_ref, updates)
+            user_data.update(updates)
+            return fields, user_data
+
+        fields, user_data = reserve_in_transaction(self.db.transaction())
+        if self.profile_cache is not None:
+            self.profile_cache.put(user_id, user_data) # Write-through of the committed state
+        return QuotaReservation(user_id, today, *fields)
+
+    def _reserve_many_sync(self, user_id, count, today, costs):
+        if self.profile_cache is not None:
+            cached = self.profile_cache.peek(user_id)
+            if cached is not None:
+                # Rejects from the cache, as in _reserve_sync, if not even the first call fits
+                apply_quota(cached, today, self.free_call_limit, costs[0] if costs else 0.0)
+        user_ref = self.db.collection('users').document(user_id)
+
+        @firestore.transactional
+        def reserve_in_transaction(transaction):
+            with STAGE_SECONDS.labels('profile_read').time():
+                user_doc = user_ref.get(transaction=transaction)
+            if not user_doc.exists:
+                raise UserNotFoundError(f"User data not found for {user_id}.")
+            user_data = user_doc.to_dict()
+            granted, updates = apply_quota_batch(user_data, today, self.free_call_limit, count, costs)
+            if updates:
+                transaction.update(user_ref, updates)
+            user_data.update(updates)
+            return granted, user_data
+
+        granted, user_data = reserve_in_transaction(self.db.transaction())
+        if self.profile_cache is not None:
+            self.profile_cache.put(user_id, user_data)
+        if not granted:
+            raise QuotaExceededError("You have run out of tokens. Please top up your account to continue.")
+        return [QuotaReservation(user_id, today, *fields) for fields in granted]
+
+    def _refund_sync(self, reservation, calls=1):
+        user_ref = self.db.collection('users').document(reservation.user_id)
+        reserved_day = datetime.combine(reservation.day, datetime.min.time())
+
+        @firestore.transactional
+        def refund_in_transaction(transaction):
+            user_data = user_ref.get(transaction=transaction).to_dict() or {}
+            last_free_call_date = user_data.get('lastFreeCallDate')
+            # Only refund if the counter was not reset by a new day in the meantime
+            if isinstance(last_free_call_date, datetime) and last_free_call_date.date() == reservation.day:
+                free_calls_today = user_data.get('freeCallsToday', 0) or 0
+                if free_calls_today > 0:
+                    transaction.update(user_ref, {'freeCallsToday': max(free_calls_today - calls, 0), 'lastFreeCallDate': reserved_day})
+
+        refund_in_transaction(self.db.transaction())
+
+    def _settle_sync(self, user_id, charged, hold_ids):
+        # A field delete per hold and a server-side increment: no transaction needed, concurrent
+        # settlements all apply (and deleting a hold that already expired and was dropped is a no-op)
+        updates = {f'balanceHolds.{hold_id}': firestore.DELETE_FIELD for hold_id in hold_ids}
+        if charged:
+            updates['balance'] = firestore.Increment(-charged)
+        if updates:
+            self.db.collection('users').document(user_id).update(updates)
+
+
+class InMemoryQuotaEngine(QuotaEngine):
+    """Quota backend on a plain dict ({user_id: user_data}). Used in tests and benchmarks."""
+
+    def __init__(self, free_call_limit, users=None):
+        super().__init__(free_call_limit)
+        self.users = users if users is not None else {}
+        self._lock = threading.Lock()
+
+    async def reserve(self, user_id, today=None, cost=0.0):
+        today = today or date.today()
+        with self._lock:
+            user_data = self.users.get(user_id)
+            if user_data is None:
+                raise UserNotFoundError(f"User data not found for {user_id}.")
+            fields, updates = apply_quota(user_data, today, self.free_call_limit, cost)
+            user_data.update(updates)
+        return QuotaReservation(user_id, today, *fields)
+
+    async def reserve_many(self, user_id, count, today=None, costs=None):
+        today = today or date.today()
+        with self._lock:
+            user_data = self.users.get(user_id)
+            if user_data is None:
+                raise UserNotFoundError(f"User data not found for {user_id}.")
+            granted, updates = apply_quota_batch(user_data, today, self.free_call_limit, count, costs)
+            user_data.update(updates)
+        if not granted:
+            raise QuotaExceededError("You have run out of tokens. Please top up your account to continue.")
+        return [QuotaReservation(user_id, today, *fields) for fields in granted]
+
+    async def refund(self, reservation):
+        if not reservation.is_free_call:
+            await self.settle(reservation, 0.0) # Releases the hold
+            return
+        with self._lock:
+            user_data = self.users.get(reservation.user_id) or {}
+            last_free_call_date = user_data.get('lastFreeCallDate')
+            if isinstance(last_free_call_date, datetime) and last_free_call_date.date() == reservation.day:
+                user_data['freeCallsToday'] = max((user_data.get('freeCallsToday', 0) or 0) - 1, 0)
+
+    async def settle(self, reservation, cost):
+        if reservation.is_free_call:
+            return
+        with self._lock:
+            user_data = self.users.get(reservation.user_id) or {}
+            (user_data.get('balanceHolds') or {}).pop(reservation.hold_id, None)
+            user_data['balance'] = (user_data.get('balance', 0) or 0) - cost
@@ -0,0 +1,143 @@
+# llm-access-service/backend/response_cache.py
+# Exact-match cache of non-streaming chat completion responses.
+#
+# The key is a SHA-256 of the canonical JSON of everything that determines the answer
+# (model, messages, sampling parameters), never of the caller. Only deterministic requests
+# are cached: temperature 0, or an explicit opt-in with the X-Response-Cache header.
+#
+# Two tiers: a per-process LRU bounded by total bytes, and optionally Redis, shared by all
+# workers. Both expire entries after `ttl` seconds. Values are the raw response bodies.
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+RESPONSE_CACHE_HEADER = 'X-Response-Cache' # Request: 'use' / 'bypass'. Response: 'HIT' / 'MISS' / 'BYPASS'.
+
+# Payload fields that take part in the key. Anything else (e.g. 'user') doesn't change the answer.
+CACHE_KEY_FIELDS = ('model', 'messages', 'temperature', 'top_p', 'max_tokens', 'seed', 'stop')
+
+
+def response_cache_key(payload):
+    """Canonical hash of a LiteLLM payload: same model, messages and sampling params -> same key."""
+    keyed = {field: payload[field] for field in CACHE_KEY_FIELDS if payload.get(field) is not None}
+    canonical = json.dumps(keyed, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_cacheable_request(payload, stream, cache_header=None):
+    """Only non-streaming, deterministic requests are served from the cache."""
+    cache_header = (cache_header or '').strip().lower()
+    if stream or cache_header == 'bypass':
+        return False
+    return cache_header == 'use' or payload.get('temperature') == 0
+
+
+class ResponseCache:
+    """In-memory LRU (bounded by bytes) in front of an optional Redis tier, with hit/miss counters."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=1024 * 1024, ttl=3600.0, redis_url=None, key_prefix="respcache"):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self.redis = None
+        if redis_url:
+            import redis.asyncio as redis # Optional dependency, only needed for the shared tier
+            self.redis = redis.from_url(redis_url)
+        self._entries = OrderedDict() # key -> (body, expires_at)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.redis_errors = 0
+
+    async def get(self, key):
+        """Returns the cached response body, or None."""
+        body = self._get_local(key)
+        if body is not None:
+            with self._lock:
+                self.hits += 1
+            return body
+        if self.redis is not None:
+            try:
+                body = await self.redis.get(f"{self.key_prefix}:{key}")
+            except Exception as e:
+                logger.warning("Response cache Redis read failed: %s", e)
+                self.redis_errors += 1
+                body = None
+            if body is not None:
+                self._put_local(key, body)
+                with self._lock:
+                    self.hits += 1
+                    self.redis_hits += 1
+                return body
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def set(self, key, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        self._put_local(key, body)
+        with self._lock:
+            self.stores += 1
+        if self.redis is not None:
+            try:
+                await self.redis.set(f"{self.key_prefix}:{key}", body, ex=max(int(self.ttl), 1))
+            except Exception as e:
+                logger.warning("Response cache Redis write failed: %s", e)
+                self.redis_errors += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'hits': self.hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'redis_errors': self.redis_errors,
+            }
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.close()
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            body, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._size -= len(body)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def _put_local(self, key, body):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[0])
+            self._entries[key] = (body, time.monotonic() + self.ttl)
+            self._size += len(body)
+            while self._size > self.max_bytes and self._entries:
+                _, (evicted_body, _) = self._entries.popitem(last=False)
+                self._size -= len(evicted_body)
+                self.evictions += 1
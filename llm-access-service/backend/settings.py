@@ -0,0 +1,221 @@
+# llm-access-service/backend/settings.py
+# Configuration of the API backend, read from the environment (and the .env file) once.
+# Values are parsed and type-checked here, so a typo fails with the variable's name instead
+# of surfacing later in a request. Required values without a default (the Firebase service
+# account) are checked when the app starts, not at import.
+import json
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from model_registry import DEFAULT_LITELLM_CONFIG_PATH, DEFAULT_MODEL_PRICING_PATH
+
+
+class SettingsError(ValueError):
+    """An environment variable has an invalid value."""
+
+
+_TRUE_VALUES = ('1', 'true', 'yes')
+
+
+def _get_str(environ, name, default=None):
+    value = environ.get(name)
+    return value if value else default
+
+
+def _get_int(environ, name, default):
+    value = environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise SettingsError(f"{name} must be an integer, got {value!r}.")
+
+
+def _get_float(environ, name, default):
+    value = environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise SettingsError(f"{name} must be a number, got {value!r}.")
+
+
+def _get_bool(environ, name, default):
+    value = environ.get(name)
+    if not value:
+        return default
+    return value.lower() in _TRUE_VALUES
+
+
+def _get_json_object(environ, name):
+    value = environ.get(name)
+    if not value:
+        return {}
+    try:
+        parsed = json.loads(value)
+    except ValueError as e:
+        raise SettingsError(f"{name} must be a JSON object: {e}")
+    if not isinstance(parsed, dict):
+        raise SettingsError(f"{name} must be a JSON object, got {value!r}.")
+    return parsed
+
+
+@dataclass(frozen=True)
+class Settings:
+    # --- Firebase ---
+    firebase_service_account_key_path: Optional[str]
+    # 'local' verifies tokens in-process against cached Google signing certificates (no network on the hot path).
+    # 'firebase' delegates every verification to firebase_admin.auth.verify_id_token.
+    firebase_token_verifier: str
+    firebase_token_cache_size: int
+
+    # --- LiteLLM ---
+    litellm_url: str
+    litellm_api_key: Optional[str]
+    # HTTP client pool and timeouts (see upstream_client.py). All calls go to the one LiteLLM host.
+    litellm_http_max_connections: int
+    litellm_http_max_keepalive_connections: int
+    litellm_http_keepalive_expiry: float
+    litellm_http_connect_timeout: float
+    litellm_http_read_timeout: float # LLM calls can take a while
+    litellm_http_write_timeout: float
+    litellm_http_pool_timeout: float
+    litellm_http2: bool # Needs the optional 'h2' package
+
+    # --- Model Registry (see model_registry.py) ---
+    litellm_config_path: str
+    model_pricing_path: str
+    model_registry_reload_seconds: float # 0 = load once at startup
+
+    # --- Free Tier ---
+    free_call_limit: int # Daily free call limit per user
+    # 'firestore' reserves each call with a Firestore transaction.
+    # 'write-behind' counts calls in memory (or in Redis if quota_redis_url is set) and flushes to Firestore in batches.
+    quota_backend: str
+    quota_redis_url: Optional[str]
+    quota_flush_interval_seconds: float
+    quota_flush_threshold: int
+    quota_max_staleness_seconds: float
+
+    # --- User Profile Cache ---
+    profile_cache_size: int
+    profile_cache_ttl_seconds: float
+    profile_cache_snapshot_listener: bool # Push profile updates with Firestore snapshot listeners
+
+    # --- Response Cache (see response_cache.py) ---
+    response_cache_enabled: bool
+    response_cache_ttl_seconds: float
+    response_cache_max_bytes: int
+    response_cache_max_entry_bytes: int
+    response_cache_redis_url: Optional[str]
+
+    # --- Request Coalescing (see single_flight.py) ---
+    single_flight_enabled: bool
+
+    # --- Batch Requests ---
+    batch_max_items: int
+    batch_max_concurrency: int # Upstream calls in flight for all batches
+    batch_per_user_concurrency: int # ... and for one user's batches
+
+    # --- Model Scheduler (see model_scheduler.py) ---
+    model_limits: dict # {model: {"max_concurrency": ..., "tokens_per_minute": ...}}
+    model_default_max_concurrency: int
+    model_default_tokens_per_minute: int # 0 = no token rate limit
+    model_queue_max_size: int
+    model_queue_max_wait_seconds: float
+
+    # --- Upstream Resilience (see upstream_resilience.py) ---
+    upstream_deadline_seconds: float
+    upstream_max_attempts: int # 1 = no retries
+    upstream_backoff_base_seconds: float
+    upstream_backoff_max_seconds: float
+    upstream_breaker_failure_threshold: int
+    upstream_breaker_reset_seconds: float
+    upstream_hedging_enabled: bool
+    upstream_hedge_min_samples: int
+
+    # --- Startup ---
+    warmup_max_retry_seconds: float # Longest pause between warm-up attempts of a client
+
+    # --- Logging (see app_logging.py) ---
+    log_level: str
+    log_format: str # 'json' (one object per line) or 'text'
+
+    # --- Metrics and Usage Dashboard ---
+    metrics_enabled: bool
+    usage_rollups_max_page_size: int
+
+    @classmethod
+    def from_environ(cls, environ):
+        return cls(
+            firebase_service_account_key_path=_get_str(environ, 'FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH'),
+            firebase_token_verifier=_get_str(environ, 'FIREBASE_TOKEN_VERIFIER', 'local'),
+            firebase_token_cache_size=_get_int(environ, 'FIREBASE_TOKEN_CACHE_SIZE', 10000),
+            litellm_url=_get_str(environ, 'LITELLM_INTERNAL_API_URL', 'http://litellm:4000'), # Internal Docker URL
+            litellm_api_key=_get_str(environ, 'LITELLM_INTERNAL_API_KEY'),
+            litellm_http_max_connections=_get_int(environ, 'LITELLM_HTTP_MAX_CONNECTIONS', 100),
+            litellm_http_max_keepalive_connections=_get_int(environ, 'LITELLM_HTTP_MAX_KEEPALIVE_CONNECTIONS', 20),
+            litellm_http_keepalive_expiry=_get_float(environ, 'LITELLM_HTTP_KEEPALIVE_EXPIRY', 30.0),
+            litellm_http_connect_timeout=_get_float(environ, 'LITELLM_HTTP_CONNECT_TIMEOUT', 5.0),
+            litellm_http_read_timeout=_get_float(environ, 'LITELLM_HTTP_READ_TIMEOUT', 120.0),
+            litellm_http_write_timeout=_get_float(environ, 'LITELLM_HTTP_WRITE_TIMEOUT', 10.0),
+            litellm_http_pool_timeout=_get_float(environ, 'LITELLM_HTTP_POOL_TIMEOUT', 10.0),
+            litellm_http2=_get_bool(environ, 'LITELLM_HTTP2', False),
+            litellm_config_path=_get_str(environ, 'LITELLM_CONFIG_PATH', DEFAULT_LITELLM_CONFIG_PATH),
+            model_pricing_path=_get_str(environ, 'MODEL_PRICING_PATH', DEFAULT_MODEL_PRICING_PATH),
+            model_registry_reload_seconds=_get_float(environ, 'MODEL_REGISTRY_RELOAD_SECONDS', 5.0),
+            free_call_limit=_get_int(environ, 'FREE_CALL_LIMIT', 5),
+            quota_backend=_get_str(environ, 'QUOTA_BACKEND', 'firestore'),
+            quota_redis_url=_get_str(environ, 'QUOTA_REDIS_URL'),
+            quota_flush_interval_seconds=_get_float(environ, 'QUOTA_FLUSH_INTERVAL_SECONDS', 5.0),
+            quota_flush_threshold=_get_int(environ, 'QUOTA_FLUSH_THRESHOLD', 500),
+            quota_max_staleness_seconds=_get_float(environ, 'QUOTA_MAX_STALENESS_SECONDS', 30.0),
+            profile_cache_size=_get_int(environ, 'PROFILE_CACHE_SIZE', 10000),
+            profile_cache_ttl_seconds=_get_float(environ, 'PROFILE_CACHE_TTL_SECONDS', 30.0),
+            profile_cache_snapshot_listener=_get_bool(environ, 'PROFILE_CACHE_SNAPSHOT_LISTENER', False),
+            response_cache_enabled=_get_bool(environ, 'RESPONSE_CACHE_ENABLED', False),
+            response_cache_ttl_seconds=_get_float(environ, 'RESPONSE_CACHE_TTL_SECONDS', 3600.0),
+            response_cache_max_bytes=_get_int(environ, 'RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+            response_cache_max_entry_bytes=_get_int(environ, 'RESPONSE_CACHE_MAX_ENTRY_BYTES', 1024 * 1024),
+            response_cache_redis_url=_get_str(environ, 'RESPONSE_CACHE_REDIS_URL'),
+            single_flight_enabled=_get_bool(environ, 'SINGLE_FLIGHT_ENABLED', False),
+            batch_max_items=_get_int(environ, 'BATCH_MAX_ITEMS', 1000),
+            batch_max_concurrency=_get_int(environ, 'BATCH_MAX_CONCURRENCY', 64),
+            batch_per_user_concurrency=_get_int(environ, 'BATCH_PER_USER_CONCURRENCY', 8),
+            model_limits=_get_json_object(environ, 'MODEL_LIMITS'),
+            model_default_max_concurrency=_get_int(environ, 'MODEL_DEFAULT_MAX_CONCURRENCY', 100),
+            model_default_tokens_per_minute=_get_int(environ, 'MODEL_DEFAULT_TOKENS_PER_MINUTE', 0),
+            model_queue_max_size=_get_int(environ, 'MODEL_QUEUE_MAX_SIZE', 200),
+            model_queue_max_wait_seconds=_get_float(environ, 'MODEL_QUEUE_MAX_WAIT_SECONDS', 30.0),
+            upstream_deadline_seconds=_get_float(environ, 'UPSTREAM_DEADLINE_SECONDS', 120.0),
+            upstream_max_attempts=_get_int(environ, 'UPSTREAM_MAX_ATTEMPTS', 3),
+            upstream_backoff_base_seconds=_get_float(environ, 'UPSTREAM_BACKOFF_BASE_SECONDS', 0.2),
+            upstream_backoff_max_seconds=_get_float(environ, 'UPSTREAM_BACKOFF_MAX_SECONDS', 2.0),
+            upstream_breaker_failure_threshold=_get_int(environ, 'UPSTREAM_BREAKER_FAILURE_THRESHOLD', 5),
+            upstream_breaker_reset_seconds=_get_float(environ, 'UPSTREAM_BREAKER_RESET_SECONDS', 30.0),
+            upstream_hedging_enabled=_get_bool(environ, 'UPSTREAM_HEDGING_ENABLED', False),
+            upstream_hedge_min_samples=_get_int(environ, 'UPSTREAM_HEDGE_MIN_SAMPLES', 20),
+            warmup_max_retry_seconds=_get_float(environ, 'WARMUP_MAX_RETRY_SECONDS', 30.0),
+            log_level=_get_str(environ, 'LOG_LEVEL', 'INFO').upper(),
+            log_format=_get_str(environ, 'LOG_FORMAT', 'json'),
+            metrics_enabled=_get_bool(environ, 'METRICS_ENABLED', True),
+            usage_rollups_max_page_size=_get_int(environ, 'USAGE_ROLLUPS_MAX_PAGE_SIZE', 500),
+        )
+
+    def check_required(self):
+        """Raises SettingsError for required values that are missing. Called at startup."""
+        if not self.firebase_service_account_key_path:
+            raise SettingsError("FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH environment variable not set.")
+
+
+@lru_cache(maxsize=None)
+def get_settings():
+    """The settings of this process, read from the .env file and the environment on first use."""
+    load_dotenv()
+    return Settings.from_environ(os.environ)
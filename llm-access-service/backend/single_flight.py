@@ -0,0 +1,169 @@
+# llm-access-service/backend/single_flight.py
+# Coalesces concurrent identical upstream calls ("single flight").
+#
+# The first request for a key (the leader) starts the LiteLLM call. Requests with the same
+# key that arrive while it is in flight (followers) wait for that call instead of starting
+# their own, and all of them get its result or its exception. For streams, the upstream
+# lines are buffered and fanned out: every subscriber gets the whole stream from the first
+# line, at its own pace.
+#
+# The upstream call runs in its own task, so a leader that disconnects does not cancel it
+# for the followers. Each caller waits for it within its own timeout, so the shared call
+# should run with the longest time budget any caller may have. A shared call or stream is
+# only cancelled once every caller is gone.
+import asyncio
+
+
+class SingleFlight:
+    """Per-process registry of in-flight upstream calls, keyed by the canonical request key."""
+
+    def __init__(self):
+        self._calls = {} # key -> SharedCall in flight
+        self._streams = {} # key -> StreamBroadcast
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key, call, timeout=None):
+        """
+        Runs `await call()` once for all concurrent callers with the same key.
+        Returns (its result, True for the caller that started the call).
+        A caller that waits longer than its `timeout` (seconds) gets asyncio.TimeoutError; the
+        call goes on for the others.
+        """
+        shared = self._calls.get(key)
+        leader = shared is None
+        if leader:
+            shared = SharedCall(call)
+            self._calls[key] = shared
+            shared.future.add_done_callback(lambda _: self._forget(self._calls, key, shared))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        shared.waiters += 1
+        try:
+            # shield: a caller that goes away must not cancel the call for the others
+            return await asyncio.wait_for(asyncio.shield(shared.future), timeout), leader
+        finally:
+            shared.waiters -= 1
+            if shared.waiters == 0 and not shared.future.done():
+                shared.future.cancel() # Nobody is waiting any more: stop paying for the call
+
+    async def stream(self, key, open_stream, timeout=None):
+        """
+        Opens `await open_stream()` (a streamed httpx response) once for all concurrent callers
+        with the same key. Returns a subscriber with aiter_lines() and aclose(), like the response,
+        whose `leader` is True for the caller that opened the stream.
+        A caller whose stream has not opened within its `timeout` (seconds) gets asyncio.TimeoutError.
+        """
+        broadcast = self._streams.get(key)
+        leader = broadcast is None
+        if leader:
+            broadcast = StreamBroadcast(open_stream)
+            self._streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda _: self._forget(self._streams, key, broadcast))
+            self.leaders += 1
+        else:
+            self.followers += 1
+        subscriber = StreamSubscriber(broadcast, leader)
+        try:
+            await asyncio.wait_for(asyncio.shield(broadcast.opened), timeout)
+        except BaseException:
+            await subscriber.aclose()
+            raise
+        return subscriber
+
+    def stats(self):
+        return {
+            'in_flight': len(self._calls) + len(self._streams),
+            'leaders': self.leaders,
+            'followers': self.followers,
+        }
+
+    @staticmethod
+    def _forget(registry, key, entry):
+        # Only remove our own entry; a newer call for the key may have started since
+        if registry.get(key) is entry:
+            del registry[key]
+
+
+class SharedCall:
+    """One upstream call in its own task, and the number of callers waiting for it."""
+
+    def __init__(self, call):
+        self.waiters = 0
+        self.future = asyncio.ensure_future(call())
+
+
+class StreamBroadcast:
+    """One upstream stream, read by a pump task into a buffer that any number of subscribers replay."""
+
+    def __init__(self, open_stream):
+        self.lines = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.opened = asyncio.get_running_loop().create_future()
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(open_stream))
+
+    async def _pump(self, open_stream):
+        upstream = None
+        try:
+            upstream = await open_stream()
+            self.opened.set_result(None)
+            async for line in upstream.aiter_lines():
+                self.lines.append(line)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = ConnectionError("Shared upstream stream was cancelled.")
+            if not self.opened.done():
+                self.opened.set_exception(self.error)
+        except Exception as e:
+            self.error = e
+            if not self.opened.done():
+                self.opened.set_exception(e)
+        finally:
+            self.done = True
+            self._notify()
+            if upstream is not None:
+                await upstream.aclose()
+
+    def _notify(self):
+        # Wake everyone waiting on the current event, and give later waiters a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_change(self):
+        await self._changed.wait()
+
+
+class StreamSubscriber:
+    """One caller's view of a StreamBroadcast, with the aiter_lines()/aclose() interface proxy_sse_stream uses."""
+
+    def __init__(self, broadcast, leader=False):
+        self.broadcast = broadcast
+        self.leader = leader
+        self.closed = False
+        broadcast.subscribers += 1
+
+    async def aiter_lines(self):
+        broadcast = self.broadcast
+        position = 0
+        while True:
+            while position < len(broadcast.lines):
+                yield broadcast.lines[position]
+                position += 1
+            if broadcast.done:
+                if broadcast.error is not None:
+                    raise broadcast.error
+                return
+            await broadcast.wait_for_change()
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.broadcast.subscribers -= 1
+        if self.broadcast.subscribers == 0 and not self.broadcast.done:
+            # Nobody is listening any more: stop paying for the upstream stream
+            self.broadcast.task.cancel()
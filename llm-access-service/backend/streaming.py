@@ -0,0 +1,85 @@
+# llm-access-service/backend/streaming.py
+import asyncio
+import json
+
+
+# Tasks started by run_detached(). The event loop only keeps weak references to tasks,
+# so a task nobody references can be garbage collected before it finishes.
+_detached_tasks = set()
+
+
+def run_detached(coro):
+    """Runs `coro` as a task that outlives the caller (e.g. a cancelled response task)."""
+    task = asyncio.ensure_future(coro)
+    _detached_tasks.add(task)
+    task.add_done_callback(_detached_tasks.discard)
+    return task
+
+class StreamUsage:
+    """
+    Tracks token usage while a LiteLLM SSE stream is proxied to the client.
+    Output tokens are counted from the streamed deltas (one content delta per token chunk);
+    if the upstream sends a final `usage` block, its numbers take precedence.
+    """
+
+    def __init__(self):
+        self.prompt_tokens = None
+        self.completion_tokens = 0
+        self.reported_completion_tokens = None
+        self.completed = False # Set when the upstream sends `data: [DONE]`
+
+    @property
+    def output_tokens(self):
+        if self.reported_completion_tokens is not None:
+            return self.reported_completion_tokens
+        return self.completion_tokens
+
+    def observe_line(self, line):
+        """Updates the counters from one SSE line (e.g. 'data: {...}')."""
+        if not line.startswith("data:"):
+            return
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            self.completed = True
+            return
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            return # Not JSON (e.g. a keep-alive comment), nothing to count
+
+        for choice in chunk.get("choices") or []:
+            delta = choice.get("delta") or {}
+            if delta.get("content") or delta.get("reasoning_content"):
+                self.completion_tokens += 1
+
+        usage = chunk.get("usage")
+        if usage:
+            self.prompt_tokens = usage.get("prompt_tokens", self.prompt_tokens)
+            self.reported_completion_tokens = usage.get("completion_tokens", self.reported_completion_tokens)
+
+
+async def proxy_sse_stream(upstream_response, usage, on_complete=None, on_incomplete=None):
+    """
+    Async generator that forwards LiteLLM's SSE lines to the client as they arrive,
+    without buffering the whole body.
+    `on_complete(usage)` is called only if the stream finished successfully
+    (upstream sent [DONE] and the client did not disconnect).
+    Otherwise `on_incomplete(usage)` is scheduled as a separate task, so it still runs
+    when the response task is cancelled by a client disconnect.
+    """
+    delivered = False
+    try:
+        async for line in upstream_response.aiter_lines():
+            usage.observe_line(line)
+            yield line + "\n"
+
+        if usage.completed:
+            delivered = True
+            if on_complete:
+                await on_complete(usage)
+    finally:
+        if not delivered and on_incomplete:
+            run_detached(on_incomplete(usage))
+        # Always release the upstream connection back to the pool,
+        # including when the client disconnects mid-stream.
+        await upstream_response.aclose()
@@ -0,0 +1,7 @@
+# llm-access-service/backend/tests/conftest.py
+# The backend modules import each other by plain name (they run from this directory),
+# so the tests put the backend directory on sys.path like the Dockerfile's WORKDIR does.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+# llm-access-service/backend/tests/test_billing_workers.py
+# Partitioned billing workers bill every usage row exactly once (benchmarks/bench_billing_workers.py).
+#
+# Needs a Postgres the test can fill and drop a schema in, given as a DSN, e.g.
+#   BILLING_TEST_POSTGRES_DSN="host=localhost user=postgres password=postgres dbname=postgres" python -m pytest
+# Skipped without one.
+import os
+
+import pytest
+
+POSTGRES_DSN = os.environ.get("BILLING_TEST_POSTGRES_DSN")
+
+pytestmark = pytest.mark.skipif(not POSTGRES_DSN, reason="BILLING_TEST_POSTGRES_DSN is not set.")
+
+ROWS = 3000
+USERS = 97
+
+
+@pytest.fixture
+def bench_database(monkeypatch):
+    """The DSN's server as POSTGRES_* variables (inherited by the worker processes), with an empty benchmark schema."""
+    psycopg2 = pytest.importorskip("psycopg2")
+    from psycopg2.extensions import parse_dsn
+
+    from benchmarks import bench_billing_workers
+    from benchmarks.fake_services import use_offline_firebase
+
+    params = parse_dsn(POSTGRES_DSN)
+    for name, key, default in (("POSTGRES_HOST", "host", "localhost"), ("POSTGRES_PORT", "port", "5432"),
+                               ("POSTGRES_USER", "user", "postgres"), ("POSTGRES_PASSWORD", "password", ""),
+                               ("POSTGRES_DB", "dbname", "postgres")):
+        monkeypatch.setenv(name, params.get(key, default))
+    monkeypatch.setenv("PGOPTIONS", f"-c search_path={bench_billing_workers.BENCH_SCHEMA}")
+    monkeypatch.delenv("FIREBASE_ADMIN_SDK_SERVICE_ACCOUNT_KEY_PATH", raising=False) # Restored afterwards
+    key_path = use_offline_firebase()
+
+    conn = psycopg2.connect(POSTGRES_DSN)
+    try:
+        bench_billing_workers.setup_schema(conn, ROWS, USERS)
+        yield conn
+    finally:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {bench_billing_workers.BENCH_SCHEMA} CASCADE;")
+        conn.commit()
+        conn.close()
+        os.unlink(key_path)
+
+
+def test_every_row_is_billed_exactly_once(bench_database):
+    from benchmarks.bench_billing_workers import run_billing_passes
+
+    # One partition per worker, then more partitions than workers (workers lock the partitions left over)
+    passes = list(run_billing_passes(bench_database, ROWS, [1, 3], chunk_size=500, commit_seconds=0))
+    passes += run_billing_passes(bench_database, ROWS, [2], partitions=3, chunk_size=500, commit_seconds=0)
+    for workers, _, ids, unprocessed, exactly_once in passes:
+        assert exactly_once, f"{workers} workers: billed {len(ids)} ({len(set(ids))} distinct), unprocessed {unprocessed}"
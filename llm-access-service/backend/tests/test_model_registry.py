@@ -0,0 +1,92 @@
+# llm-access-service/backend/tests/test_model_registry.py
+# Building the model registry from the LiteLLM config and the pricing file, and reloading it.
+import os
+
+import pytest
+
+from model_registry import (
+    ModelRegistry,
+    ModelRegistryError,
+    ModelRegistryLoader,
+    load_model_registry,
+)
+
+
+LITELLM_CONFIG = """
+model_list:
+  - model_name: gpt-4o
+    litellm_params:
+      model: openai/gpt-4o
+"""
+
+PRICING = """
+profit_margin: 0.5
+models:
+  gpt-4o: {input: 2.0, output: 8.0, max_output_tokens: 1000, tokenizer: o200k_base}
+  retired-model: {input: 1.0, output: 1.0}
+"""
+
+
+def write_files(tmp_path, config=LITELLM_CONFIG, pricing=PRICING):
+    config_path, pricing_path = tmp_path / "config.yaml", tmp_path / "model_pricing.yaml"
+    config_path.write_text(config)
+    pricing_path.write_text(pricing)
+    return str(config_path), str(pricing_path)
+
+
+def test_registry_compiles_per_token_prices_with_the_margin(tmp_path):
+    registry = load_model_registry(*write_files(tmp_path))
+    info = registry.served("gpt-4o")
+    assert info.upstream_model == "openai/gpt-4o"
+    assert info.input_price == pytest.approx(2.0 * 1.5 / 1_000_000)
+    assert info.estimate_cost(1000, 500) == pytest.approx((1000 * 2.0 + 500 * 8.0) * 1.5 / 1_000_000)
+    assert (info.max_output_tokens, info.tokenizer) == (1000, "o200k_base")
+    assert registry.tokenizers == {"o200k_base"}
+
+
+def test_priced_models_that_are_not_served_can_only_be_billed(tmp_path):
+    registry = load_model_registry(*write_files(tmp_path))
+    assert registry.get("retired-model") is not None
+    assert registry.served("retired-model") is None
+    assert registry.served_models == ("gpt-4o",)
+    assert "unknown" not in registry
+
+
+def test_served_model_without_a_price_is_an_error():
+    with pytest.raises(ModelRegistryError, match="no price: gpt-4o"):
+        ModelRegistry({}, 0.0, {"gpt-4o": "openai/gpt-4o"})
+
+
+@pytest.mark.parametrize("pricing, message", [
+    ("models: [gpt-4o]", "must map model names"),
+    ("models:\n  gpt-4o: {input: 1.0}", "no output price"),
+    ("models:\n  gpt-4o: {input: -1.0, output: 1.0}", "must not be negative"),
+    ("models:\n  gpt-4o: {input: cheap, output: 1.0}", "must be numbers"),
+    ("models: {", "Invalid YAML"),
+])
+def test_broken_pricing_files_are_rejected(tmp_path, pricing, message):
+    with pytest.raises(ModelRegistryError, match=message):
+        load_model_registry(*write_files(tmp_path, pricing=pricing))
+
+
+def test_loader_swaps_in_a_changed_registry_and_keeps_it_on_a_broken_file(tmp_path):
+    config_path, pricing_path = write_files(tmp_path)
+    loader = ModelRegistryLoader(config_path, pricing_path)
+    first = loader.current
+    assert not loader.reload_if_changed()
+
+    def rewrite(text):
+        with open(pricing_path, "w") as f:
+            f.write(text)
+        stat = os.stat(pricing_path)
+        os.utime(pricing_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000)) # A new mtime for sure
+
+    rewrite(PRICING.replace("input: 2.0", "input: 4.0"))
+    assert loader.reload_if_changed()
+    assert loader.current is not first
+    assert loader.current.get("gpt-4o").input_price == pytest.approx(4.0 * 1.5 / 1_000_000)
+
+    second = loader.current
+    rewrite("models: {")
+    assert not loader.reload_if_changed()
+    assert loader.current is second
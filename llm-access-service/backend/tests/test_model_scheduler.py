@@ -0,0 +1,119 @@
+# llm-access-service/backend/tests/test_model_scheduler.py
+# Per-model concurrency and token-rate budgets, the priority queue and its limits.
+import asyncio
+
+import pytest
+
+import model_scheduler
+from model_scheduler import (
+    PRIORITY_FREE,
+    PRIORITY_PAID,
+    ModelBudget,
+    ModelBusyError,
+    ModelScheduler,
+    estimate_request_tokens,
+)
+
+
+def test_request_tokens_default_the_completion_size():
+    assert estimate_request_tokens(100, 50) == 150
+    assert estimate_request_tokens(100) == 100 + model_scheduler.DEFAULT_COMPLETION_TOKENS
+
+
+def test_calls_over_the_concurrency_limit_wait_for_a_release():
+    async def main():
+        scheduler = ModelScheduler(default_budget=ModelBudget(max_concurrency=1))
+        first = await scheduler.acquire("m", 10)
+        waiting = asyncio.ensure_future(scheduler.acquire("m", 10))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        scheduler.release(first)
+        second = await asyncio.wait_for(waiting, 1)
+        scheduler.release(second)
+        scheduler.release(second) # A second release is ignored
+        return scheduler.stats()["m"]
+
+    stats = asyncio.run(main())
+    assert (stats['in_flight'], stats['started'], stats['queued']) == (0, 2, 1)
+
+
+def test_budgets_are_per_model():
+    async def main():
+        scheduler = ModelScheduler(budgets={"small": ModelBudget(max_concurrency=1)},
+                                   default_budget=ModelBudget(max_concurrency=5))
+        await scheduler.acquire("small", 10)
+        return [await asyncio.wait_for(scheduler.acquire("other", 10), 1) for _ in range(5)]
+
+    assert len(asyncio.run(main())) == 5
+
+
+def test_paid_calls_are_started_before_free_calls():
+    async def main():
+        scheduler = ModelScheduler(default_budget=ModelBudget(max_concurrency=1))
+        started = []
+
+        async def call(name, priority):
+            ticket = await scheduler.acquire("m", 10, priority)
+            started.append(name)
+            scheduler.release(ticket)
+
+        first = await scheduler.acquire("m", 10)
+        calls = [asyncio.ensure_future(call("free", PRIORITY_FREE)), asyncio.ensure_future(call("paid", PRIORITY_PAID))]
+        await asyncio.sleep(0)
+        scheduler.release(first)
+        await asyncio.gather(*calls)
+        return started
+
+    assert asyncio.run(main()) == ["paid", "free"]
+
+
+def test_a_full_queue_rejects_with_retry_after():
+    async def main():
+        scheduler = ModelScheduler(default_budget=ModelBudget(max_concurrency=1), max_queue=1)
+        await scheduler.acquire("m", 10)
+        waiting = asyncio.ensure_future(scheduler.acquire("m", 10))
+        await asyncio.sleep(0)
+        try:
+            with pytest.raises(ModelBusyError) as error:
+                await scheduler.acquire("m", 10)
+            return error.value.retry_after, scheduler.stats()["m"]['rejected']
+        finally:
+            waiting.cancel()
+
+    retry_after, rejected = asyncio.run(main())
+    assert retry_after >= 1
+    assert rejected == 1
+
+
+def test_waiting_longer_than_max_wait_gives_up():
+    async def main():
+        scheduler = ModelScheduler(default_budget=ModelBudget(max_concurrency=1), max_wait=0.01)
+        await scheduler.acquire("m", 10)
+        with pytest.raises(ModelBusyError):
+            await scheduler.acquire("m", 10)
+        return scheduler.stats()["m"]
+
+    stats = asyncio.run(main())
+    assert (stats['timeouts'], stats['queue_depth']) == (1, 0)
+
+
+def test_token_rate_limit_waits_for_the_bucket_to_refill():
+    async def main():
+        scheduler = ModelScheduler(default_budget=ModelBudget(tokens_per_minute=60000))
+        scheduler.release(await scheduler.acquire("m", 60000)) # Empties the bucket
+        waiting = asyncio.ensure_future(scheduler.acquire("m", 100)) # Refilled in 0.1 s
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        return await asyncio.wait_for(waiting, 2)
+
+    assert asyncio.run(main()).tokens == 100
+
+
+def test_release_corrects_the_bucket_to_the_actual_usage():
+    async def main():
+        scheduler = ModelScheduler(default_budget=ModelBudget(tokens_per_minute=1000))
+        ticket = await scheduler.acquire("m", 800)
+        scheduler.release(ticket, actual_tokens=100)
+        return scheduler._queue("m").tokens
+
+    assert asyncio.run(main()) == pytest.approx(900, abs=1)
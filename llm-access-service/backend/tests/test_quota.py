@@ -0,0 +1,217 @@
+# llm-access-service/backend/tests/test_quota.py
+# The quota policy (apply_quota, apply_quota_batch) and the in-memory engine that applies it.
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from quota import (
+    BALANCE_HOLD_TTL_SECONDS,
+    FirestoreQuotaEngine,
+    InMemoryQuotaEngine,
+    InsufficientBalanceError,
+    QuotaExceededError,
+    apply_quota,
+    apply_quota_batch,
+    held_balance,
+)
+
+
+TODAY = date(2026, 3, 10)
+FREE_CALL_LIMIT = 5
+
+
+def midnight(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def test_free_call_counts_against_today():
+    user = {'freeCallsToday': 2, 'lastFreeCallDate': midnight(TODAY), 'balance': 1.0}
+    fields, updates = apply_quota(user, TODAY, FREE_CALL_LIMIT)
+    assert fields == (True, 3, 1.0, 0.0, None)
+    assert updates == {'freeCallsToday': 3, 'lastFreeCallDate': midnight(TODAY)}
+
+
+def test_new_day_starts_free_calls_from_zero():
+    user = {'freeCallsToday': FREE_CALL_LIMIT, 'lastFreeCallDate': midnight(TODAY - timedelta(days=1))}
+    fields, updates = apply_quota(user, TODAY, FREE_CALL_LIMIT)
+    assert fields[:2] == (True, 1)
+    assert updates['freeCallsToday'] == 1
+
+
+def test_first_call_of_a_new_user_is_free():
+    fields, updates = apply_quota({}, TODAY, FREE_CALL_LIMIT)
+    assert fields[:2] == (True, 1)
+    assert updates['lastFreeCallDate'] == midnight(TODAY)
+
+
+def test_paid_call_without_cost_needs_no_write():
+    user = {'freeCallsToday': FREE_CALL_LIMIT, 'lastFreeCallDate': midnight(TODAY), 'balance': 0.5}
+    fields, updates = apply_quota(user, TODAY, FREE_CALL_LIMIT)
+    assert fields == (False, FREE_CALL_LIMIT, 0.5, 0.0, None)
+    assert updates == {}
+
+
+def test_no_free_calls_and_no_balance_is_rejected():
+    user = {'freeCallsToday': FREE_CALL_LIMIT, 'lastFreeCallDate': midnight(TODAY), 'balance': 0}
+    with pytest.raises(QuotaExceededError):
+        apply_quota(user, TODAY, FREE_CALL_LIMIT)
+
+
+def test_batch_grants_free_calls_then_paid_calls():
+    user = {'freeCallsToday': FREE_CALL_LIMIT - 2, 'lastFreeCallDate': midnight(TODAY), 'balance': 1.0}
+    granted, updates = apply_quota_batch(user, TODAY, FREE_CALL_LIMIT, 4)
+    assert [fields[0] for fields in granted] == [True, True, False, False]
+    assert updates['freeCallsToday'] == FREE_CALL_LIMIT
+
+
+def test_batch_stops_where_the_quota_runs_out():
+    user = {'freeCallsToday': FREE_CALL_LIMIT - 2, 'lastFreeCallDate': midnight(TODAY), 'balance': 0}
+    granted, updates = apply_quota_batch(user, TODAY, FREE_CALL_LIMIT, 4)
+    assert len(granted) == 2
+    assert updates['freeCallsToday'] == FREE_CALL_LIMIT
+
+
+def test_batch_without_any_call_left_raises():
+    user = {'freeCallsToday': FREE_CALL_LIMIT, 'lastFreeCallDate': midnight(TODAY), 'balance': 0}
+    with pytest.raises(QuotaExceededError):
+        apply_quota_batch(user, TODAY, FREE_CALL_LIMIT, 3)
+
+
+def test_concurrent_reservations_do_not_overspend_the_free_calls():
+    users = {'u': {'balance': 0}}
+    engine = InMemoryQuotaEngine(FREE_CALL_LIMIT, users=users)
+
+    async def reserve_all():
+        return await asyncio.gather(*[engine.reserve('u', TODAY) for _ in range(FREE_CALL_LIMIT * 2)],
+                                    return_exceptions=True)
+
+    results = asyncio.run(reserve_all())
+    assert sum(not isinstance(result, Exception) for result in results) == FREE_CALL_LIMIT
+    assert all(isinstance(result, QuotaExceededError) for result in results if isinstance(result, Exception))
+    assert users['u']['freeCallsToday'] == FREE_CALL_LIMIT
+
+
+def test_refund_gives_the_free_call_back():
+    users = {'u': {}}
+    engine = InMemoryQuotaEngine(FREE_CALL_LIMIT, users=users)
+    reservation = asyncio.run(engine.reserve('u', TODAY))
+    asyncio.run(engine.refund(reservation))
+    assert users['u']['freeCallsToday'] == 0
+
+
+def test_refund_after_the_day_changed_keeps_the_new_count():
+    users = {'u': {}}
+    engine = InMemoryQuotaEngine(FREE_CALL_LIMIT, users=users)
+    reservation = asyncio.run(engine.reserve('u', TODAY))
+    asyncio.run(engine.reserve('u', TODAY + timedelta(days=1)))
+    asyncio.run(engine.refund(reservation))
+    assert users['u']['freeCallsToday'] == 1
+
+
+# --- Balance Holds ---
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def paid_user(balance, held=0.0, held_at=NOW):
+    holds = {'h0': {'amount': held, 'expiresAt': held_at + timedelta(seconds=BALANCE_HOLD_TTL_SECONDS)}} if held else {}
+    return {'freeCallsToday': FREE_CALL_LIMIT, 'lastFreeCallDate': midnight(TODAY), 'balance': balance,
+            'balanceHolds': holds}
+
+
+def test_paid_call_holds_its_maximum_cost():
+    fields, updates = apply_quota(paid_user(1.0, held=0.25), TODAY, FREE_CALL_LIMIT, cost=0.5, now=NOW)
+    hold_id = fields[4]
+    assert fields == (False, FREE_CALL_LIMIT, 0.75, 0.5, hold_id)
+    assert updates['balanceHolds'][hold_id] == {'amount': 0.5, 'expiresAt': NOW + timedelta(seconds=BALANCE_HOLD_TTL_SECONDS)}
+    assert held_balance(updates, NOW) == 0.75
+
+
+def test_paid_call_over_the_available_balance_is_rejected():
+    with pytest.raises(InsufficientBalanceError) as error:
+        apply_quota(paid_user(1.0, held=0.75), TODAY, FREE_CALL_LIMIT, cost=0.5, now=NOW)
+    assert error.value.available == pytest.approx(0.25)
+    assert error.value.cost == 0.5
+
+
+def test_holds_lapse_after_their_ttl():
+    lapsed_at = NOW - timedelta(seconds=BALANCE_HOLD_TTL_SECONDS + 1)
+    assert held_balance(paid_user(1.0, held=0.75, held_at=lapsed_at), NOW) == 0
+    assert held_balance(paid_user(1.0, held=0.75), NOW) == 0.75
+    fields, updates = apply_quota(paid_user(1.0, held=0.75, held_at=lapsed_at), TODAY, FREE_CALL_LIMIT, cost=0.5, now=NOW)
+    assert fields[3] == 0.5
+    assert list(updates['balanceHolds']) == [fields[4]] # The lapsed hold is dropped
+
+
+def test_a_lost_hold_lapses_while_new_holds_are_placed():
+    user = paid_user(1.0, held=0.75, held_at=NOW) # Never settled
+    for minute in range(1, 20):
+        now = NOW + timedelta(minutes=minute)
+        fields, updates = apply_quota(user, TODAY, FREE_CALL_LIMIT, cost=0.1, now=now)
+        user.update(updates)
+        user['balanceHolds'].pop(fields[4]) # Settled
+    assert held_balance(user, now) == 0
+
+
+def test_batch_holds_calls_while_the_balance_covers_them():
+    granted, updates = apply_quota_batch(paid_user(1.0), TODAY, FREE_CALL_LIMIT, 4, costs=[0.4, 0.4, 0.4, 0.1])
+    assert [fields[3] for fields in granted] == [0.4, 0.4]
+    assert held_balance(updates, NOW) == pytest.approx(0.8)
+
+
+def test_settle_charges_the_actual_cost_and_releases_the_hold():
+    users = {'u': paid_user(1.0)}
+    engine = InMemoryQuotaEngine(FREE_CALL_LIMIT, users=users)
+    reservation = asyncio.run(engine.reserve('u', TODAY, cost=0.5))
+    assert users['u']['balanceHolds'][reservation.hold_id]['amount'] == 0.5
+    asyncio.run(engine.settle(reservation, 0.125))
+    assert users['u']['balance'] == pytest.approx(0.875)
+    assert users['u']['balanceHolds'] == {}
+
+
+def test_refund_releases_the_hold_without_charging():
+    users = {'u': paid_user(1.0)}
+    engine = InMemoryQuotaEngine(FREE_CALL_LIMIT, users=users)
+    reservation = asyncio.run(engine.reserve('u', TODAY, cost=0.5))
+    asyncio.run(engine.refund(reservation))
+    assert users['u']['balance'] == 1.0
+    assert users['u']['balanceHolds'] == {}
+
+
+def test_concurrent_holds_do_not_overspend_the_balance():
+    users = {'u': paid_user(1.0)}
+    engine = InMemoryQuotaEngine(FREE_CALL_LIMIT, users=users)
+
+    async def reserve_all():
+        return await asyncio.gather(*[engine.reserve('u', TODAY, cost=0.3) for _ in range(5)], return_exceptions=True)
+
+    results = asyncio.run(reserve_all())
+    assert sum(not isinstance(result, Exception) for result in results) == 3
+    assert held_balance(users['u'], datetime.now(timezone.utc)) == pytest.approx(0.9)
+
+
+class CachedProfiles:
+    """Just the peek() of UserProfileCache."""
+
+    def __init__(self, users):
+        self.users = users
+
+    def peek(self, user_id):
+        return self.users.get(user_id)
+
+
+class UnreachableFirestore:
+    def collection(self, name):
+        raise AssertionError("The call should have been decided from the cached profile.")
+
+
+def test_firestore_engine_rejects_uncovered_holds_from_the_cached_profile():
+    profiles = CachedProfiles({'u': paid_user(1.0, held=0.75, held_at=datetime.now(timezone.utc))})
+    engine = FirestoreQuotaEngine(UnreachableFirestore(), FREE_CALL_LIMIT, profile_cache=profiles)
+    with pytest.raises(InsufficientBalanceError):
+        asyncio.run(engine.reserve('u', TODAY, cost=0.5))
+    with pytest.raises(InsufficientBalanceError):
+        asyncio.run(engine.reserve_many('u', 2, TODAY, costs=[0.5, 0.5]))
+    # A hold the cached balance covers needs the transaction
+    with pytest.raises(AssertionError):
+        asyncio.run(engine.reserve('u', TODAY, cost=0.125))
@@ -0,0 +1,64 @@
+# llm-access-service/backend/tests/test_response_cache.py
+# The response cache key, which requests are cacheable, and the in-memory tier's TTL and size bound.
+import asyncio
+
+import response_cache
+from response_cache import ResponseCache, is_cacheable_request, response_cache_key
+
+
+PAYLOAD = {"model": "gpt-4o", "messages": [{"role": "user", "content": "hello"}], "temperature": 0}
+
+
+def test_key_ignores_the_caller_and_the_field_order():
+    reordered = {"temperature": 0, "messages": [{"content": "hello", "role": "user"}], "model": "gpt-4o"}
+    assert response_cache_key(PAYLOAD) == response_cache_key(reordered)
+    assert response_cache_key(PAYLOAD) == response_cache_key(dict(PAYLOAD, user="someone-else"))
+    assert response_cache_key(PAYLOAD) == response_cache_key(dict(PAYLOAD, seed=None)) # Unset = absent
+
+
+def test_key_changes_with_anything_that_changes_the_answer():
+    key = response_cache_key(PAYLOAD)
+    assert response_cache_key(dict(PAYLOAD, model="gpt-4o-mini")) != key
+    assert response_cache_key(dict(PAYLOAD, max_tokens=10)) != key
+    assert response_cache_key(dict(PAYLOAD, messages=[{"role": "user", "content": "hello!"}])) != key
+
+
+def test_only_deterministic_non_streaming_requests_are_cacheable():
+    assert is_cacheable_request(PAYLOAD, stream=False)
+    assert not is_cacheable_request(PAYLOAD, stream=True)
+    assert not is_cacheable_request(PAYLOAD, stream=False, cache_header="bypass")
+    assert not is_cacheable_request(dict(PAYLOAD, temperature=0.7), stream=False)
+    assert is_cacheable_request(dict(PAYLOAD, temperature=0.7), stream=False, cache_header=" Use ")
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, 'monotonic', lambda: now[0])
+    cache = ResponseCache(ttl=60)
+
+    async def main():
+        await cache.set("key", b"body")
+        now[0] += 59
+        fresh = await cache.get("key")
+        now[0] += 1
+        return fresh, await cache.get("key")
+
+    assert asyncio.run(main()) == (b"body", None)
+    assert cache.stats()['entries'] == 0
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted_by_size():
+    cache = ResponseCache(max_bytes=10, max_entry_bytes=8)
+
+    async def main():
+        await cache.set("a", b"aaaa")
+        await cache.set("b", b"bbbb")
+        await cache.get("a") # Now "b" is the least recently used
+        await cache.set("c", b"cccc")
+        await cache.set("too-big", b"x" * 9) # Over max_entry_bytes: not stored
+        return [await cache.get(key) for key in ("a", "b", "c", "too-big")]
+
+    assert asyncio.run(main()) == [b"aaaa", None, b"cccc", None]
+    assert cache.stats()['bytes'] == 8
+    assert cache.stats()['evictions'] == 1
@@ -0,0 +1,150 @@
+# llm-access-service/backend/tests/test_single_flight.py
+# Coalescing of identical concurrent upstream calls and streams.
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+class FakeStream:
+    """A streamed response whose lines are released one by one through a queue."""
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    async def aiter_lines(self):
+        while True:
+            line = await self.queue.get()
+            if line is None:
+                return
+            yield line
+
+    async def aclose(self):
+        self.closed = True
+
+
+def test_followers_share_the_leaders_call():
+    calls = []
+
+    async def main():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def call():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        waiters = [asyncio.ensure_future(flight.do("key", call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*waiters), flight.stats()
+
+    results, stats = asyncio.run(main())
+    assert calls == [1]
+    assert results == [("result", True), ("result", False), ("result", False)]
+    assert stats == {'in_flight': 0, 'leaders': 1, 'followers': 2}
+
+
+def test_followers_get_the_leaders_exception():
+    async def main():
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0)
+            raise ValueError("upstream failed")
+
+        return await asyncio.gather(*(flight.do("key", call) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert [type(result) for result in results] == [ValueError, ValueError]
+
+
+def test_a_caller_that_times_out_does_not_cancel_the_call_for_the_others():
+    async def main():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def call():
+            await release.wait()
+            return "result"
+
+        patient = asyncio.ensure_future(flight.do("key", call))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await flight.do("key", call, timeout=0.01)
+        release.set()
+        return await patient
+
+    assert asyncio.run(main()) == ("result", True)
+
+
+def test_the_call_is_cancelled_once_every_caller_is_gone():
+    async def main():
+        flight = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def call():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        with pytest.raises(asyncio.TimeoutError):
+            await flight.do("key", call, timeout=0.01)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flight.stats()['in_flight']
+
+    assert asyncio.run(main()) == 0
+
+
+def test_stream_lines_are_fanned_out_to_every_subscriber():
+    async def main():
+        flight = SingleFlight()
+        upstream = FakeStream()
+        opens = []
+
+        async def open_stream():
+            opens.append(1)
+            return upstream
+
+        async def read(subscriber):
+            return subscriber.leader, [line async for line in subscriber.aiter_lines()]
+
+        leader = await flight.stream("key", open_stream)
+        await upstream.queue.put("data: 1")
+        await asyncio.sleep(0)
+        follower = await flight.stream("key", open_stream) # Joins late, still gets the first line
+        readers = [asyncio.ensure_future(read(subscriber)) for subscriber in (leader, follower)]
+        await upstream.queue.put("data: 2")
+        await upstream.queue.put(None)
+        return opens, await asyncio.gather(*readers), upstream.closed
+
+    opens, results, closed = asyncio.run(main())
+    assert opens == [1]
+    assert results == [(True, ["data: 1", "data: 2"]), (False, ["data: 1", "data: 2"])]
+    assert closed
+
+
+def test_stream_is_cancelled_once_every_subscriber_closed():
+    async def main():
+        flight = SingleFlight()
+        upstream = FakeStream()
+
+        async def open_stream():
+            return upstream
+
+        first = await flight.stream("key", open_stream)
+        second = await flight.stream("key", open_stream)
+        await first.aclose()
+        await asyncio.sleep(0)
+        assert not upstream.closed # Still read for the second subscriber
+        await second.aclose()
+        for _ in range(3):
+            await asyncio.sleep(0)
+        return upstream.closed, flight.stats()['in_flight']
+
+    assert asyncio.run(main()) == (True, 0)
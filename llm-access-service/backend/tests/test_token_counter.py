@@ -0,0 +1,67 @@
+# llm-access-service/backend/tests/test_token_counter.py
+# Prompt token counting: the chat format overhead, the length estimate and the memoized counts.
+import pytest
+
+import token_counter
+from token_counter import (
+    TOKENS_PER_MESSAGE,
+    TOKENS_PER_REPLY,
+    count_prompt_tokens,
+    count_text_tokens,
+    estimate_text_tokens,
+)
+
+
+class WordEncoding:
+    """Stands in for a tiktoken Encoding: one token per word."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text, disallowed_special=()):
+        self.calls += 1
+        return text.split()
+
+
+@pytest.fixture
+def words(monkeypatch):
+    encoding = WordEncoding()
+    monkeypatch.setitem(token_counter._encodings, "words", encoding)
+    token_counter._count_memoized.cache_clear()
+    yield encoding
+    token_counter._count_memoized.cache_clear()
+
+
+def test_unloaded_encodings_estimate_one_token_per_3_bytes():
+    assert estimate_text_tokens("") == 0
+    assert estimate_text_tokens("abcd") == 2
+    assert estimate_text_tokens("日本") == 2 # 6 bytes of UTF-8
+    assert count_text_tokens("abcdef", "not-loaded") == 2
+
+
+def test_prompt_counts_every_string_field_and_the_format_overhead(words):
+    messages = [
+        {"role": "system", "content": "be brief"},
+        {"role": "user", "name": "alice", "content": [{"type": "text", "text": "hello there"}, {"type": "image_url"}]},
+    ]
+    # Words: system + be brief, user + alice + hello there
+    assert count_prompt_tokens(messages, "words") == TOKENS_PER_REPLY + 2 * TOKENS_PER_MESSAGE + 3 + 4
+
+
+def test_non_dict_messages_only_count_the_overhead(words):
+    assert count_prompt_tokens(["junk"], "words") == TOKENS_PER_REPLY + TOKENS_PER_MESSAGE
+
+
+def test_repeated_texts_are_counted_once(words):
+    messages = [{"role": "user", "content": "the same system prompt"}]
+    for _ in range(3):
+        count_prompt_tokens(messages, "words")
+    assert words.calls == 2 # "user" and the content, once each
+    assert token_counter.text_cache_stats()['hits'] == 4
+
+
+def test_long_texts_are_not_memoized(words):
+    text = "word " * (token_counter.MAX_MEMOIZED_CHARS // 5 + 1)
+    for _ in range(2):
+        assert count_text_tokens(text, "words") == token_counter.MAX_MEMOIZED_CHARS // 5 + 1
+    assert words.calls == 2
@@ -0,0 +1,77 @@
+# llm-access-service/backend/tests/test_token_verifier.py
+# Local verification of Firebase ID tokens, signed here with a generated RSA keypair.
+import asyncio
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from token_verifier import CachedTokenVerifier, StaticKeyProvider, TokenVerificationError
+
+
+PROJECT_ID = "test-project"
+KID = "test-kid"
+PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+class CountingKeyProvider(StaticKeyProvider):
+    """Counts the key lookups, one per token that is actually verified."""
+
+    def __init__(self, keys):
+        super().__init__(keys)
+        self.lookups = 0
+
+    async def get_key(self, kid):
+        self.lookups += 1
+        return await super().get_key(kid)
+
+
+def make_token(kid=KID, audience=PROJECT_ID, issuer=f"https://securetoken.google.com/{PROJECT_ID}",
+               expires_in=3600, sub="user-1"):
+    now = int(time.time())
+    claims = {'aud': audience, 'iss': issuer, 'sub': sub, 'iat': now - 10, 'exp': now + expires_in}
+    return jwt.encode(claims, PRIVATE_KEY, algorithm='RS256', headers={'kid': kid})
+
+
+def make_verifier():
+    return CachedTokenVerifier(PROJECT_ID, CountingKeyProvider({KID: PRIVATE_KEY.public_key()}))
+
+
+def test_valid_token_returns_its_claims_with_the_uid():
+    claims = asyncio.run(make_verifier().verify(make_token()))
+    assert claims['uid'] == claims['sub'] == "user-1"
+
+
+@pytest.mark.parametrize("token, message", [
+    (make_token(expires_in=-60), "expired"),
+    (make_token(audience="other-project"), "invalid"),
+    (make_token(issuer="https://securetoken.google.com/other-project"), "invalid"),
+    (make_token(kid="unknown-kid"), "unknown signing key"),
+    ("not-a-token", "invalid"),
+], ids=["expired", "wrong audience", "wrong issuer", "unknown kid", "malformed"])
+def test_bad_tokens_are_rejected(token, message):
+    with pytest.raises(TokenVerificationError, match=message):
+        asyncio.run(make_verifier().verify(token))
+
+
+def test_verified_tokens_are_served_from_the_cache():
+    verifier = make_verifier()
+    token = make_token()
+
+    async def verify_twice():
+        return await verifier.verify(token), await verifier.verify(token)
+
+    first, second = asyncio.run(verify_twice())
+    assert first is second
+    assert verifier.key_provider.lookups == 1
+
+
+def test_cached_tokens_still_expire():
+    verifier = make_verifier()
+    token = make_token(expires_in=1)
+    asyncio.run(verifier.verify(token))
+    verifier._cache[next(iter(verifier._cache))]['exp'] = time.time() - 1 # As if the token's time ran out
+    with pytest.raises(TokenVerificationError, match="expired"):
+        asyncio.run(verifier.verify(token))
+    assert not verifier._cache
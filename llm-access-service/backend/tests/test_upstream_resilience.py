@@ -0,0 +1,188 @@
+# llm-access-service/backend/tests/test_upstream_resilience.py
+# Retries, deadlines, hedging and the per-model circuit breaker around LiteLLM calls.
+import asyncio
+
+import httpx
+import pytest
+
+from model_scheduler import ModelBusyError
+from upstream_resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Deadline,
+    DeadlineExceededError,
+    UpstreamResilience,
+)
+
+
+def status_error(status_code, headers=None):
+    request = httpx.Request("POST", "http://litellm/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status_code}", request=request, response=response)
+
+
+def failing_attempts(*outcomes):
+    """An attempt() that raises (or returns) the given outcomes in order, and records its calls."""
+    calls = []
+
+    async def attempt():
+        outcome = outcomes[len(calls)]
+        calls.append(outcome)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    return attempt, calls
+
+
+def make_resilience(**kwargs):
+    kwargs.setdefault('backoff_base', 0.001)
+    kwargs.setdefault('backoff_max', 0.001)
+    return UpstreamResilience(**kwargs)
+
+
+# --- Circuit Breaker ---
+def test_breaker_opens_after_consecutive_failures_and_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success() # A success resets the count
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert (breaker.state, breaker.times_opened) == ('open', 1)
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call("m")
+    assert 1 <= error.value.retry_after <= 30
+
+
+def test_breaker_lets_one_trial_call_through_after_the_reset_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    breaker.before_call("m") # The trial call
+    assert breaker.state == 'half-open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call("m") # Only one trial at a time
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call("m")
+
+
+def test_failed_trial_call_opens_the_breaker_again():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+    breaker.opened_at -= 30
+    breaker.before_call("m")
+    breaker.record_failure()
+    assert (breaker.state, breaker.times_opened) == ('open', 2)
+
+
+def test_cancelled_trial_call_allows_another_one():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    breaker.before_call("m")
+    breaker.record_other()
+    breaker.before_call("m")
+    assert breaker.state == 'half-open'
+
+
+# --- Retries ---
+def test_connect_errors_and_5xx_are_retried():
+    resilience = make_resilience(max_attempts=3)
+    attempt, calls = failing_attempts(httpx.ConnectError("refused"), status_error(503), "answer")
+    assert asyncio.run(resilience.call("m", Deadline(5), attempt)) == "answer"
+    assert len(calls) == 3
+    assert resilience.stats()['retries'] == 2
+    assert resilience.stats()['breakers']["m"]['failures'] == 0
+
+
+def test_client_errors_and_read_timeouts_are_not_retried():
+    for error in (status_error(400), httpx.ReadTimeout("slow")):
+        attempt, calls = failing_attempts(error, "answer")
+        with pytest.raises(type(error)):
+            asyncio.run(make_resilience().call("m", Deadline(5), attempt))
+        assert len(calls) == 1
+
+
+def test_the_last_error_is_raised_once_the_attempts_are_used_up():
+    resilience = make_resilience(max_attempts=2, failure_threshold=5)
+    attempt, calls = failing_attempts(status_error(502), status_error(503))
+    with pytest.raises(httpx.HTTPStatusError) as error:
+        asyncio.run(resilience.call("m", Deadline(5), attempt))
+    assert error.value.response.status_code == 503
+    assert resilience.stats()['breakers']["m"]['failures'] == 2
+
+
+def test_no_retry_if_the_retry_after_does_not_fit_in_the_deadline():
+    attempt, calls = failing_attempts(status_error(429, headers={"Retry-After": "10"}), "answer")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(make_resilience().call("m", Deadline(1), attempt))
+    assert len(calls) == 1
+
+
+def test_429_does_not_count_against_the_breaker():
+    resilience = make_resilience(max_attempts=1, failure_threshold=1)
+    attempt, _ = failing_attempts(status_error(429))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(resilience.call("m", Deadline(5), attempt))
+    assert resilience.stats()['breakers']["m"]['state'] == 'closed'
+
+
+def test_open_breaker_fails_fast_without_calling_upstream():
+    resilience = make_resilience(max_attempts=1, failure_threshold=1)
+    attempt, calls = failing_attempts(status_error(500), "answer")
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(resilience.call("m", Deadline(5), attempt))
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(resilience.call("m", Deadline(5), attempt))
+    assert len(calls) == 1
+    assert isinstance(CircuitOpenError("", 1), ModelBusyError) # Answered like a busy model (503)
+
+
+# --- Deadlines ---
+def test_attempts_are_cut_off_at_the_deadline():
+    resilience = make_resilience()
+
+    async def attempt():
+        await asyncio.sleep(10)
+
+    with pytest.raises(DeadlineExceededError):
+        asyncio.run(resilience.call("m", Deadline(0.01), attempt))
+    assert resilience.stats()['deadlines_exceeded'] == 1
+
+
+def test_missed_deadlines_do_not_open_the_breaker():
+    resilience = make_resilience(failure_threshold=2)
+
+    async def attempt():
+        await asyncio.sleep(10)
+
+    for _ in range(3):
+        with pytest.raises(DeadlineExceededError):
+            asyncio.run(resilience.call("m", Deadline(0.01), attempt))
+    assert resilience.stats()['breakers']["m"] == {'state': 'closed', 'failures': 0, 'times_opened': 0}
+
+
+# --- Hedging ---
+def test_slow_attempt_is_hedged_and_the_first_answer_wins():
+    resilience = make_resilience(hedging=True, hedge_min_samples=1)
+    resilience._latency("m").add(0.01) # Recent calls took 10 ms
+    started = []
+
+    async def attempt():
+        started.append(len(started))
+        if len(started) == 1:
+            await asyncio.sleep(10) # The first attempt hangs
+        return f"answer {len(started)}"
+
+    assert asyncio.run(resilience.call("m", Deadline(5), attempt, hedge=True)) == "answer 2"
+    assert (resilience.stats()['hedges'], resilience.stats()['hedge_wins']) == (1, 1)
+
+
+def test_no_hedging_without_enough_latency_samples():
+    resilience = make_resilience(hedging=True, hedge_min_samples=20)
+    attempt, calls = failing_attempts("answer")
+    assert asyncio.run(resilience.call("m", Deadline(5), attempt, hedge=True)) == "answer"
+    assert resilience.stats()['hedges'] == 0
@@ -0,0 +1,74 @@
+# llm-access-service/backend/tests/test_usage_costing.py
+# The billing job's vectorized pricing of usage chunks, checked against the API's per-call prices.
+import random
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+
+from model_registry import ModelRegistry
+from usage_costing import price_chunk
+
+
+PRICING = {
+    "gpt-4o": {"input": 15.0, "output": 60.0},
+    "deepseek-r1": {"input": 0.55, "output": 1.10},
+}
+REGISTRY = ModelRegistry(PRICING, 0.3, {"gpt-4o": "openai/gpt-4o", "deepseek-r1": "novita/deepseek/deepseek-r1"})
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def usage_row(record_id, user_id="u1", model="gpt-4o", prompt_tokens=100, completion_tokens=50, request_id=None):
+    return (record_id, user_id, model, prompt_tokens, completion_tokens, NOW, request_id)
+
+
+def test_vectorized_costs_match_the_scalar_cost_of_every_row():
+    rng = random.Random(7)
+    rows = [
+        usage_row(f"r{i}", f"u{rng.randrange(5)}", rng.choice(list(PRICING)), rng.randrange(20000), rng.randrange(4000))
+        for i in range(500)
+    ]
+    chunk, skipped = price_chunk(rows, REGISTRY.price_table)
+    expected = [REGISTRY.get(model).estimate_cost(prompt, completion) for _, _, model, prompt, completion, _, _ in rows]
+    assert skipped == []
+    np.testing.assert_allclose(chunk.costs, expected, rtol=1e-12)
+
+
+def test_unknown_models_and_missing_token_counts_cost_nothing():
+    rows = [usage_row("r1", model="not-priced"), usage_row("r2", prompt_tokens=None, completion_tokens=None)]
+    chunk, _ = price_chunk(rows, REGISTRY.price_table)
+    assert chunk.costs.tolist() == [0.0, 0.0]
+
+
+def test_rows_without_a_user_are_skipped():
+    rows = [usage_row("r1"), usage_row("r2", user_id=None), usage_row("r3", user_id="", request_id="req-3")]
+    chunk, skipped = price_chunk(rows, REGISTRY.price_table)
+    assert skipped == ["r2", "r3"]
+    assert chunk.record_ids == ["r1"]
+    assert chunk.request_ids == [None]
+
+
+def test_aggregates_sum_calls_tokens_and_costs_per_user_and_model():
+    rows = [
+        usage_row("r1", "a", "gpt-4o", 100, 10),
+        usage_row("r2", "a", "gpt-4o", 200, 20),
+        usage_row("r3", "a", "deepseek-r1", 300, 30),
+        usage_row("r4", "b", "gpt-4o", 400, 40),
+    ]
+    chunk, _ = price_chunk(rows, REGISTRY.price_table)
+    aggregates = chunk.aggregates()
+    totals = {
+        (user_id, model): (calls, input_tokens, output_tokens, cost)
+        for user_id, model, calls, input_tokens, output_tokens, cost in zip(
+            aggregates['user_id'], aggregates['model'], aggregates['calls'],
+            aggregates['input_tokens'], aggregates['output_tokens'], aggregates['cost'])
+    }
+    assert totals[("a", "gpt-4o")][:3] == (2, 300, 30)
+    assert totals[("a", "gpt-4o")][3] == pytest.approx(REGISTRY.get("gpt-4o").estimate_cost(300, 30))
+    assert totals[("a", "deepseek-r1")][:3] == (1, 300, 30)
+    assert totals[("b", "gpt-4o")][:3] == (1, 400, 40)
+
+
+def test_empty_chunk():
+    chunk, skipped = price_chunk([], REGISTRY.price_table)
+    assert (len(chunk), skipped) == (0, [])
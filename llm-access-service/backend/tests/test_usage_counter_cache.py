@@ -0,0 +1,255 @@
+# llm-access-service/backend/tests/test_usage_counter_cache.py
+# The write-behind quota engine against an in-memory stand-in for the Firestore client.
+import asyncio
+import threading
+from datetime import date, datetime
+
+import pytest
+from firebase_admin import firestore
+
+import usage_counter_cache
+from quota import InsufficientBalanceError
+from usage_counter_cache import WriteBehindQuotaEngine
+
+
+TODAY = date(2026, 3, 10)
+FREE_CALL_LIMIT = 5
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db, doc_id):
+        self.db = db
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        return FakeSnapshot(self.db.docs.get(self.id))
+
+
+class FakeCollection:
+    def __init__(self, db):
+        self.db = db
+
+    def document(self, doc_id):
+        return FakeDocument(self.db, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def update(self, ref, updates):
+        self.writes.append((ref.id, updates))
+
+    def commit(self):
+        if self.db.failing_commits:
+            self.db.failing_commits -= 1
+            raise RuntimeError("Firestore is unavailable.")
+        for doc_id, updates in self.writes:
+            doc = self.db.docs[doc_id]
+            for field, value in updates.items():
+                if isinstance(value, firestore.Increment):
+                    value = (doc.get(field) or 0) + value.value
+                doc[field] = value
+        self.db.commits += 1
+
+
+class FakeFirestore:
+    """Just enough of the Firestore client for WriteBehindQuotaEngine's reads and batched writes."""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.failing_commits = 0 # The next N batch commits fail
+        self.commits = 0
+
+    def collection(self, name):
+        return FakeCollection(self)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+def user_doc(free_calls_today=0, balance=0.0):
+    return {'freeCallsToday': free_calls_today, 'lastFreeCallDate': datetime.combine(TODAY, datetime.min.time()),
+            'balance': balance}
+
+
+def run_with_engine(db, scenario):
+    """Runs `await scenario(engine)` between the engine's start() and stop()."""
+    async def main():
+        engine = WriteBehindQuotaEngine(db, FREE_CALL_LIMIT, flush_interval=3600)
+        await engine.start()
+        try:
+            await scenario(engine)
+        finally:
+            await engine.stop()
+    asyncio.run(main())
+
+
+def test_failed_flush_requeues_counts_and_charges():
+    db = FakeFirestore({'u': user_doc(balance=1.0)})
+
+    async def scenario(engine):
+        await engine.reserve('u', TODAY)
+        await engine.reserve('u', TODAY)
+        engine.pending_charges['u'] = 0.25
+        db.failing_commits = 1
+        with pytest.raises(RuntimeError):
+            await engine.flush()
+        assert engine.pending == {('u', TODAY): 2}
+        assert engine.pending_charges == {'u': 0.25}
+        await engine.reserve('u', TODAY) # Counted on top of the requeued deltas
+        await engine.flush()
+        assert engine.pending == {}
+        assert engine.pending_charges == {}
+
+    run_with_engine(db, scenario)
+    assert db.docs['u']['freeCallsToday'] == 3
+    assert db.docs['u']['balance'] == pytest.approx(0.75)
+
+
+def test_partly_failed_flush_does_not_write_committed_batches_twice(monkeypatch):
+    monkeypatch.setattr(usage_counter_cache, 'FIRESTORE_BATCH_LIMIT', 1) # One user per batch
+    db = FakeFirestore({'a': user_doc(), 'b': user_doc()})
+
+    async def scenario(engine):
+        await engine.reserve('a', TODAY)
+        await engine.reserve('b', TODAY)
+        commits = db.commits
+        original_batch = db.batch
+
+        def batch():
+            # The first batch commits, the second one fails
+            fake = original_batch()
+            if db.commits > commits:
+                db.failing_commits = 1
+            return fake
+        db.batch = batch
+        with pytest.raises(RuntimeError):
+            await engine.flush()
+        assert len(engine.pending) == 1
+        db.batch = original_batch
+        await engine.flush()
+
+    run_with_engine(db, scenario)
+    assert db.docs['a']['freeCallsToday'] == 1
+    assert db.docs['b']['freeCallsToday'] == 1
+
+
+def test_profile_reload_during_a_flush_keeps_the_counts_being_written():
+    db = FakeFirestore({'u': user_doc(free_calls_today=1)})
+    committing, release = threading.Event(), threading.Event()
+    original_commit = FakeBatch.commit
+
+    def slow_commit(batch):
+        committing.set()
+        release.wait(5)
+        original_commit(batch)
+
+    async def scenario(engine):
+        await engine.reserve('u', TODAY)
+        await engine.reserve('u', TODAY)
+        FakeBatch.commit = slow_commit
+        try:
+            flush = asyncio.ensure_future(engine.flush())
+            await asyncio.get_running_loop().run_in_executor(None, committing.wait, 5)
+            # Firestore still says 1, but the 2 calls being written must not be forgotten
+            engine.invalidate('u')
+            await engine.reserve('u', TODAY)
+            assert engine.store.counters[('u', TODAY)] == 4
+            release.set()
+            await flush
+        finally:
+            release.set()
+            FakeBatch.commit = original_commit
+
+    run_with_engine(db, scenario)
+    assert db.docs['u']['freeCallsToday'] == 4
+
+
+def test_stop_flushes_pending_counts():
+    db = FakeFirestore({'u': user_doc(free_calls_today=1)})
+
+    async def scenario(engine):
+        await engine.reserve('u', TODAY)
+
+    run_with_engine(db, scenario)
+    assert db.docs['u']['freeCallsToday'] == 2
+
+
+def test_stop_closes_the_store_even_if_the_final_flush_fails():
+    db = FakeFirestore({'u': user_doc()})
+    closed = []
+
+    async def scenario(engine):
+        original_close = engine.store.close
+
+        async def close():
+            closed.append(True)
+            await original_close()
+        engine.store.close = close
+        await engine.reserve('u', TODAY)
+        db.failing_commits = 1
+
+    with pytest.raises(RuntimeError):
+        run_with_engine(db, scenario)
+    assert closed == [True]
+
+
+def test_paid_calls_hold_settle_and_refund():
+    db = FakeFirestore({'u': user_doc(free_calls_today=FREE_CALL_LIMIT, balance=1.0)})
+
+    async def scenario(engine):
+        settled = await engine.reserve('u', TODAY, cost=0.5)
+        refunded = await engine.reserve('u', TODAY, cost=0.25)
+        assert (settled.is_free_call, settled.held, refunded.held) == (False, 0.5, 0.25)
+        with pytest.raises(InsufficientBalanceError):
+            await engine.reserve('u', TODAY, cost=0.5)
+        await engine.settle(settled, 0.125)
+        await engine.refund(refunded)
+        assert await engine.store.add_holds('u', []) == pytest.approx(0.0)
+        # The unflushed charge already counts against the balance
+        with pytest.raises(InsufficientBalanceError):
+            await engine.reserve('u', TODAY, cost=0.9)
+
+    run_with_engine(db, scenario)
+    assert db.docs['u']['balance'] == pytest.approx(0.875)
+    assert db.docs['u']['freeCallsToday'] == FREE_CALL_LIMIT
+
+
+def test_batch_holds_stop_where_the_balance_runs_out():
+    db = FakeFirestore({'u': user_doc(free_calls_today=FREE_CALL_LIMIT - 1, balance=1.0)})
+
+    async def scenario(engine):
+        reservations = await engine.reserve_many('u', 4, TODAY, costs=[0.4, 0.4, 0.4, 0.4])
+        assert [(r.is_free_call, r.held) for r in reservations] == [(True, 0.0), (False, 0.4), (False, 0.4)]
+        assert await engine.store.add_holds('u', []) == pytest.approx(0.8)
+
+    run_with_engine(db, scenario)
+
+
+def test_each_hold_expires_on_its_own(monkeypatch):
+    store = usage_counter_cache.LocalCounterStore()
+    now = [1000.0]
+    monkeypatch.setattr(usage_counter_cache.time, 'monotonic', lambda: now[0])
+
+    async def scenario():
+        await store.add_holds('u', [('lost', 0.5)]) # Never released
+        for _ in range(20):
+            now[0] += 60
+            assert await store.add_holds('u', [('call', 0.1)]) == pytest.approx(0.6 if now[0] < 1900 else 0.1)
+            await store.release_holds('u', [('call', 0.1)])
+
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+# llm-access-service/backend/token_counter.py
+# Local prompt token counting for the pre-flight cost estimate of chat requests.
+#
+# With the optional 'tiktoken' package, prompts are counted with the BPE encoding that
+# model_pricing.yaml names for the model. Encodings are loaded once per process by
+# load_encodings() (from the app's warm-up, since the first load may download the encoding
+# file), never on the request path: until an encoding is loaded, or without tiktoken, prompt
+# tokens are estimated as one token per 3 bytes of UTF-8, which overestimates English text
+# and roughly matches CJK text.
+#
+# Counts of individual message texts are memoized. System prompts and earlier turns of a
+# conversation repeat from request to request, so usually only the newest message is tokenized.
+import logging
+from functools import lru_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+# Per-message overhead of the chat format (role and separators) and the primer of the reply,
+# as counted for OpenAI's chat models
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Memoized message texts per process. Longer texts are counted every time, so the cache
+# stays below TEXT_CACHE_SIZE * MAX_MEMOIZED_CHARS characters.
+TEXT_CACHE_SIZE = 4096
+MAX_MEMOIZED_CHARS = 16384
+
+_encodings = {} # Encoding name -> loaded tiktoken Encoding
+
+
+def load_encodings(names):
+    """
+    Loads the tiktoken encodings `names` (once per process; the first load may download them).
+    Encodings that cannot be loaded are logged and left to the length estimate.
+    """
+    try:
+        import tiktoken # Optional dependency, without it prompt tokens are estimated
+    except ImportError:
+        logger.warning("The 'tiktoken' package is not installed. Prompt tokens are estimated from their length.")
+        return
+    for name in names:
+        if name in _encodings:
+            continue
+        try:
+            _encodings[name] = tiktoken.get_encoding(name)
+        except Exception as e:
+            logger.warning("Could not load the %s encoding, prompt tokens are estimated from their length: %s", name, e)
+            continue
+        logger.info("Loaded the %s encoding.", name)
+        _count_memoized.cache_clear() # Drop counts estimated before the encoding was there
+
+
+def estimate_text_tokens(text):
+    return -(-len(text.encode('utf-8')) // 3)
+
+
+def _count(encoding_name, text):
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        return estimate_text_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _count_memoized(encoding_name, text):
+    return _count(encoding_name, text)
+
+
+def count_text_tokens(text, encoding_name=None):
+    """Tokens of one text with the encoding `encoding_name` (estimated if it is not loaded)."""
+    if len(text) > MAX_MEMOIZED_CHARS:
+        return _count(encoding_name, text)
+    return _count_memoized(encoding_name, text)
+
+
+def count_prompt_tokens(messages, encoding_name=None):
+    """
+    Prompt tokens of a list of chat messages (OpenAI format), counted like the model counts
+    them: every string field (role, content, name) plus the chat format's overhead.
+    Text parts of multi-part content are counted; images are not.
+    """
+    tokens = TOKENS_PER_REPLY
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE
+        if not isinstance(message, dict):
+            continue
+        for key, value in message.items():
+            if isinstance(value, str):
+                tokens += count_text_tokens(value, encoding_name)
+            elif key == 'content' and isinstance(value, list):
+                for part in value:
+                    text = part.get('text') if isinstance(part, dict) else None
+                    if isinstance(text, str):
+                        tokens += count_text_tokens(text, encoding_name)
+    return tokens
+
+
+def text_cache_stats():
+    info = _count_memoized.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'size': info.currsize,
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_ratio': round(info.hits / lookups, 3) if lookups else 0.0,
+        'encodings': sorted(_encodings),
+    }
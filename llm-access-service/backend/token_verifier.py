@@ -0,0 +1,250 @@
+# llm-access-service/backend/token_verifier.py
+# Firebase ID token verification without a network round trip on the request path.
+#
+# Google's signing certificates are kept in memory and refreshed in the background
+# according to their Cache-Control max-age. Tokens that were already verified are kept
+# in a bounded LRU (keyed by the SHA-256 of the token) until their `exp`.
+# Key providers are pluggable, so tests can verify tokens signed with a local keypair.
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+import httpx
+import jwt
+from cryptography.x509 import load_pem_x509_certificate
+from starlette.concurrency import run_in_threadpool
+
+
+logger = logging.getLogger(__name__)
+
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+DEFAULT_CERTS_MAX_AGE = 3600 # Used if Google does not send a max-age
+CERTS_RETRY_SECONDS = 60 # Retry delay after a failed background refresh
+MIN_KID_REFRESH_INTERVAL = 30 # Rate limit for refreshes triggered by an unknown key id
+MIN_EMPTY_REFRESH_INTERVAL = 1 # ... while no keys are loaded yet (startup, or the first fetch failed)
+
+
+class TokenVerificationError(Exception):
+    """Raised when an ID token is missing, malformed, expired or has an invalid signature."""
+
+
+class TokenVerifierUnavailableError(Exception):
+    """Raised when a token can't be checked because no signing keys could be loaded yet."""
+
+
+# --- Key Providers ---
+class StaticKeyProvider:
+    """Serves a fixed set of public keys ({kid: key}). Useful for tests with a local keypair."""
+
+    def __init__(self, keys):
+        self.keys = dict(keys)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def get_key(self, kid):
+        return self.keys.get(kid)
+
+
+class GoogleCertKeyProvider:
+    """
+    Keeps Google's securetoken signing certificates in memory.
+    A background task refreshes them shortly before their Cache-Control max-age runs out.
+    Until start() has loaded them, get_key() fetches them on demand.
+    """
+
+    def __init__(self, http_client=None, certs_url=GOOGLE_CERTS_URL):
+        self._owns_client = http_client is None
+        # Created here, not in start(): requests can arrive before the warm-up calls start()
+        self.http_client = http_client if http_client is not None else httpx.AsyncClient(timeout=httpx.Timeout(10.0))
+        self.certs_url = certs_url
+        self.keys = {}
+        self.expires_at = 0
+        self.last_refresh = 0 # Last successful refresh
+        self.last_attempt = 0 # Last refresh attempt, successful or not
+        self._refresh_task = None
+        self._refresh_lock = asyncio.Lock()
+
+    async def start(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            # Don't block startup; the keys are fetched on first use or by the background task
+            logger.error("Error fetching Firebase signing certificates at startup: %s", e)
+            self.expires_at = time.time() + CERTS_RETRY_SECONDS + 60
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+        if self._owns_client:
+            await self.http_client.aclose()
+
+    async def refresh(self, coalesce=False):
+        """
+        Fetches the current certificates and their max-age.
+        With `coalesce`, returns without fetching if another refresh started while this one waited.
+        """
+        requested = time.time()
+        async with self._refresh_lock:
+            if coalesce and self.last_attempt >= requested:
+                return
+            self.last_attempt = time.time()
+            response = await self.http_client.get(self.certs_url)
+            response.raise_for_status()
+            self.keys = {
+                kid: load_pem_x509_certificate(pem.encode()).public_key()
+                for kid, pem in response.json().items()
+            }
+            max_age = parse_max_age(response.headers.get("Cache-Control"))
+            self.last_refresh = time.time()
+            self.expires_at = self.last_refresh + max_age
+            logger.info("Fetched %d Firebase signing certificates (max-age %ss).", len(self.keys), max_age)
+
+    async def _refresh_loop(self):
+        while True:
+            # Refresh a little before the certificates expire
+            delay = max(self.expires_at - time.time() - 60, 1)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep serving the old keys; Google publishes new keys well before rotating
+                logger.error("Error refreshing Firebase signing certificates: %s", e)
+                self.expires_at = time.time() + CERTS_RETRY_SECONDS + 60
+
+    async def get_key(self, kid):
+        key = self.keys.get(kid)
+        min_interval = MIN_KID_REFRESH_INTERVAL if self.keys else MIN_EMPTY_REFRESH_INTERVAL
+        if key is None and time.time() - self.last_attempt > min_interval:
+            # Unknown key id: the keys may have just rotated, or were not loaded yet.
+            # Concurrent requests share one fetch.
+            try:
+                await self.refresh(coalesce=True)
+            except Exception as e:
+                logger.warning("Error refreshing Firebase signing certificates for unknown kid: %s", e)
+            key = self.keys.get(kid)
+        return key
+
+
+def parse_max_age(cache_control):
+    """Returns the max-age (in seconds) from a Cache-Control header."""
+    if cache_control:
+        match = re.search(r"max-age=(\d+)", cache_control)
+        if match:
+            return int(match.group(1))
+    return DEFAULT_CERTS_MAX_AGE
+
+
+# --- Verifiers ---
+class CachedTokenVerifier:
+    """
+    Verifies Firebase ID tokens locally against keys from a key provider,
+    with a bounded LRU of already-verified tokens.
+    """
+
+    def __init__(self, project_id, key_provider, cache_size=10000, clock_skew_seconds=0):
+        self.project_id = project_id
+        self.key_provider = key_provider
+        self.cache_size = cache_size
+        self.clock_skew_seconds = clock_skew_seconds
+        self._cache = OrderedDict() # token hash -> decoded claims
+
+    async def start(self):
+        await self.key_provider.start()
+
+    async def stop(self):
+        await self.key_provider.stop()
+
+    @property
+    def ready(self):
+        """True once signing keys are loaded."""
+        return bool(self.key_provider.keys)
+
+    async def verify(self, id_token):
+        """
+        Returns the decoded token claims (including 'uid'), or raises TokenVerificationError.
+        Raises TokenVerifierUnavailableError if no signing keys could be loaded to check the token.
+        """
+        token_hash = hashlib.sha256(id_token.encode()).digest()
+
+        claims = self._cache.get(token_hash)
+        if claims is not None:
+            if claims['exp'] + self.clock_skew_seconds > time.time():
+                self._cache.move_to_end(token_hash)
+                return claims
+            del self._cache[token_hash]
+            raise TokenVerificationError("Firebase ID token has expired.")
+
+        claims = await self._decode(id_token)
+
+        self._cache[token_hash] = claims
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False) # Evict the least recently used token
+        return claims
+
+    async def _decode(self, id_token):
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except jwt.PyJWTError as e:
+            raise TokenVerificationError(f"Firebase ID token is invalid: {e}")
+
+        if header.get('alg') != 'RS256':
+            raise TokenVerificationError("Firebase ID token is invalid: unexpected algorithm.")
+
+        key = await self.key_provider.get_key(header.get('kid'))
+        if key is None and not self.ready:
+            # Not the token's fault: say so, instead of rejecting a possibly valid token
+            raise TokenVerifierUnavailableError("Firebase signing certificates are not loaded yet.")
+        if key is None:
+            raise TokenVerificationError("Firebase ID token is invalid: unknown signing key.")
+
+        try:
+            claims = jwt.decode(
+                id_token,
+                key=key,
+                algorithms=['RS256'],
+                audience=self.project_id,
+                issuer=f"https://securetoken.google.com/{self.project_id}",
+                leeway=self.clock_skew_seconds,
+                options={"require": ["exp", "iat", "sub"]},
+            )
+        except jwt.ExpiredSignatureError:
+            raise TokenVerificationError("Firebase ID token has expired.")
+        except jwt.PyJWTError as e:
+            raise TokenVerificationError(f"Firebase ID token is invalid: {e}")
+
+        if not claims['sub'] or len(claims['sub']) > 128:
+            raise TokenVerificationError("Firebase ID token is invalid: bad subject.")
+        claims['uid'] = claims['sub']
+        return claims
+
+
+class FirebaseAdminTokenVerifier:
+    """Fallback that delegates to firebase_admin.auth.verify_id_token (runs in a worker thread)."""
+
+    ready = True # firebase_admin fetches its keys on first use
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def verify(self, id_token):
+        from firebase_admin import auth
+        try:
+            return await run_in_threadpool(auth.verify_id_token, id_token)
+        except (auth.ExpiredIdTokenError, auth.InvalidIdTokenError) as e:
+            raise TokenVerificationError(str(e))
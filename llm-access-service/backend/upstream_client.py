@@ -0,0 +1,43 @@
+# llm-access-service/backend/upstream_client.py
+import logging
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+# --- LiteLLM HTTP Client ---
+# All calls from the backend go to a single host (the LiteLLM proxy), so the pool
+# limits below are effectively per-host connection limits. The values come from the
+# LITELLM_HTTP_* settings (see settings.py); the defaults here match those.
+def create_litellm_client(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0,
+                          connect_timeout=5.0, read_timeout=120.0, write_timeout=10.0, pool_timeout=10.0,
+                          http2=False):
+    """
+    Creates the shared async HTTP client used for all LiteLLM calls.
+    Meant to be created once at app startup and closed at shutdown.
+
+    HTTP/2 multiplexes many requests over one connection. It needs the optional 'h2' package
+    and an upstream that speaks HTTP/2; without 'h2' the client falls back to HTTP/1.1 keep-alive.
+    """
+    if http2:
+        try:
+            import h2 # noqa: F401 - only checking that HTTP/2 support is installed
+        except ImportError:
+            logger.warning("LITELLM_HTTP2 is enabled but the 'h2' package is not installed. Falling back to HTTP/1.1.")
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=write_timeout,
+            pool=pool_timeout,
+        ),
+    )
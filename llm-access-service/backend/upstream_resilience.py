@@ -0,0 +1,234 @@
+# llm-access-service/backend/upstream_resilience.py
+# Retries, hedged requests and circuit breaking around LiteLLM calls.
+#
+# - Deadline: every chat request gets an overall deadline. Attempts, backoff sleeps and
+#   scheduler waits all count against it, and the remaining time is forwarded to LiteLLM.
+# - Retries: connect errors, 429 and 5xx answers are retried with full-jitter exponential
+#   backoff. Read timeouts are not retried, since the provider may already be generating
+#   (and billing) the first attempt.
+# - Hedging (optional, non-streaming only): if an attempt is slower than the model's recent
+#   p95 latency, a second identical attempt is started and the first answer wins. Both
+#   attempts (and retries) carry the same request id in their LiteLLM metadata, and the
+#   billing job bills one usage row per request id, so a hedged call is billed once.
+# - Circuit breaker: after `failure_threshold` consecutive failures of a model, its calls
+#   fail fast for `reset_timeout` seconds, then a single trial call decides whether to close.
+#   Only transport errors and 5xx answers are failures. A request deadline set by the client,
+#   or a wait in this worker's scheduler queue, says nothing about the upstream, so users
+#   can't open a model's breaker for everyone by sending calls with tiny deadlines.
+import asyncio
+import math
+import random
+import time
+from collections import deque
+
+import httpx
+
+from model_scheduler import ModelBusyError
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class DeadlineExceededError(Exception):
+    """The request's deadline passed before LiteLLM answered."""
+
+
+class CircuitOpenError(ModelBusyError):
+    """The model's circuit breaker is open: recent calls failed, so this one fails fast."""
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+def is_retryable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+def is_upstream_failure(error):
+    """
+    Errors that say the upstream is unhealthy (429 only says it is busy, 4xx are the caller's
+    fault, and DeadlineExceededError depends on the caller's deadline).
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def retry_after_seconds(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return float(error.response.headers.get("Retry-After", ""))
+        except ValueError:
+            return None
+    return None
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.times_opened = 0
+
+    def before_call(self, model):
+        if self.state == 'open':
+            waited = time.monotonic() - self.opened_at
+            if waited < self.reset_timeout:
+                raise CircuitOpenError(f"Model {model} is currently unavailable.", max(1, math.ceil(self.reset_timeout - waited)))
+            self.state = 'half-open'
+        if self.state == 'half-open':
+            if self.trial_in_flight:
+                raise CircuitOpenError(f"Model {model} is currently unavailable.", 1)
+            self.trial_in_flight = True
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == 'half-open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                self.times_opened += 1
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def record_other(self):
+        # The call ended without telling anything about the upstream's health (e.g. cancelled)
+        self.trial_in_flight = False
+
+
+class LatencyWindow:
+    """The latest successful call durations of a model, for the hedging delay."""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class UpstreamResilience:
+    def __init__(self, max_attempts=3, backoff_base=0.2, backoff_max=2.0, failure_threshold=5,
+                 reset_timeout=30.0, hedging=False, hedge_min_samples=20):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedging = hedging
+        self.hedge_min_samples = hedge_min_samples
+        self._breakers = {}
+        self._latencies = {}
+        # Metrics
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadlines_exceeded = 0
+
+    async def call(self, model, deadline, attempt, hedge=False):
+        """
+        Runs `attempt()` (a coroutine function making one upstream call) with retries,
+        optional hedging and the model's circuit breaker. Returns its result or raises the
+        last error, CircuitOpenError or DeadlineExceededError.
+        """
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+
+        for attempt_number in range(self.max_attempts):
+            breaker.before_call(model)
+            try:
+                if hedge and self.hedging:
+                    result = await self._hedged(model, deadline, attempt)
+                else:
+                    result = await self._timed(model, deadline, attempt)
+            except BaseException as e:
+                if is_upstream_failure(e):
+                    breaker.record_failure()
+                elif isinstance(e, Exception) and not isinstance(e, (ModelBusyError, DeadlineExceededError)):
+                    breaker.record_success() # The upstream answered, e.g. 4xx or 429
+                else:
+                    breaker.record_other()
+                if not is_retryable(e) or attempt_number == self.max_attempts - 1:
+                    raise
+                # Full jitter, but never sooner than the upstream's Retry-After
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt_number))
+                delay = max(delay, retry_after_seconds(e) or 0)
+                if delay >= deadline.remaining():
+                    raise
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+    async def _timed(self, model, deadline, attempt):
+        remaining = deadline.remaining()
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(attempt(), timeout=remaining)
+        except asyncio.TimeoutError:
+            self.deadlines_exceeded += 1
+            raise DeadlineExceededError(f"No answer from model {model} before the request deadline.") from None
+        self._latency(model).add(time.monotonic() - started)
+        return result
+
+    async def _hedged(self, model, deadline, attempt):
+        latency = self._latency(model)
+        delay = latency.percentile(0.95) if len(latency.samples) >= self.hedge_min_samples else None
+        if delay is None or delay >= deadline.remaining():
+            return await self._timed(model, deadline, attempt)
+
+        tasks = [asyncio.ensure_future(self._timed(model, deadline, attempt))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Slower than 95% of recent calls: race a second attempt against the first
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(self._timed(model, deadline, attempt)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.hedge_wins += task is not tasks[0]
+                        return task.result()
+            return tasks[0].result() # Every attempt failed: raise the first one's error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _latency(self, model):
+        latency = self._latencies.get(model)
+        if latency is None:
+            latency = self._latencies[model] = LatencyWindow()
+        return latency
+
+    def stats(self):
+        return {
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'deadlines_exceeded': self.deadlines_exceeded,
+            'breakers': {
+                model: {'state': breaker.state, 'failures': breaker.failures, 'times_opened': breaker.times_opened}
+                for model, breaker in self._breakers.items()
+            },
+        }
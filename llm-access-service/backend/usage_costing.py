@@ -0,0 +1,112 @@
+# llm-access-service/backend/usage_costing.py
+# Columnar cost computation for the billing job.
+# A chunk of usage rows is turned into arrays (model ids, prompt tokens, completion tokens)
+# and priced in one vectorized pass against a precomputed per-token price table.
+from itertools import repeat
+
+import numpy as np
+
+
+class PriceTable:
+    """
+    Per-token prices with the profit margin already applied, as arrays indexed by model id.
+    Unknown models get the last index, priced at 0; the billing job logs them.
+    Built by model_registry.py from model_pricing.yaml.
+    """
+
+    def __init__(self, pricing, profit_margin):
+        """pricing: {model: {"input": ..., "output": ...}}, prices per million tokens."""
+        self.models = list(pricing)
+        self.model_index = {model: i for i, model in enumerate(self.models)}
+        self.unknown_index = len(self.models)
+        multiplier = (1 + profit_margin) / 1_000_000
+        self.input_price = np.array([pricing[m].get("input", 0) for m in self.models] + [0.0]) * multiplier
+        self.output_price = np.array([pricing[m].get("output", 0) for m in self.models] + [0.0]) * multiplier
+
+    def model_ids(self, models):
+        """Maps a sequence of model names to an array of model ids."""
+        # map() over dict.get runs the lookups in C, without a Python-level loop
+        ids = map(self.model_index.get, models, repeat(self.unknown_index, len(models)))
+        return np.fromiter(ids, dtype=np.intp, count=len(models))
+
+
+class CostedChunk:
+    """A priced chunk of usage rows, column by column."""
+
+    def __init__(self, record_ids, user_ids, models, model_ids, input_tokens, output_tokens, timestamps, costs, request_ids=None):
+        self.record_ids = record_ids
+        self.user_ids = user_ids
+        self.models = models
+        self.model_ids = model_ids
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.timestamps = timestamps
+        self.costs = costs
+        self.request_ids = request_ids if request_ids is not None else [None] * len(record_ids)
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def aggregates(self):
+        """
+        Returns per-user/per-model totals as columns (arrays of equal length):
+        {'user_id', 'model', 'calls', 'input_tokens', 'output_tokens', 'cost'}.
+        """
+        # Integer codes for users (dict lookups are much cheaper than sorting strings),
+        # combined with the model ids into one group key per user/model pair
+        user_index = dict.fromkeys(self.user_ids.tolist())
+        for code, user_id in enumerate(user_index):
+            user_index[user_id] = code
+        user_codes = np.fromiter(map(user_index.__getitem__, self.user_ids.tolist()), dtype=np.int64, count=len(self))
+        group_keys = user_codes * (int(self.model_ids.max()) + 1 if len(self) else 1) + self.model_ids
+        groups, first_index, group_codes = np.unique(group_keys, return_index=True, return_inverse=True)
+
+        return {
+            'user_id': self.user_ids[first_index],
+            'model': self.models[first_index],
+            'calls': np.bincount(group_codes, minlength=len(groups)),
+            'input_tokens': np.bincount(group_codes, weights=self.input_tokens, minlength=len(groups)).astype(np.int64),
+            'output_tokens': np.bincount(group_codes, weights=self.output_tokens, minlength=len(groups)).astype(np.int64),
+            'cost': np.bincount(group_codes, weights=self.costs, minlength=len(groups)),
+        }
+
+
+def _token_column(values):
+    # NULL token counts become NaN in the float conversion and are billed as 0
+    return np.nan_to_num(np.array(values, dtype=np.float64), nan=0.0, copy=False).astype(np.int64)
+
+
+def price_chunk(usage_records, price_table):
+    """
+    Prices a chunk of rows (id, user_id, model, prompt_tokens, completion_tokens, timestamp[, request_id]).
+    Returns (CostedChunk of billable rows, IDs of rows skipped for a missing user_id).
+    """
+    count = len(usage_records)
+    if not count:
+        return CostedChunk([], np.array([], dtype=object), np.array([], dtype=object), np.array([], dtype=np.intp),
+                           np.array([], dtype=np.int64), np.array([], dtype=np.int64), [], np.array([])), []
+
+    columns = list(zip(*usage_records))
+    record_ids, user_ids, models, prompt_tokens, completion_tokens, timestamps = columns[:6]
+    request_ids = columns[6] if len(columns) > 6 else (None,) * count
+    user_ids = np.array(user_ids, dtype=object)
+    models = np.array(models, dtype=object)
+    input_tokens = _token_column(prompt_tokens)
+    output_tokens = _token_column(completion_tokens)
+
+    # Rows without a user can't be billed
+    billable = user_ids.astype(bool)
+    skipped_record_ids = [] if billable.all() else [record_ids[i] for i in np.flatnonzero(~billable)]
+    if skipped_record_ids:
+        record_ids = [record_ids[i] for i in np.flatnonzero(billable)]
+        timestamps = [timestamps[i] for i in np.flatnonzero(billable)]
+        request_ids = [request_ids[i] for i in np.flatnonzero(billable)]
+        user_ids, models = user_ids[billable], models[billable]
+        input_tokens, output_tokens = input_tokens[billable], output_tokens[billable]
+
+    model_ids = price_table.model_ids(models) if len(models) else np.array([], dtype=np.intp)
+    costs = input_tokens * price_table.input_price[model_ids] + output_tokens * price_table.output_price[model_ids]
+
+    chunk = CostedChunk(list(record_ids), user_ids, models, model_ids, input_tokens, output_tokens, list(timestamps), costs,
+                        list(request_ids))
+    return chunk, skipped_record_ids
@@ -0,0 +1,419 @@
+# llm-access-service/backend/usage_counter_cache.py
+# Write-behind quota engine: free-call counters live in memory (or in Redis, shared by all
+# workers) and are flushed to the Firestore user documents in batches, so Firestore write
+# cost is per user per flush interval instead of per request.
+#
+# Staleness is bounded: user profiles (balance, stored counters) are re-read after
+# `max_staleness` seconds, pending deltas are flushed every `flush_interval` seconds
+# (or earlier once `flush_threshold` users are dirty), and everything is flushed on shutdown.
+#
+# Balance holds of paid calls in flight live in the counter store too (shared through Redis),
+# each with its own expiry (see quota.py), and settled charges are flushed like the free-call deltas, as Firestore increments of the
+# balance. Other workers see a charge once it is flushed and they re-read the profile.
+import asyncio
+import logging
+import time
+from datetime import date, datetime
+
+from firebase_admin import firestore
+from starlette.concurrency import run_in_threadpool
+
+from api_metrics import STAGE_SECONDS
+from quota import (
+    BALANCE_HOLD_TTL_SECONDS,
+    InsufficientBalanceError,
+    QuotaEngine,
+    QuotaExceededError,
+    QuotaReservation,
+    UserNotFoundError,
+    new_hold_id,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+FIRESTORE_BATCH_LIMIT = 500 # Max writes in one Firestore batch
+
+
+# --- Counter Stores ---
+class LocalCounterStore:
+    """Per-process counters. Exact within one worker; workers only see each other's calls after a flush."""
+
+    def __init__(self):
+        self.counters = {} # (user_id, day) -> count
+        self.holds = {} # user_id -> {hold id: (amount, monotonic expiry)} of calls in flight
+
+    async def seed(self, user_id, day, value, overwrite=False):
+        key = (user_id, day)
+        if overwrite or key not in self.counters:
+            self.counters[key] = value
+
+    async def incr(self, user_id, day, amount):
+        key = (user_id, day)
+        self.counters[key] = self.counters.get(key, 0) + amount
+        # Drop counters from previous days
+        if amount > 0 and len(self.counters) % 1000 == 0:
+            self.counters = {k: v for k, v in self.counters.items() if k[1] >= day}
+        return self.counters[key]
+
+    async def add_holds(self, user_id, holds):
+        """
+        Adds (hold id, amount) holds that expire after BALANCE_HOLD_TTL_SECONDS and returns
+        the balance held by all unexpired holds of the user, these included.
+        """
+        now = time.monotonic()
+        user_holds = {hold_id: hold for hold_id, hold in self.holds.get(user_id, {}).items() if hold[1] > now}
+        for hold_id, amount in holds:
+            user_holds[hold_id] = (amount, now + BALANCE_HOLD_TTL_SECONDS)
+        if user_holds:
+            self.holds[user_id] = user_holds
+        else:
+            self.holds.pop(user_id, None)
+        return sum(amount for amount, _ in user_holds.values())
+
+    async def release_holds(self, user_id, holds):
+        """Removes (hold id, amount) holds added by add_holds()."""
+        user_holds = self.holds.get(user_id, {})
+        for hold_id, _ in holds:
+            user_holds.pop(hold_id, None)
+        if not user_holds:
+            self.holds.pop(user_id, None)
+
+    async def close(self):
+        pass
+
+
+class RedisCounterStore:
+    """Counters shared by all workers and hosts through Redis (atomic INCRBY)."""
+
+    def __init__(self, redis_url, key_prefix="freecalls"):
+        import redis.asyncio as redis # Optional dependency, only needed for this store
+        self.redis = redis.from_url(redis_url)
+        self.key_prefix = key_prefix
+
+    def _key(self, user_id, day):
+        return f"{self.key_prefix}:{user_id}:{day.isoformat()}"
+
+    async def seed(self, user_id, day, value, overwrite=False):
+        # Redis is authoritative once the key exists, so only seed missing keys
+        await self.redis.set(self._key(user_id, day), value, ex=2 * 24 * 3600, nx=not overwrite)
+
+    async def incr(self, user_id, day, amount):
+        return await self.redis.incrby(self._key(user_id, day), amount)
+
+    # Holds are members '<hold id>:<amount>' of a sorted set per user, scored by their expiry
+    # (Unix time), so the hold of a call that is never settled (a worker died) expires on its own.
+    def _holds_key(self, user_id):
+        return f"{self.key_prefix}:holds:{user_id}"
+
+    async def add_holds(self, user_id, holds):
+        key = self._holds_key(user_id)
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now)
+            if holds:
+                pipe.zadd(key, {f"{hold_id}:{amount!r}": now + BALANCE_HOLD_TTL_SECONDS for hold_id, amount in holds})
+            pipe.zrange(key, 0, -1)
+            pipe.expire(key, BALANCE_HOLD_TTL_SECONDS)
+            results = await pipe.execute()
+        members = results[-2]
+        return sum(float(member.rsplit(b':', 1)[1]) for member in members)
+
+    async def release_holds(self, user_id, holds):
+        if holds:
+            await self.redis.zrem(self._holds_key(user_id), *(f"{hold_id}:{amount!r}" for hold_id, amount in holds))
+
+    async def close(self):
+        await self.redis.close()
+
+
+# --- Write-Behind Quota Engine ---
+class CachedUser:
+    def __init__(self, balance, stored_day, loaded_at):
+        self.balance = balance
+        self.stored_day = stored_day # The lastFreeCallDate currently stored in Firestore
+        self.loaded_at = loaded_at
+
+
+class WriteBehindQuotaEngine(QuotaEngine):
+    """
+    Quota backend that reserves free calls against in-memory/Redis counters and
+    flushes the coalesced deltas to Firestore in batched writes.
+    """
+
+    def __init__(self, db, free_call_limit, store=None, flush_interval=5.0, flush_threshold=500, max_staleness=30.0):
+        super().__init__(free_call_limit)
+        self.db = db
+        self.store = store or LocalCounterStore()
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_staleness = max_staleness
+        self.users = {} # user_id -> CachedUser
+        self.pending = {} # (user_id, day) -> free calls not yet written to Firestore
+        self._flushing = {} # ... and the part of them being written right now
+        self.pending_charges = {} # user_id -> settled cost not yet written to Firestore
+        self._flushing_charges = {} # ... and the part of it being written right now
+        self._loading = {} # user_id -> future of an in-flight profile load
+        self._flush_task = None
+        self._flush_now = None
+        self._flush_lock = None
+
+    async def start(self):
+        self._flush_now = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        try:
+            await self.flush() # Don't lose pending counts on shutdown
+        except Exception:
+            logger.error("Final flush failed, pending usage counts of %d users and charges of %d users are lost.",
+                         len({user_id for user_id, _ in self.pending}), len(self.pending_charges))
+            raise
+        finally:
+            await self.store.close()
+
+    async def reserve(self, user_id, today=None, cost=0.0):
+        today = today or date.today()
+        cached = await self._get_user(user_id, today)
+
+        free_calls_used = await self.store.incr(user_id, today, 1)
+        if free_calls_used <= self.free_call_limit:
+            self._add_pending(user_id, today, 1)
+            return QuotaReservation(user_id, today, True, free_calls_used, cached.balance)
+
+        # Free limit reached: undo the increment and hold the call's cost against the paid balance
+        free_calls_used = await self.store.incr(user_id, today, -1)
+        reservations = await self._hold(user_id, today, cached, free_calls_used, [cost])
+        return reservations[0]
+
+    async def reserve_many(self, user_id, count, today=None, costs=None):
+        # One counter increment for the whole batch, then give back what exceeds the free limit
+        today = today or date.today()
+        cached = await self._get_user(user_id, today)
+
+        free_calls_used = await self.store.incr(user_id, today, count)
+        over_limit = min(max(free_calls_used - self.free_call_limit, 0), count)
+        if over_limit:
+            free_calls_used = await self.store.incr(user_id, today, -over_limit)
+        free_calls = count - over_limit
+        if free_calls:
+            self._add_pending(user_id, today, free_calls)
+
+        first_used = free_calls_used - free_calls
+        reservations = [QuotaReservation(user_id, today, True, first_used + i + 1, cached.balance) for i in range(free_calls)]
+        if over_limit:
+            paid_costs = list(costs[free_calls:]) if costs else [0.0] * over_limit
+            try:
+                reservations += await self._hold(user_id, today, cached, free_calls_used, paid_costs)
+            except QuotaExceededError:
+                if not reservations:
+                    raise
+        return reservations
+
+    async def refund(self, reservation):
+        if reservation.is_free_call:
+            await self.store.incr(reservation.user_id, reservation.day, -1)
+            self._add_pending(reservation.user_id, reservation.day, -1)
+        elif reservation.hold_id:
+            await self.store.release_holds(reservation.user_id, [(reservation.hold_id, reservation.held)])
+
+    async def settle(self, reservation, cost):
+        if reservation.is_free_call:
+            return
+        if cost:
+            self.pending_charges[reservation.user_id] = self.pending_charges.get(reservation.user_id, 0.0) + cost
+            self._request_flush_if_due()
+        if reservation.hold_id:
+            await self.store.release_holds(reservation.user_id, [(reservation.hold_id, reservation.held)])
+
+    async def _hold(self, user_id, today, cached, free_calls_used, costs):
+        """
+        Holds the costs of paid calls, in order, while the balance covers them, and returns
+        their reservations. One store increment for all of them, one more to give back the rest.
+        """
+        holds = [(new_hold_id() if cost else None, cost) for cost in costs]
+        total = sum(costs)
+        held = await self.store.add_holds(user_id, [hold for hold in holds if hold[0]])
+        available = cached.balance - self._unflushed_charges(user_id) - (held - total)
+        reservations = []
+        covered = 0.0
+        if available > 0:
+            for hold_id, cost in holds:
+                if covered + cost > available:
+                    break
+                reservations.append(QuotaReservation(user_id, today, False, free_calls_used, available - covered, cost, hold_id))
+                covered += cost
+        uncovered = [hold for hold in holds[len(reservations):] if hold[0]]
+        if uncovered:
+            await self.store.release_holds(user_id, uncovered)
+        if not reservations:
+            if available > 0:
+                raise InsufficientBalanceError(available, costs[0])
+            raise QuotaExceededError("You have run out of tokens. Please top up your account to continue.")
+        return reservations
+
+    def _unflushed_calls(self, user_id, day):
+        key = (user_id, day)
+        return self.pending.get(key, 0) + self._flushing.get(key, 0)
+
+    def _unflushed_charges(self, user_id):
+        return self.pending_charges.get(user_id, 0.0) + self._flushing_charges.get(user_id, 0.0)
+
+    def invalidate(self, user_id):
+        # Forces the next reserve() for this user to re-read the profile (e.g. after a top-up)
+        cached = self.users.get(user_id)
+        if cached is not None:
+            cached.loaded_at = float('-inf') # Keep stored_day, which the flush still needs
+
+    def _add_pending(self, user_id, day, delta):
+        key = (user_id, day)
+        self.pending[key] = self.pending.get(key, 0) + delta
+        self._request_flush_if_due()
+
+    def _request_flush_if_due(self):
+        if len(self.pending) + len(self.pending_charges) >= self.flush_threshold and self._flush_now is not None:
+            self._flush_now.set()
+
+    async def _get_user(self, user_id, today):
+        cached = self.users.get(user_id)
+        if cached is not None and time.monotonic() - cached.loaded_at < self.max_staleness:
+            return cached
+
+        # Coalesce concurrent loads of the same profile into one Firestore read
+        future = self._loading.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load_user(user_id, today))
+            self._loading[user_id] = future
+            future.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        return await asyncio.shield(future)
+
+    async def _load_user(self, user_id, today):
+        with STAGE_SECONDS.labels('profile_read').time():
+            user_doc = await run_in_threadpool(self.db.collection('users').document(user_id).get)
+        if not user_doc.exists:
+            raise UserNotFoundError(f"User data not found for {user_id}.")
+        user_data = user_doc.to_dict()
+
+        stored_day = user_data.get('lastFreeCallDate')
+        if isinstance(stored_day, datetime):
+            stored_day = stored_day.date()
+        stored_count = (user_data.get('freeCallsToday', 0) or 0) if stored_day == today else 0
+
+        # The counter is what Firestore has plus what this process has not flushed yet,
+        # which also picks up calls flushed by other workers. Redis keeps its own value
+        # if the key already exists, since it is shared by all workers.
+        await self.store.seed(
+            user_id, today, stored_count + self._unflushed_calls(user_id, today),
+            overwrite=isinstance(self.store, LocalCounterStore),
+        )
+
+        cached = CachedUser(user_data.get('balance', 0) or 0, stored_day, time.monotonic())
+        self.users[user_id] = cached
+        return cached
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Error flushing usage counters to Firestore: %s", e)
+
+    async def flush(self):
+        """Writes all pending deltas and charges to Firestore."""
+        if not self.pending and not self.pending_charges:
+            return
+        async with self._flush_lock:
+            pending, self.pending = self.pending, {}
+            charges, self.pending_charges = self.pending_charges, {}
+            self._flushing, self._flushing_charges = pending, charges
+            try:
+                await run_in_threadpool(self._write_deltas, pending)
+                await run_in_threadpool(self._write_charges, charges)
+            except Exception:
+                # Put the deltas that were not written back, so the next flush retries them
+                for key, delta in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + delta
+                for user_id, charge in charges.items():
+                    self.pending_charges[user_id] = self.pending_charges.get(user_id, 0.0) + charge
+                raise
+            finally:
+                self._flushing, self._flushing_charges = {}, {}
+
+    def _write_deltas(self, pending):
+        """Writes the deltas and removes each one from `pending` once it is committed."""
+        same_day, new_day = [], []
+        for (user_id, day), delta in pending.items():
+            cached = self.users.get(user_id)
+            if cached is not None and cached.stored_day == day:
+                if delta:
+                    same_day.append((user_id, day, delta))
+            else:
+                new_day.append((user_id, day, delta))
+
+        # Same day as stored: coalesced atomic increments, up to 500 per batch
+        for start in range(0, len(same_day), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            chunk = same_day[start:start + FIRESTORE_BATCH_LIMIT]
+            for user_id, day, delta in chunk:
+                batch.update(self.db.collection('users').document(user_id), {'freeCallsToday': firestore.Increment(delta)})
+            batch.commit()
+            for user_id, day, delta in chunk:
+                del pending[(user_id, day)]
+
+        # First write of a new day: reset and add in a transaction, because another
+        # worker may already have reset the counter. Happens once per user per day.
+        for user_id, day, delta in new_day:
+            self._reset_day(user_id, day, delta)
+            del pending[(user_id, day)]
+            cached = self.users.get(user_id)
+            if cached is not None:
+                cached.stored_day = day
+
+        if same_day or new_day:
+            logger.debug("Flushed usage counters for %d users to Firestore.", len(same_day) + len(new_day))
+
+    def _write_charges(self, charges):
+        """Deducts the settled charges from the balances and removes each one from `charges` once it is committed."""
+        items = list(charges.items())
+        for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            chunk = items[start:start + FIRESTORE_BATCH_LIMIT]
+            for user_id, charge in chunk:
+                batch.update(self.db.collection('users').document(user_id), {'balance': firestore.Increment(-charge)})
+            batch.commit()
+            for user_id, _ in chunk:
+                del charges[user_id]
+                cached = self.users.get(user_id)
+                if cached is not None:
+                    cached.loaded_at = float('-inf') # Re-read the balance, which now includes the charge
+        if items:
+            logger.debug("Flushed balance charges for %d users to Firestore.", len(items))
+
+    def _reset_day(self, user_id, day, delta):
+        user_ref = self.db.collection('users').document(user_id)
+        day_start = datetime.combine(day, datetime.min.time())
+
+        @firestore.transactional
+        def reset_in_transaction(transaction):
+            user_data = user_ref.get(transaction=transaction).to_dict() or {}
+            stored_day = user_data.get('lastFreeCallDate')
+            if isinstance(stored_day, datetime) and stored_day.date() == day:
+                count = (user_data.get('freeCallsToday', 0) or 0) + delta
+            else:
+                count = delta
+            transaction.update(user_ref, {'freeCallsToday': max(count, 0), 'lastFreeCallDate': day_start})
+
+        reset_in_transaction(self.db.transaction())
@@ -0,0 +1,105 @@
+# llm-access-service/backend/usage_rollups.py
+# Pre-aggregated daily usage per user and model, kept in the 'usage_rollups' collection.
+# The billing job increments one rollup document per (user, day, model) in the same
+# Firestore transaction that writes the billing records, and the backend serves them
+# to the usage dashboard (one small read instead of every raw billing record).
+#
+# The dashboard query needs a composite index on usage_rollups:
+#   user_id ASC, day DESC, model ASC
+from firebase_admin import firestore
+
+
+ROLLUP_COLLECTION = 'usage_rollups'
+FIRESTORE_BATCH_LIMIT = 500 # Max writes in one Firestore batch or transaction
+
+
+def rollup_document_id(user_id, day, model):
+    # Model names can contain '/' (e.g. provider prefixes), which is not allowed in document IDs
+    return f"{user_id}_{day}_{model}".replace('/', '_')
+
+
+def usage_day(timestamp):
+    """The rollup day (YYYY-MM-DD) of a usage timestamp."""
+    return timestamp.date().isoformat()
+
+
+def build_rollups(billing_records):
+    """Sums billing records into {(user_id, day, model): totals}."""
+    rollups = {}
+    for record in billing_records:
+        key = (record['user_id'], usage_day(record['timestamp']), record['model'])
+        totals = rollups.get(key)
+        if totals is None:
+            totals = rollups[key] = {'calls': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost': 0.0}
+        totals['calls'] += 1
+        totals['input_tokens'] += record['input_tokens']
+        totals['output_tokens'] += record['output_tokens']
+        totals['cost'] += record['cost']
+    return rollups
+
+
+def plan_billing_batches(billing_records, limit=FIRESTORE_BATCH_LIMIT):
+    """
+    Splits billing records into batches whose billing documents plus rollup documents
+    fit in one Firestore write batch.
+    """
+    batch, rollup_keys = [], set()
+    for record in billing_records:
+        key = (record['user_id'], usage_day(record['timestamp']), record['model'])
+        new_keys = len(rollup_keys) + (key not in rollup_keys)
+        if batch and len(batch) + 1 + new_keys > limit:
+            yield batch
+            batch, rollup_keys = [], set()
+        batch.append(record)
+        rollup_keys.add(key)
+    if batch:
+        yield batch
+
+
+def add_rollup_increments(transaction, db, rollups):
+    """Adds one merge write with atomic increments per rollup document to the transaction."""
+    for (user_id, day, model), totals in rollups.items():
+        rollup_ref = db.collection(ROLLUP_COLLECTION).document(rollup_document_id(user_id, day, model))
+        transaction.set(rollup_ref, {
+            'user_id': user_id,
+            'day': day,
+            'model': model,
+            'calls': firestore.Increment(totals['calls']),
+            'input_tokens': firestore.Increment(totals['input_tokens']),
+            'output_tokens': firestore.Increment(totals['output_tokens']),
+            'cost': firestore.Increment(totals['cost']),
+            'updated_at': firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+
+def query_rollups(db, user_id, start_day=None, end_day=None, page_size=100, page_token=None):
+    """
+    Returns (rollups, next_page_token) for a user, newest day first.
+    Days are YYYY-MM-DD strings (inclusive range). The page token is the (day, model)
+    of the last returned rollup, so paging needs no extra document read.
+    """
+    query = db.collection(ROLLUP_COLLECTION).where('user_id', '==', user_id)
+    if start_day:
+        query = query.where('day', '>=', start_day)
+    if end_day:
+        query = query.where('day', '<=', end_day)
+    query = query.order_by('day', direction=firestore.Query.DESCENDING).order_by('model')
+    if page_token:
+        last_day, _, last_model = page_token.partition('|')
+        query = query.start_after({'day': last_day, 'model': last_model})
+
+    rollups = [
+        {
+            'day': data.get('day'),
+            'model': data.get('model'),
+            'calls': data.get('calls', 0),
+            'input_tokens': data.get('input_tokens', 0),
+            'output_tokens': data.get('output_tokens', 0),
+            'cost': data.get('cost', 0.0),
+        }
+        for data in (doc.to_dict() for doc in query.limit(page_size).stream())
+    ]
+    next_page_token = None
+    if len(rollups) == page_size:
+        next_page_token = f"{rollups[-1]['day']}|{rollups[-1]['model']}"
+    return rollups, next_page_token